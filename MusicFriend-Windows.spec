@@ -5,7 +5,7 @@ a = Analysis(
     ['pure_desktop_app.py'],
     pathex=[],
     binaries=[],
-    datas=[('spotify_detector.py', '.'), ('desktop_assistant.py', '.'), ('netease_api_utils.py', '.')],
+    datas=[('spotify_detector.py', '.'), ('desktop_assistant.py', '.'), ('netease_api_utils.py', '.'), ('startup_profiler.py', '.'), ('track_index.py', '.'), ('clock_sync.py', '.'), ('album_art.py', '.'), ('async_core.py', '.'), ('update_outbox.py', '.'), ('ui_scheduler.py', '.'), ('music_daemon.py', '.')],
     hiddenimports=[],
     hookspath=[],
     hooksconfig={},
@@ -1,23 +1,28 @@
 import tkinter as tk
+import asyncio
 import threading
 import time
+import aiohttp
 import requests
 from PIL import Image, ImageTk
 import io
+from concurrent.futures import ThreadPoolExecutor
+import album_art
+import music_daemon
 import netease_client
 
 # --- Global variables ---
-currently_displayed_song = None
+currently_displayed_song = None # (song, artist) as detected, while it is on screen
 album_cover_photo = None # To hold a reference to the PhotoImage
+cover_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cover") # Covers of daemon songs
 
-def update_album_art(image_url):
-    """Downloads the image and updates the album cover label."""
+def update_album_art(cover_future, song):
+    """Called once the prefetched cover download finishes; updates the album cover label."""
     global album_cover_photo
+    if song != currently_displayed_song:
+        return # The user already moved on to another song
     try:
-        # Download image data
-        response = requests.get(image_url, timeout=5)
-        response.raise_for_status() # Raise an exception for bad status codes
-        image_data = response.content
+        image_data = cover_future.result()
         
         # Open image data with Pillow and resize
         pil_image = Image.open(io.BytesIO(image_data))
@@ -35,48 +40,91 @@ def update_album_art(image_url):
         print(f"Error processing image: {e}")
         album_cover_label.config(image=placeholder_photo)
 
-
-def polling_loop():
-    """Periodically checks for the current song and updates the UI."""
+def show_song(song, artist):
+    """Shows a newly detected song while its details load; returns False if it is already shown."""
     global currently_displayed_song
+    if (song, artist) == currently_displayed_song:
+        return False
+    print(f"New song detected: {song}")
+    currently_displayed_song = (song, artist)
     
+    # Update text immediately to show we're working
+    commentary_text.set(f"▶ Now Playing: {song} - {artist}\n\nFetching details...")
+    album_cover_label.config(image=placeholder_photo) # Show placeholder while loading
+    return True
+
+def show_details(name, artist, album, release_year, cover_future):
+    """Shows the details of the song on screen, and its cover once cover_future (if any) resolves."""
+    commentary = (
+        f"Song: {name}\n"
+        f"Artist(s): {artist}\n"
+        f"Album: {album or 'Unknown'}\n"
+        f"Released: {release_year or 'an unknown year'}"
+    )
+    commentary_text.set(commentary)
+    if cover_future is not None:
+        cover_future.add_done_callback(lambda f, s=currently_displayed_song: update_album_art(f, s))
+
+def show_nothing(message):
+    global currently_displayed_song
+    if currently_displayed_song is not None or "Welcome" in commentary_text.get():
+        currently_displayed_song = None
+        commentary_text.set(message or "Waiting for a song to play...")
+        album_cover_label.config(image=placeholder_photo)
+
+def show_daemon_song(data):
+    """
+    Renders a 'song' message from the music daemon on the Tk thread. The daemon already
+    resolved album, year and cover URL, so only the cover itself is downloaded here.
+    """
+    # Daemons from before title/artist were published only send "title - artist" as song.
+    song = data.get("title") or data.get("song")
+    if not song:
+        show_nothing(None)
+        return
+    artist = data.get("artist") or ""
+    if not show_song(song, artist):
+        return # A heartbeat for the song on screen
+    art_url = data.get("art_url")
+    cover_future = None
+    if art_url:
+        cover_url = album_art.sized_url(art_url, netease_client.COVER_SIZE)
+        cover_future = cover_executor.submit(netease_client.download_cover, cover_url)
+    show_details(song, artist, data.get("album"), data.get("year"), cover_future)
+
+def follow_daemon():
+    """Runs in a thread: renders the daemon's detections as they arrive, then falls back to our own."""
+    def on_message(message):
+        if message["type"] == "song":
+            root.after(0, show_daemon_song, message["data"])
+    try:
+        asyncio.run(music_daemon.follow(on_message))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Daemon connection failed: {e}")
+    polling_loop() # Back to detecting the song ourselves
+
+def polling_loop():
+    """Without a music daemon: periodically checks for the current song and updates the UI."""
     while True:
         song_info, error_message = netease_client.get_current_netease_song()
         
         if song_info:
             song, artist = song_info
             
-            if song != currently_displayed_song:
-                print(f"New song detected: {song}")
-                currently_displayed_song = song
-                
-                # Update text immediately to show we're working
-                commentary_text.set(f"▶ Now Playing: {song} - {artist}\n\nFetching details...")
-                album_cover_label.config(image=placeholder_photo) # Show placeholder while loading
-
+            if show_song(song, artist):
                 # Get detailed track info (now returns a dictionary)
                 track_details, detail_error = netease_client.get_track_info(song, artist)
                 
                 if track_details:
-                    # Format the commentary string
-                    commentary = (
-                        f"Song: {track_details['name']}\n"
-                        f"Artist(s): {track_details['artist']}\n"
-                        f"Album: {track_details['album']}\n"
-                        f"Released: {track_details['release_year']}"
-                    )
-                    commentary_text.set(commentary)
-                    
-                    # Update album art in a separate thread to not block the UI
-                    threading.Thread(target=update_album_art, args=(track_details['cover_url'],), daemon=True).start()
+                    print(f"Track info timings (ms): {track_details['timings']}")
+                    # The cover has been downloading since the search returned; show it when it's done
+                    show_details(track_details['name'], track_details['artist'], track_details['album'],
+                                 track_details['release_year'], track_details['cover_future'])
                 else:
                     commentary_text.set(detail_error)
 
         else:
-            if currently_displayed_song is not None or "Welcome" in commentary_text.get():
-                currently_displayed_song = None
-                commentary_text.set(error_message or "Waiting for a song to play...")
-                album_cover_label.config(image=placeholder_photo)
+            show_nothing(error_message)
 
         time.sleep(5)
 
@@ -118,9 +166,12 @@ commentary_label = tk.Label(
 commentary_label.pack(fill=tk.BOTH, expand=True)
 commentary_text.set("Welcome to MusicFriend! Initializing...")
 
-# --- Start Background Thread ---
-polling_thread = threading.Thread(target=polling_loop, daemon=True)
-polling_thread.start()
+# --- Start Background Threads ---
+# A running music daemon already detects the song and looks it up; we only render its messages.
+if music_daemon.daemon_running():
+    threading.Thread(target=follow_daemon, daemon=True).start()
+else:
+    threading.Thread(target=polling_loop, daemon=True).start()
 
 netease_client.initialize_netease()
 
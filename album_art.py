@@ -0,0 +1,77 @@
+import re
+from urllib.parse import urlsplit, urlunsplit
+
+# --- Album art sizing ---
+# Seats show covers at 80x80, but the platforms hand out full-size (640px+) images.
+# Each provider knows how to get a variant close to the size we actually display.
+SEAT_ART_SIZE = 80
+
+class ArtProvider:
+    """Base provider: leaves URLs untouched."""
+    def matches(self, url):
+        return False
+    def sized_url(self, url, size):
+        return url
+
+class NetEaseArtProvider(ArtProvider):
+    """NetEase's image CDN renders thumbnails on request via ?param=WxH (written WyH)."""
+    HOST_SUFFIX = "music.126.net"
+
+    def matches(self, url):
+        return (urlsplit(url).hostname or "").endswith(self.HOST_SUFFIX)
+
+    def sized_url(self, url, size):
+        parts = urlsplit(url)
+        query = f"param={size}y{size}"
+        return urlunsplit((parts.scheme, parts.netloc, parts.path, query, ""))
+
+class SpotifyArtProvider(ArtProvider):
+    """
+    Spotify can't resize a given URL; every size has its own URL in the album's `images` list.
+    Use pick_image() when the list is available (i.e. in the detector).
+    """
+    HOST_SUFFIX = "scdn.co"
+    # A slightly smaller image upscaled by <= 4/3 still looks fine and is far cheaper.
+    MIN_SCALE = 0.75
+
+    def matches(self, url):
+        return (urlsplit(url).hostname or "").endswith(self.HOST_SUFFIX)
+
+    @classmethod
+    def pick_image(cls, images, size):
+        """
+        Returns the URL of the smallest entry that is at least MIN_SCALE * size pixels wide,
+        or of the largest entry if none is big enough.
+        """
+        candidates = sorted((img for img in images if img.get("url")), key=lambda img: img.get("width") or 0)
+        if not candidates:
+            return None
+        for img in candidates:
+            if (img.get("width") or 0) >= size * cls.MIN_SCALE:
+                return img["url"]
+        return candidates[-1]["url"]
+
+class ArtProxyProvider(ArtProvider):
+    """Our own server's /art/<key> thumbnails (see art_proxy.py) take the size as ?s=N."""
+    PATH = re.compile(r"^/art/[0-9a-f]{24}$")
+
+    def matches(self, url):
+        return bool(self.PATH.match(urlsplit(url).path))
+
+    def sized_url(self, url, size):
+        parts = urlsplit(url)
+        return urlunsplit((parts.scheme, parts.netloc, parts.path, f"s={size}", ""))
+
+PROVIDERS = [ArtProxyProvider(), NetEaseArtProvider(), SpotifyArtProvider()]
+
+def sized_url(url, size=SEAT_ART_SIZE):
+    """Returns a URL for a variant of `url` close to `size` pixels, if the provider supports it."""
+    if not url:
+        return url
+    for provider in PROVIDERS:
+        if provider.matches(url):
+            return provider.sized_url(url, size)
+    return url
+
+def pick_spotify_image(images, size=SEAT_ART_SIZE):
+    return SpotifyArtProvider.pick_image(images, size)
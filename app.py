@@ -1,71 +1,520 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, g, Response
 from flask_cors import CORS
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, ConnectionRefusedError, emit, join_room
+from eventlet import tpool
+from eventlet.event import Event
+from eventlet.semaphore import Semaphore
+from eventlet.timeout import Timeout
+import art_proxy
+import atexit
+import hmac
+import os
 import time
+import rate_limit
+import room_cluster
+import room_service
+import room_snapshot
+import sampling_profiler
+import traffic_trace
 
 app = Flask(__name__)
 CORS(app)
 # Re-initialize SocketIO, using eventlet for production
 socketio = SocketIO(app, async_mode='eventlet', cors_allowed_origins="*")
 
-# --- In-memory "database" for song state (unchanged) ---
-room_state = {}
-INACTIVE_THRESHOLD = 30 
+# --- In-memory "database" for song state ---
+# The state itself lives in room_service.RoomService, shared with the asyncio server mode
+# (asgi_app.py). This module adapts it to Flask + eventlet: routes, green-thread waits, tpool.
+DEFAULT_ROOM = room_service.DEFAULT_ROOM
+LONG_POLL_MAX_WAIT = room_service.LONG_POLL_MAX_WAIT
+# room -> [Event shared by every request waiting on that room, how many are waiting]. An entry
+# leaves with a wake-up or with the last waiter, so it never outlives the requests using it.
+room_waiters = {}
+
+def wake_waiters(name, version):
+    """Wakes all long-poll waiters of a room with one notification."""
+    waiters = room_waiters.pop(name, None)
+    if waiters is not None:
+        waiters[0].send(version)
+
+def announce_shared(payload):
+    socketio.emit('now_shared', payload)
+
+service = room_service.RoomService(on_change=wake_waiters, on_shared=announce_shared)
+rooms = service.rooms
+room_state = rooms[DEFAULT_ROOM]
+art_cache = service.art_cache
+
+def wait_for_change(name, since, timeout):
+    """Cooperatively blocks (green thread, not OS thread) until the room leaves version `since`."""
+    if service.version(name) != since:
+        return
+    waiters = room_waiters.get(name)
+    if waiters is None:
+        waiters = room_waiters[name] = [Event(), 0]
+    waiters[1] += 1
+    try:
+        with Timeout(timeout, False):
+            waiters[0].wait()
+    finally:
+        waiters[1] -= 1
+        if waiters[1] == 0 and room_waiters.get(name) is waiters:
+            del room_waiters[name]
+
+def waiter_counts():
+    """Long-poll bookkeeping for /admin/memory."""
+    return {"long_poll_rooms": len(room_waiters), "long_poll_waiters": sum(count for _, count in room_waiters.values())}
+
+# --- Snapshot / warm restore across restarts ---
+def save_snapshot(blocking=False):
+    snapshot = service.build_snapshot()
+    if blocking:
+        service.save_snapshot(room_service.SNAPSHOT_PATH, snapshot)
+    else:
+        # File I/O runs on eventlet's native thread pool so the hub keeps serving requests.
+        tpool.execute(service.save_snapshot, room_service.SNAPSHOT_PATH, snapshot)
+
+def snapshot_loop():
+    while True:
+        socketio.sleep(room_service.SNAPSHOT_INTERVAL)
+        save_snapshot()
+
+if room_service.SNAPSHOT_INTERVAL > 0:
+    service.restore_snapshot(room_snapshot.read_snapshot(room_service.SNAPSHOT_PATH))
+    socketio.start_background_task(snapshot_loop)
+    atexit.register(save_snapshot, blocking=True)
+
+# --- Reclaiming expired users of rooms nobody polls (see room_service caps) ---
+def reclaim_loop():
+    while True:
+        socketio.sleep(room_service.RECLAIM_INTERVAL)
+        service.reclaim()
+
+if room_service.RECLAIM_INTERVAL > 0:
+    socketio.start_background_task(reclaim_loop)
+
+# --- Traffic trace recording (opt-in via TRACE_PATH, see traffic_trace.py) ---
+trace = traffic_trace.recorder_from_env()
+
+def trace_loop():
+    while True:
+        socketio.sleep(traffic_trace.TRACE_FLUSH_INTERVAL)
+        tpool.execute(trace.flush)
+
+if trace is not None:
+    socketio.start_background_task(trace_loop)
+    atexit.register(trace.flush)
+
+# --- Album art proxy (optional, needs Pillow) ---
+art_fetches = {}  # key -> Event, so concurrent requests for a new cover share one fetch
+
+def fetch_art(key, url):
+    """Fetches and resizes a cover once; concurrent callers wait for the same result."""
+    pending = art_fetches.get(key)
+    if pending is not None:
+        return pending.wait()
+    pending = art_fetches[key] = Event()
+    ok = False
+    try:
+        # Download and resize on eventlet's native thread pool; both would block the hub.
+        thumbnails = tpool.execute(lambda: art_proxy.make_thumbnails(art_proxy.fetch_image(url)))
+        # The disk writes go to the pool too; only the cache's bookkeeping runs on the hub.
+        written = tpool.execute(art_cache.write, key, thumbnails)
+        tpool.execute(art_cache.remove_files, art_cache.add(key, written))
+        ok = True
+    except Exception as e:
+        print(f"Art proxy: Could not fetch '{url}': {e}")
+    finally:
+        del art_fetches[key]
+        pending.send(ok)
+    return ok
+
+# --- Admin-gated profiling (see sampling_profiler.py) ---
+# The /admin routes only exist when ADMIN_TOKEN is set; callers send it as X-Admin-Token.
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+profiler = sampling_profiler.SamplingProfiler()
+
+def admin_denied():
+    """Returns an error response unless the request carries the admin token."""
+    if not ADMIN_TOKEN:
+        return jsonify({"status": "error", "message": "Not found"}), 404
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return jsonify({"status": "error", "message": "Forbidden"}), 403
+    return None
+
+# --- Rooms partitioned across nodes (opt-in via CLUSTER_NODES/CLUSTER_SELF, see room_cluster.py) ---
+cluster = room_cluster.cluster_from_env()
+rebalance_lock = Semaphore()
+
+def moved_response(name):
+    """A 307 to the node that owns room `name`, or None when it is this one."""
+    node = cluster.owner_elsewhere(name)
+    if node is None:
+        return None
+    response = jsonify({"status": "error", "message": "Room lives on another node", "node": node})
+    response.status_code = 307
+    response.headers['Location'] = node + (request.full_path if request.query_string else request.path)
+    response.headers['X-Room-Node'] = node
+    return response
+
+def rebalance():
+    """Hands the rooms this node no longer owns to their owners, then forgets them."""
+    with rebalance_lock:
+        cluster.rebalance_pending = False
+        for node, names in cluster.moved_rooms(service.room_names()).items():
+            handoff = service.export_rooms(names)
+            # Requests for these rooms are redirected already, so they can't change meanwhile.
+            if any(handoff.values()) and not tpool.execute(room_cluster.send_handoff, node, handoff, ADMIN_TOKEN):
+                cluster.failed_handoffs += 1
+                cluster.rebalance_pending = True
+                continue
+            service.drop_rooms(names)
+            cluster.handed_off_rooms += len(names)
+
+def cluster_loop():
+    while True:
+        socketio.sleep(room_cluster.REBALANCE_INTERVAL)
+        if cluster.rebalance_pending:
+            rebalance()
+
+if cluster.self_url:
+    socketio.start_background_task(cluster_loop)
+
+@app.before_request
+def profile_request():
+    if profiler.active:
+        g.profile = profiler.begin(f"{request.method} {request.path}")
+
+@app.teardown_request
+def finish_profile(exc):
+    profiler.end(g.pop('profile', None))
+
+def client_ip():
+    # Render sits behind a proxy; see rate_limit.client_address for which hop is trusted.
+    return rate_limit.client_address(request.headers.get('X-Forwarded-For'), request.remote_addr)
 
 # --- HTTP Routes for Song Polling (unchanged) ---
 @app.route('/')
 def index():
-    return render_template('index.html')
-
-def cleanup_inactive_users():
-    global room_state
-    current_time = time.time()
-    inactive_users = [
-        user for user, data in room_state.items() 
-        if current_time - data.get("timestamp", 0) > INACTIVE_THRESHOLD
-    ]
-    for user in inactive_users:
-        del room_state[user]
+    """The room page, with the room (?room=, default room otherwise) inlined so it draws at once."""
+    name = room_service.room_name(request.args.get('room'))
+    moved = moved_response(name)
+    if moved:
+        return moved
+    service.cleanup_inactive_users(name)
+    return render_template('index.html', initial_state=service.initial_state(name))
 
 @app.route('/update_state', methods=['POST'])
 def update_state():
-    global room_state
-    data = request.get_json()
-    if not data or 'user' not in data:
-        return jsonify({"status": "error", "message": "Invalid data"}), 400
-    
+    now = time.time()
+    data = request.get_json(silent=True)
+    message = room_service.update_error(data)
+    if message:
+        return jsonify({"status": "error", "message": message}), 400
+    name = room_service.room_name(data.get('room'))
+    moved = moved_response(name)
+    if moved:
+        return moved
+    if trace is not None:
+        trace.update(data)
+
     user = data.get('user')
-    room_state[user] = {
-        "song": data.get("song", ""),
-        "platform": data.get("platform", "unknown"),
-        "art_url": data.get("art_url"),
-        "timestamp": time.time()
-    }
-    return jsonify({"status": "success"})
+    allowed, retry_after = service.admit_update(user, client_ip())
+    if not allowed:
+        response = jsonify({"status": "error", "message": "Too many updates, slow down"})
+        response.headers['Retry-After'] = rate_limit.retry_after_header(retry_after)
+        return response, 429
+
+    service.update(name, user, data, service.proxied_art_url(data.get("art_url"), request.url_root), now)
+    # received_at/server_time double as t1/t2 of a clock offset exchange for HTTP-only clients.
+    return jsonify({"status": "success", "received_at": now, "server_time": time.time()})
+
+@app.route('/update_state/batch', methods=['POST'])
+def update_state_batch():
+    """
+    Bulk /update_state for relays reporting many users: the body is a JSON array of the same
+    objects /update_state takes. They are applied together and the response has one result
+    per item, in order.
+    """
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or len(items) > room_service.MAX_BATCH_SIZE:
+        return jsonify({"status": "error", "message": f"Expected a JSON array of at most {room_service.MAX_BATCH_SIZE} updates"}), 400
+    if trace is not None:
+        trace.batch(items)
+    allowed, retry_after = service.admit_batch(client_ip())
+    if not allowed:
+        response = jsonify({"status": "error", "message": "Too many updates, slow down"})
+        response.headers['Retry-After'] = rate_limit.retry_after_header(retry_after)
+        return response, 429
+    now = time.time()
+    url_root = request.url_root
+    results = service.update_batch(items, lambda url: service.proxied_art_url(url, url_root), now, cluster.owner_elsewhere)
+    return jsonify({"status": "success", "results": results, "received_at": now, "server_time": time.time()})
 
 @app.route('/get_state', methods=['GET'])
 def get_state():
-    cleanup_inactive_users()
-    return jsonify(room_state)
+    """
+    Returns the room. The room's version is sent in the X-Room-Version header.
+    Long-poll: /get_state?since=<version>&wait=<seconds> holds the request until the
+    version differs from `since` or the wait expires, whichever comes first.
+    Pages: /get_state?limit=50&after=<next>&fields=user,song returns
+    {"users": [...], "next": ..., "total": ...} in user order instead of the whole room.
+    Deltas: with since=<version>&delta=1 the answer is {"full", "users", "removed"}: only the
+    users that changed after `since` and the ones that left, or the whole room when "full".
+    """
+    name = room_service.room_name(request.args.get('room'))
+    paged = any(key in request.args for key in ('limit', 'after', 'fields'))
+    try:
+        limit, fields = room_service.page_args(request.args.get('limit', type=int), request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    moved = moved_response(name)
+    if moved:
+        return moved
+    service.cleanup_inactive_users(name)
+    since = request.args.get('since', type=int)
+    wait = min(request.args.get('wait', 0, type=float), LONG_POLL_MAX_WAIT)
+    if trace is not None:
+        trace.get(name, since, wait)
+    if since is not None and wait > 0:
+        wait_for_change(name, since, wait)
+        moved = moved_response(name)  # handed off while waiting
+        if moved:
+            return moved
+        service.cleanup_inactive_users(name)
+    if paged:
+        response = jsonify(service.page(name, limit, request.args.get('after'), fields))
+    elif request.args.get('delta') == '1':
+        response = jsonify(service.delta(name, since))
+    else:
+        response = jsonify(service.view(name))
+    response.headers['X-Room-Version'] = str(service.version(name))
+    return response
+
+@app.route('/latency', methods=['POST'])
+def report_latency():
+    """
+    Clients report when traced track changes of others reached them and were drawn:
+    {"reports": [{"trace_id", "delivered_at", "rendered_at"}]}, both in server time.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('reports'), list):
+        return jsonify({"status": "error", "message": "Invalid data"}), 400
+    allowed, retry_after = service.admit_batch(client_ip())
+    if not allowed:
+        response = jsonify({"status": "error", "message": "Too many reports, slow down"})
+        response.headers['Retry-After'] = rate_limit.retry_after_header(retry_after)
+        return response, 429
+    return jsonify({"status": "success", "accepted": service.report_latency(data['reports'])})
+
+@app.route('/same_song', methods=['GET'])
+def same_song_listeners():
+    """Who else in the room plays the same track as `user` (or as `song`), e.g. /same_song?user=rex"""
+    name = room_service.room_name(request.args.get('room'))
+    moved = moved_response(name)
+    if moved:
+        return moved
+    return jsonify(service.same_song_listeners(name, request.args.get('user'), request.args.get('song')))
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Top-k tracks, artists and listeners by listening time for a room, e.g. /stats?room=default&window=24h&k=10"""
+    name = room_service.room_name(request.args.get('room'))
+    moved = moved_response(name)
+    if moved:
+        return moved
+    window = request.args.get('window', '24h')
+    if window not in room_service.STATS_WINDOWS:
+        return jsonify({"status": "error", "message": f"Unknown window, use one of {list(room_service.STATS_WINDOWS)}"}), 400
+    k = room_service.stats_k(request.args.get('k', type=int))
+    return jsonify(service.stats(name, window, k))
+
+@app.route('/art/<key>', methods=['GET'])
+def art(key):
+    """Serves a resized cover, e.g. /art/<key>?s=80 (sizes snap to art_proxy.STANDARD_SIZES)."""
+    if art_cache is None:
+        return jsonify({"status": "error", "message": "Art proxy is disabled"}), 404
+    size = art_proxy.snap_size(request.args.get('s', art_proxy.STANDARD_SIZES[0], type=int))
+    path = art_cache.lookup(key, size)
+    data = None if path is None else tpool.execute(art_cache.read, path)
+    if data is None:
+        url = art_cache.origin(key)
+        if url is None:
+            return jsonify({"status": "error", "message": "Unknown cover"}), 404
+        if not fetch_art(key, url):
+            return jsonify({"status": "error", "message": "Could not fetch cover"}), 502
+        path = art_cache.lookup(key, size)
+        data = None if path is None else tpool.execute(art_cache.read, path)
+        if data is None:
+            # Evicted again by a concurrent store() before it could be read.
+            return jsonify({"status": "error", "message": "Could not fetch cover"}), 502
+    # The key is derived from the origin URL, so the content never changes.
+    response = Response(data, mimetype='image/jpeg')
+    response.headers['Cache-Control'] = f"public, max-age={room_service.ART_MAX_AGE}, immutable"
+    response.set_etag(f"{key}_{size}")
+    return response.make_conditional(request)
+
+@app.route('/admin/profile', methods=['GET', 'POST', 'DELETE'])
+def admin_profile():
+    """
+    POST starts a sampling window: ?seconds=30&interval_ms=10&slow_ms=500 (requests slower than
+    slow_ms keep their own profile). DELETE stops it. GET returns the window's folded stacks
+    (feed them to flamegraph.pl or speedscope), or its status with ?format=json.
+    """
+    denied = admin_denied()
+    if denied:
+        return denied
+    if request.method == 'POST':
+        profiler.start(request.args.get('seconds', 30, type=float),
+                       request.args.get('interval_ms', sampling_profiler.DEFAULT_INTERVAL * 1000, type=float) / 1000,
+                       request.args.get('slow_ms', sampling_profiler.DEFAULT_SLOW_THRESHOLD * 1000, type=float) / 1000)
+    elif request.method == 'DELETE':
+        profiler.stop()
+    if request.method == 'GET' and request.args.get('format') != 'json':
+        return Response(profiler.folded(), mimetype='text/plain')
+    return jsonify(profiler.status())
+
+@app.route('/admin/profile/slow', methods=['GET'])
+def admin_slow_requests():
+    """Captured slow requests, newest last; /admin/profile/slow?index=N returns one as folded stacks."""
+    denied = admin_denied()
+    if denied:
+        return denied
+    captures = list(profiler.slow)
+    index = request.args.get('index', type=int)
+    if index is None:
+        return jsonify([{k: v for k, v in capture.items() if k != 'folded'} for capture in captures])
+    if not -len(captures) <= index < len(captures):
+        return jsonify({"status": "error", "message": "No such capture"}), 404
+    return Response(captures[index]['folded'], mimetype='text/plain')
+
+@app.route('/admin/latency', methods=['GET', 'DELETE'])
+def admin_latency():
+    """Per-stage and total latency histograms of traced track changes; DELETE starts over."""
+    denied = admin_denied()
+    if denied:
+        return denied
+    if request.method == 'DELETE':
+        service.latency.reset()
+    return jsonify(service.latency.summary())
+
+@app.route('/admin/memory', methods=['GET'])
+def admin_memory():
+    """Room/user/connection counts against their caps, evictions and approximate sizes."""
+    denied = admin_denied()
+    if denied:
+        return denied
+    return jsonify(dict(service.memory(), **waiter_counts()))
+
+@app.route('/cluster', methods=['GET'])
+def cluster_info():
+    """The cluster's nodes; /cluster?room=<name> also says which node owns that room."""
+    info = {"self": cluster.self_url, "nodes": cluster.ring.nodes}
+    if 'room' in request.args:
+        name = room_service.room_name(request.args.get('room'))
+        info.update(room=name, node=cluster.owner(name))
+    return jsonify(info)
+
+@app.route('/admin/cluster', methods=['GET', 'PUT'])
+def admin_cluster():
+    """PUT {"nodes": [url, ...]} (sent to every node) changes membership and hands rooms over."""
+    denied = admin_denied()
+    if denied:
+        return denied
+    if request.method == 'PUT':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get('nodes'), list):
+            return jsonify({"status": "error", "message": "Expected {\"nodes\": [url, ...]}"}), 400
+        if not cluster.self_url:
+            return jsonify({"status": "error", "message": "This node was started without CLUSTER_SELF"}), 400
+        cluster.set_nodes(data['nodes'])
+        rebalance()
+    return jsonify(cluster.status())
+
+@app.route('/admin/cluster/handoff', methods=['POST'])
+def admin_cluster_handoff():
+    """Rooms another node hands over, as RoomService.export_rooms() made them."""
+    denied = admin_denied()
+    if denied:
+        return denied
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('rooms'), dict):
+        return jsonify({"status": "error", "message": "Invalid data"}), 400
+    users = service.adopt_rooms(data)
+    names = room_service.handoff_rooms(data)
+    cluster.adopted_rooms += len(names)
+    if cluster.moved_rooms(names):
+        cluster.rebalance_pending = True  # sent here under an older membership; pass them on
+    return jsonify({"status": "success", "rooms": len(names), "users": users})
 
 # --- NEW: WebSocket Handlers for Live Chat ---
 @socketio.on('connect')
 def handle_connect():
+    # A connection belongs to a room (?room=, the default room otherwise); its owner serves it.
+    room = room_service.room_name(request.args.get('room'))
+    node = cluster.owner_elsewhere(room)
+    if node is not None:
+        raise ConnectionRefusedError({"message": "Room lives on another node", "node": node})
+    if not service.admit_connection():
+        return False  # At MAX_CONNECTIONS; Flask-SocketIO refuses the connection
     print('Chat client connected')
+    if trace is not None:
+        trace.connect(request.sid, client_ip())
+    # Chat is per room: the connection joins its Socket.IO room and gets that room's recent
+    # chat replayed, so a reconnect after a redeploy doesn't show an empty chat.
+    join_room(room)
+    messages = service.chat_history(room)
+    if messages:
+        emit('chat_history', messages)
 
 @socketio.on('disconnect')
 def handle_disconnect():
+    service.connection_closed()
     print('Chat client disconnected')
+    if trace is not None:
+        trace.disconnect(request.sid)
+
+@socketio.on('clock_sync')
+@profiler.track('socket clock_sync')
+def handle_clock_sync(data):
+    """
+    One NTP-style exchange: the client emits {'t0': <its clock>} with an ack callback
+    and gets back t1/t2 in server time, then computes offset and round trip itself.
+    """
+    t1 = time.time()
+    if trace is not None:
+        trace.clock_sync(request.sid)
+    t0 = data.get('t0') if isinstance(data, dict) else None
+    return {"t0": t0, "t1": t1, "t2": time.time()}
 
 @socketio.on('send_message')
+@profiler.track('socket send_message')
 def handle_send_message(data):
     """
-    Receives a message from a client and broadcasts it to all clients.
+    Receives a message from a client and broadcasts it to the clients in its room.
     'data' is expected to be a dictionary, e.g., {'user': 'rex', 'message': 'Hello!'}
     """
-    print(f"Received message from {data.get('user')}: {data.get('message')}")
-    # Broadcast the message to all connected clients, including the sender.
-    emit('new_message', data, broadcast=True)
+    if not isinstance(data, dict):
+        return
+    room = room_service.room_name(request.args.get('room'))
+    node = cluster.owner_elsewhere(room)
+    if node is not None:
+        # The room moved since this client connected; it reconnects to the new owner.
+        emit('room_moved', {"room": room, "node": node})
+        return
+    allowed, retry_after = service.admit_message(data.get('user'), client_ip())
+    if not allowed:
+        # Only the sender hears about it; the message is dropped.
+        emit('rate_limited', {"event": "send_message", "retry_after": round(retry_after, 2)})
+        return
+    if trace is not None:
+        trace.message(request.sid, data)
+    message = service.add_message(room, data)
+    if message is None:
+        return
+    print(f"Received message from {message['user']}: {message['message']}")
+    # Broadcast the message to everyone in the room, including the sender.
+    emit('new_message', message, to=room)
 
 if __name__ == '__main__':
     # Use socketio.run() for local testing with WebSocket support
@@ -0,0 +1,187 @@
+import hashlib
+import io
+import os
+from collections import OrderedDict
+from urllib.error import HTTPError
+from urllib.parse import urlsplit
+from urllib.request import HTTPRedirectHandler, Request, build_opener
+
+# Pillow is optional on the server: without it the art proxy simply stays off.
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# --- Server-side album art thumbnails ---
+# Each cover is fetched from its CDN once, resized to every standard seat size, and the
+# results are kept in a bounded on-disk cache. Clients then all download the same small file.
+STANDARD_SIZES = (80, 160, 200)
+MAX_ORIGIN_BYTES = 5 * 1024 * 1024
+FETCH_TIMEOUT = 10
+# Only covers on the platforms' image CDNs (the hosts album_art.py knows) are fetched, and
+# redirects are only followed between them, so a reported art_url can't make the server
+# request internal or metadata addresses. "*.host" matches subdomains of host. Other URLs
+# reach clients untouched, as without the proxy.
+ORIGIN_HOSTS = tuple(host.strip().lower() for host in
+                     os.environ.get("ART_ORIGIN_HOSTS", "*.music.126.net,i.scdn.co").split(",") if host.strip())
+
+def available():
+    return Image is not None
+
+def art_key(url):
+    """Stable, URL-safe id for an origin image URL."""
+    return hashlib.sha1(url.encode("utf-8")).hexdigest()[:24]
+
+def snap_size(size):
+    """Rounds a requested size up to the nearest standard size (or the largest one)."""
+    for standard in STANDARD_SIZES:
+        if size <= standard:
+            return standard
+    return STANDARD_SIZES[-1]
+
+def allowed_origin(url, hosts=ORIGIN_HOSTS):
+    """True for an http(s) URL on one of the art CDN hosts."""
+    if not isinstance(url, str):
+        return False
+    try:
+        parts = urlsplit(url)
+        host = (parts.hostname or "").lower()
+    except ValueError:
+        return False
+    if parts.scheme not in ("http", "https") or not host:
+        return False
+    return any(host.endswith(pattern[1:]) if pattern.startswith("*.") else host == pattern for pattern in hosts)
+
+class _OriginRedirects(HTTPRedirectHandler):
+    """Follows a redirect only when it stays on the allowed hosts."""
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if not allowed_origin(newurl, self.hosts):
+            raise HTTPError(newurl, code, f"Refusing redirect off the art hosts: {newurl}", headers, fp)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+def fetch_image(url, hosts=ORIGIN_HOSTS):
+    """Downloads an origin image (art CDN hosts only, size-capped). Blocking."""
+    if not allowed_origin(url, hosts):
+        raise ValueError(f"Refusing to fetch a URL off the art hosts: {url}")
+    request = Request(url, headers={"User-Agent": "ListeningTogether-ArtProxy"})
+    with build_opener(_OriginRedirects(hosts)).open(request, timeout=FETCH_TIMEOUT) as response:
+        data = response.read(MAX_ORIGIN_BYTES + 1)
+    if len(data) > MAX_ORIGIN_BYTES:
+        raise ValueError(f"Origin image too large: {url}")
+    return data
+
+def make_thumbnails(data, sizes=STANDARD_SIZES):
+    """Returns {size: jpeg bytes} with the image resized once per standard size. Blocking."""
+    image = Image.open(io.BytesIO(data))
+    image = image.convert("RGB")
+    thumbnails = {}
+    # Resize from the largest size down, so each step works on an already small image.
+    for size in sorted(sizes, reverse=True):
+        image.thumbnail((size, size), Image.LANCZOS)
+        out = io.BytesIO()
+        image.save(out, format="JPEG", quality=85, optimize=True)
+        thumbnails[size] = out.getvalue()
+    return thumbnails
+
+class ThumbnailCache:
+    """
+    Bounded on-disk cache of resized covers, evicting the least recently used cover
+    once the total size exceeds max_bytes. Also remembers which origin URL belongs to
+    each key, so /art/<key> can only serve covers that were actually reported.
+    """
+
+    def __init__(self, directory, max_bytes, max_origins=10000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_origins = max_origins
+        self.total_bytes = 0
+        self._entries = OrderedDict()  # key -> bytes on disk for all its sizes
+        self._origins = OrderedDict()  # key -> origin url
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def register(self, url):
+        key = art_key(url)
+        self._origins[key] = url
+        self._origins.move_to_end(key)
+        if len(self._origins) > self.max_origins:
+            self._origins.popitem(last=False)
+        return key
+
+    def origin(self, key):
+        return self._origins.get(key)
+
+    def path(self, key, size):
+        return os.path.join(self.directory, f"{key}_{size}.jpg")
+
+    def lookup(self, key, size):
+        """Returns the cached file for key/size, or None."""
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self.path(key, size)
+
+    @staticmethod
+    def read(path):
+        """
+        Returns the bytes of a file from lookup(), or None if it was evicted in the meantime. Blocking.
+        Servers send these bytes rather than the path: a store() for another cover can delete
+        the file between lookup() and the moment a file response would open it.
+        """
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def store(self, key, thumbnails):
+        """Writes all sizes of one cover and evicts old covers if needed (blocking)."""
+        self.remove_files(self.add(key, self.write(key, thumbnails)))
+
+    # store() in steps, for servers that keep disk I/O off their event loop: write() and
+    # remove_files() only touch files, add() only the in-memory bookkeeping.
+    def write(self, key, thumbnails):
+        """Writes all sizes of one cover to disk and returns the bytes written. Blocking."""
+        written = 0
+        for size, data in thumbnails.items():
+            tmp_path = self.path(key, size) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(key, size))
+            written += len(data)
+        return written
+
+    def add(self, key, written):
+        """Accounts for a written cover; returns the keys evicted to stay under max_bytes."""
+        self.total_bytes += written - self._entries.pop(key, 0)
+        self._entries[key] = written
+        evicted = []
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            old_key, old_bytes = self._entries.popitem(last=False)
+            self.total_bytes -= old_bytes
+            evicted.append(old_key)
+        return evicted
+
+    def remove_files(self, keys):
+        """Deletes the files of evicted covers. Blocking."""
+        for key in keys:
+            for size in STANDARD_SIZES:
+                try:
+                    os.remove(self.path(key, size))
+                except OSError:
+                    # Already gone, or (on Windows) still open in read(); a restart's scan picks up leftovers.
+                    pass
+
+    def _scan(self):
+        # Pick up covers from a previous run so a restart doesn't refetch everything.
+        for name in sorted(os.listdir(self.directory), key=lambda n: os.path.getmtime(os.path.join(self.directory, n))):
+            if not name.endswith(".jpg") or "_" not in name:
+                continue
+            key = name.rsplit("_", 1)[0]
+            size = os.path.getsize(os.path.join(self.directory, name))
+            self._entries[key] = self._entries.get(key, 0) + size
+            self.total_bytes += size
@@ -0,0 +1,562 @@
+import asyncio
+import contextlib
+import hmac
+import os
+import time
+import urllib.parse
+
+import aiohttp
+import socketio
+from jinja2 import Environment, FileSystemLoader
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import HTMLResponse, JSONResponse, Response
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+
+import art_proxy
+import rate_limit
+import room_cluster
+import room_service
+import room_snapshot
+import spotify_farm
+import traffic_trace
+
+# --- asyncio server mode ---
+# The same routes and Socket.IO events as app.py, on python-socketio's AsyncServer and
+# Starlette under uvicorn instead of Flask + eventlet. Room state comes from the same
+# room_service.RoomService; only waiting and blocking I/O are done the asyncio way.
+# Run with: uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins="*")
+
+# --- In-memory "database" for song state ---
+DEFAULT_ROOM = room_service.DEFAULT_ROOM
+room_waiters = {}  # room -> [asyncio.Event, how many are waiting], as in app.py
+
+def wake_waiters(name, version):
+    """Wakes all long-poll waiters of a room with one notification."""
+    waiters = room_waiters.pop(name, None)
+    if waiters is not None:
+        waiters[0].set()
+
+def announce_shared(payload):
+    sio.start_background_task(sio.emit, 'now_shared', payload)
+
+service = room_service.RoomService(on_change=wake_waiters, on_shared=announce_shared)
+art_cache = service.art_cache
+
+async def wait_for_change(name, since, timeout):
+    """Suspends the request (not a thread) until the room leaves version `since`."""
+    if service.version(name) != since:
+        return
+    waiters = room_waiters.get(name)
+    if waiters is None:
+        waiters = room_waiters[name] = [asyncio.Event(), 0]
+    waiters[1] += 1
+    try:
+        await asyncio.wait_for(waiters[0].wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        waiters[1] -= 1
+        if waiters[1] == 0 and room_waiters.get(name) is waiters:
+            del room_waiters[name]
+
+def waiter_counts():
+    """Long-poll bookkeeping for /admin/memory."""
+    return {"long_poll_rooms": len(room_waiters), "long_poll_waiters": sum(count for _, count in room_waiters.values())}
+
+# --- Snapshot / warm restore across restarts ---
+async def snapshot_loop():
+    while True:
+        await asyncio.sleep(room_service.SNAPSHOT_INTERVAL)
+        # File I/O runs on the default thread pool so the loop keeps serving requests.
+        await asyncio.to_thread(service.save_snapshot, room_service.SNAPSHOT_PATH, service.build_snapshot())
+
+async def reclaim_loop():
+    while True:
+        await asyncio.sleep(room_service.RECLAIM_INTERVAL)
+        service.reclaim()
+
+# --- Server-side Spotify polling (optional) ---
+# SPOTIFY_FARM=1 plus the app's SPOTIFY_CLIENT_ID/SPOTIFY_CLIENT_SECRET lets users link their
+# account via /spotify/link; the server then reports their playback like a client would.
+SPOTIFY_FARM_ENABLED = (os.environ.get("SPOTIFY_FARM", "0") == "1"
+                        and bool(os.environ.get("SPOTIFY_CLIENT_ID")) and bool(os.environ.get("SPOTIFY_CLIENT_SECRET")))
+
+def report_playback(name, user, data, root):
+    service.update(name, user, dict(data, platform="spotify"), service.proxied_art_url(data.get("art_url"), root))
+
+farm = spotify_farm.SpotifyPollerFarm(
+    report_playback, os.environ.get("SPOTIFY_CLIENT_ID"), os.environ.get("SPOTIFY_CLIENT_SECRET"),
+) if SPOTIFY_FARM_ENABLED else None
+
+@contextlib.asynccontextmanager
+async def lifespan(web_app):
+    snapshot_task = None
+    if room_service.SNAPSHOT_INTERVAL > 0:
+        service.restore_snapshot(await asyncio.to_thread(room_snapshot.read_snapshot, room_service.SNAPSHOT_PATH))
+        snapshot_task = asyncio.create_task(snapshot_loop())
+    trace_task = asyncio.create_task(trace_loop()) if trace is not None else None
+    reclaim_task = asyncio.create_task(reclaim_loop()) if room_service.RECLAIM_INTERVAL > 0 else None
+    cluster_task = asyncio.create_task(cluster_loop()) if cluster.self_url else None
+    if farm is not None:
+        await farm.start()
+    try:
+        yield
+    finally:
+        if farm is not None:
+            await farm.stop()
+        if reclaim_task is not None:
+            reclaim_task.cancel()
+        if cluster_task is not None:
+            cluster_task.cancel()
+        if trace_task is not None:
+            trace_task.cancel()
+            trace.flush()
+        if snapshot_task is not None:
+            snapshot_task.cancel()
+            service.save_snapshot(room_service.SNAPSHOT_PATH)
+
+# --- Traffic trace recording (opt-in via TRACE_PATH, see traffic_trace.py) ---
+trace = traffic_trace.recorder_from_env()
+
+async def trace_loop():
+    while True:
+        await asyncio.sleep(traffic_trace.TRACE_FLUSH_INTERVAL)
+        await asyncio.to_thread(trace.flush)
+
+# --- Album art proxy (optional, needs Pillow) ---
+art_fetches = {}  # key -> Future, so concurrent requests for a new cover share one fetch
+
+async def fetch_art(key, url):
+    """Fetches and resizes a cover once; concurrent callers await the same result."""
+    pending = art_fetches.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+    pending = art_fetches[key] = asyncio.get_running_loop().create_future()
+    ok = False
+    try:
+        # Download and resize on the thread pool; both would block the loop.
+        thumbnails = await asyncio.to_thread(lambda: art_proxy.make_thumbnails(art_proxy.fetch_image(url)))
+        # The disk writes go to the pool too; only the cache's bookkeeping runs on the loop.
+        written = await asyncio.to_thread(art_cache.write, key, thumbnails)
+        await asyncio.to_thread(art_cache.remove_files, art_cache.add(key, written))
+        ok = True
+    except Exception as e:
+        print(f"Art proxy: Could not fetch '{url}': {e}")
+    finally:
+        del art_fetches[key]
+        pending.set_result(ok)
+    return ok
+
+# --- Request helpers (the Flask equivalents are built in) ---
+def arg(request, name, default=None, type=None):
+    """Like Flask's request.args.get(name, default, type=...): bad values give the default."""
+    value = request.query_params.get(name)
+    if value is None or type is None:
+        return default if value is None else value
+    try:
+        return type(value)
+    except ValueError:
+        return default
+
+def client_ip(request):
+    return rate_limit.client_address(request.headers.get('x-forwarded-for', ''), request.client.host if request.client else None)
+
+def url_root(request):
+    return str(request.base_url)
+
+def error(message, status):
+    return JSONResponse({"status": "error", "message": message}, status_code=status)
+
+# --- Rooms partitioned across nodes (opt-in via CLUSTER_NODES/CLUSTER_SELF, see room_cluster.py) ---
+cluster = room_cluster.cluster_from_env()
+rebalance_lock = asyncio.Lock()
+
+def moved_response(request, name):
+    """A 307 to the node that owns room `name`, or None when it is this one."""
+    node = cluster.owner_elsewhere(name)
+    if node is None:
+        return None
+    location = node + request.url.path + (f"?{request.url.query}" if request.url.query else "")
+    return JSONResponse({"status": "error", "message": "Room lives on another node", "node": node},
+                        status_code=307, headers={'Location': location, 'X-Room-Node': node})
+
+async def rebalance():
+    """Same as app.rebalance: hands the rooms this node no longer owns to their owners."""
+    async with rebalance_lock:
+        cluster.rebalance_pending = False
+        for node, names in cluster.moved_rooms(service.room_names()).items():
+            handoff = service.export_rooms(names)
+            if any(handoff.values()) and not await asyncio.to_thread(room_cluster.send_handoff, node, handoff, ADMIN_TOKEN):
+                cluster.failed_handoffs += 1
+                cluster.rebalance_pending = True
+                continue
+            service.drop_rooms(names)
+            cluster.handed_off_rooms += len(names)
+
+async def cluster_loop():
+    while True:
+        await asyncio.sleep(room_cluster.REBALANCE_INTERVAL)
+        if cluster.rebalance_pending:
+            await rebalance()
+
+# --- HTTP Routes for Song Polling ---
+templates = Environment(loader=FileSystemLoader(os.path.join(BASE_DIR, 'templates')), autoescape=True)
+# index.html is written for Flask's url_for('static', filename=...).
+templates.globals['url_for'] = lambda endpoint, filename: f"/{endpoint}/{filename}"
+
+async def index(request):
+    name = room_service.room_name(request.query_params.get('room'))
+    moved = moved_response(request, name)
+    if moved:
+        return moved
+    service.cleanup_inactive_users(name)
+    return HTMLResponse(templates.get_template('index.html').render(initial_state=service.initial_state(name)))
+
+async def update_state(request):
+    now = time.time()
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    message = room_service.update_error(data)
+    if message:
+        return error(message, 400)
+    name = room_service.room_name(data.get('room'))
+    moved = moved_response(request, name)
+    if moved:
+        return moved
+    if trace is not None:
+        trace.update(data)
+
+    user = data.get('user')
+    allowed, retry_after = service.admit_update(user, client_ip(request))
+    if not allowed:
+        return JSONResponse({"status": "error", "message": "Too many updates, slow down"}, status_code=429,
+                            headers={'Retry-After': rate_limit.retry_after_header(retry_after)})
+
+    service.update(name, user, data, service.proxied_art_url(data.get("art_url"), url_root(request)), now)
+    # received_at/server_time double as t1/t2 of a clock offset exchange for HTTP-only clients.
+    return JSONResponse({"status": "success", "received_at": now, "server_time": time.time()})
+
+async def update_state_batch(request):
+    """Same contract as app.update_state_batch."""
+    try:
+        items = await request.json()
+    except ValueError:
+        items = None
+    if not isinstance(items, list) or len(items) > room_service.MAX_BATCH_SIZE:
+        return error(f"Expected a JSON array of at most {room_service.MAX_BATCH_SIZE} updates", 400)
+    if trace is not None:
+        trace.batch(items)
+    allowed, retry_after = service.admit_batch(client_ip(request))
+    if not allowed:
+        return JSONResponse({"status": "error", "message": "Too many updates, slow down"}, status_code=429,
+                            headers={'Retry-After': rate_limit.retry_after_header(retry_after)})
+    now = time.time()
+    root = url_root(request)
+    results = service.update_batch(items, lambda url: service.proxied_art_url(url, root), now, cluster.owner_elsewhere)
+    return JSONResponse({"status": "success", "results": results, "received_at": now, "server_time": time.time()})
+
+async def get_state(request):
+    """Same contract as app.get_state, including the since/wait long-poll and pages."""
+    name = room_service.room_name(arg(request, 'room'))
+    paged = any(key in request.query_params for key in ('limit', 'after', 'fields'))
+    try:
+        limit, fields = room_service.page_args(arg(request, 'limit', type=int), arg(request, 'fields'))
+    except ValueError as e:
+        return error(str(e), 400)
+    moved = moved_response(request, name)
+    if moved:
+        return moved
+    service.cleanup_inactive_users(name)
+    since = arg(request, 'since', type=int)
+    wait = min(arg(request, 'wait', 0, type=float), room_service.LONG_POLL_MAX_WAIT)
+    if trace is not None:
+        trace.get(name, since, wait)
+    if since is not None and wait > 0:
+        await wait_for_change(name, since, wait)
+        moved = moved_response(request, name)  # handed off while waiting
+        if moved:
+            return moved
+        service.cleanup_inactive_users(name)
+    if paged:
+        body = service.page(name, limit, arg(request, 'after'), fields)
+    elif arg(request, 'delta') == '1':
+        body = service.delta(name, since)
+    else:
+        body = service.view(name)
+    return JSONResponse(body, headers={'X-Room-Version': str(service.version(name))})
+
+async def report_latency(request):
+    """Same contract as app.report_latency."""
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get('reports'), list):
+        return error("Invalid data", 400)
+    allowed, retry_after = service.admit_batch(client_ip(request))
+    if not allowed:
+        return JSONResponse({"status": "error", "message": "Too many reports, slow down"}, status_code=429,
+                            headers={'Retry-After': rate_limit.retry_after_header(retry_after)})
+    return JSONResponse({"status": "success", "accepted": service.report_latency(data['reports'])})
+
+async def same_song_listeners(request):
+    name = room_service.room_name(arg(request, 'room'))
+    moved = moved_response(request, name)
+    if moved:
+        return moved
+    return JSONResponse(service.same_song_listeners(name, arg(request, 'user'), arg(request, 'song')))
+
+async def stats(request):
+    name = room_service.room_name(arg(request, 'room'))
+    moved = moved_response(request, name)
+    if moved:
+        return moved
+    window = arg(request, 'window', '24h')
+    if window not in room_service.STATS_WINDOWS:
+        return error(f"Unknown window, use one of {list(room_service.STATS_WINDOWS)}", 400)
+    k = room_service.stats_k(arg(request, 'k', type=int))
+    return JSONResponse(service.stats(name, window, k))
+
+async def art(request):
+    if art_cache is None:
+        return error("Art proxy is disabled", 404)
+    key = request.path_params['key']
+    size = art_proxy.snap_size(arg(request, 's', art_proxy.STANDARD_SIZES[0], type=int))
+    path = art_cache.lookup(key, size)
+    data = None if path is None else await asyncio.to_thread(art_cache.read, path)
+    if data is None:
+        url = art_cache.origin(key)
+        if url is None:
+            return error("Unknown cover", 404)
+        if not await fetch_art(key, url):
+            return error("Could not fetch cover", 502)
+        path = art_cache.lookup(key, size)
+        data = None if path is None else await asyncio.to_thread(art_cache.read, path)
+        if data is None:
+            # Evicted again by a concurrent store() before it could be read.
+            return error("Could not fetch cover", 502)
+    # The key is derived from the origin URL, so the content never changes.
+    etag = f'"{key}_{size}"'
+    headers = {'Cache-Control': f"public, max-age={room_service.ART_MAX_AGE}, immutable", 'ETag': etag}
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(data, media_type='image/jpeg', headers=headers)
+
+async def spotify_link(request):
+    """
+    Links a Spotify account: {"user", "refresh_token", "room"?}. The token needs the
+    user-read-currently-playing scope and must belong to this app's client id.
+    """
+    if farm is None:
+        return error("Server-side Spotify polling is disabled", 404)
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get('user'), str) or not data.get('refresh_token'):
+        return error("Invalid data", 400)
+    allowed, retry_after = service.admit_update(data['user'], client_ip(request))
+    if not allowed:
+        return JSONResponse({"status": "error", "message": "Too many requests, slow down"}, status_code=429,
+                            headers={'Retry-After': rate_limit.retry_after_header(retry_after)})
+    try:
+        await farm.link(data['user'], room_service.room_name(data.get('room')), str(data['refresh_token']), url_root(request))
+    except spotify_farm.AuthError:
+        return error("Spotify rejected the refresh token", 400)
+    except spotify_farm.RateLimited as e:
+        return JSONResponse({"status": "error", "message": "Spotify is rate limiting, try again later"}, status_code=503,
+                            headers={'Retry-After': rate_limit.retry_after_header(e.seconds)})
+    except ValueError as e:
+        return error(str(e), 503)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return error("Could not reach Spotify", 502)
+    except spotify_farm.BadResponse:
+        return error("Unexpected response from Spotify", 502)
+    return JSONResponse({"status": "success"})
+
+async def spotify_unlink(request):
+    """Stops server-side polling: {"user", "refresh_token"} (the token used to link)."""
+    if farm is None:
+        return error("Server-side Spotify polling is disabled", 404)
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not farm.unlink(data.get('user'), data.get('refresh_token')):
+        return error("Not linked", 404)
+    return JSONResponse({"status": "success"})
+
+async def spotify_status(request):
+    if farm is None:
+        return error("Server-side Spotify polling is disabled", 404)
+    return JSONResponse(farm.stats())
+
+# --- Admin (only exists when ADMIN_TOKEN is set; callers send it as X-Admin-Token) ---
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+def admin_denied(request):
+    if not ADMIN_TOKEN:
+        return error("Not found", 404)
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return error("Forbidden", 403)
+    return None
+
+async def admin_latency(request):
+    """Same as app.admin_latency."""
+    denied = admin_denied(request)
+    if denied:
+        return denied
+    if request.method == 'DELETE':
+        service.latency.reset()
+    return JSONResponse(service.latency.summary())
+
+async def admin_memory(request):
+    """Same as app.admin_memory."""
+    return admin_denied(request) or JSONResponse(dict(service.memory(), **waiter_counts()))
+
+async def cluster_info(request):
+    """Same as app.cluster_info."""
+    info = {"self": cluster.self_url, "nodes": cluster.ring.nodes}
+    if 'room' in request.query_params:
+        name = room_service.room_name(arg(request, 'room'))
+        info.update(room=name, node=cluster.owner(name))
+    return JSONResponse(info)
+
+async def admin_cluster(request):
+    """Same as app.admin_cluster."""
+    denied = admin_denied(request)
+    if denied:
+        return denied
+    if request.method == 'PUT':
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        if not isinstance(data, dict) or not isinstance(data.get('nodes'), list):
+            return error('Expected {"nodes": [url, ...]}', 400)
+        if not cluster.self_url:
+            return error("This node was started without CLUSTER_SELF", 400)
+        cluster.set_nodes(data['nodes'])
+        await rebalance()
+    return JSONResponse(cluster.status())
+
+async def admin_cluster_handoff(request):
+    """Same as app.admin_cluster_handoff."""
+    denied = admin_denied(request)
+    if denied:
+        return denied
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get('rooms'), dict):
+        return error("Invalid data", 400)
+    users = service.adopt_rooms(data)
+    names = room_service.handoff_rooms(data)
+    cluster.adopted_rooms += len(names)
+    if cluster.moved_rooms(names):
+        cluster.rebalance_pending = True  # sent here under an older membership; pass them on
+    return JSONResponse({"status": "success", "rooms": len(names), "users": users})
+
+web = Starlette(
+    routes=[
+        Route('/', index),
+        Route('/update_state', update_state, methods=['POST']),
+        Route('/update_state/batch', update_state_batch, methods=['POST']),
+        Route('/get_state', get_state, methods=['GET']),
+        Route('/same_song', same_song_listeners, methods=['GET']),
+        Route('/stats', stats, methods=['GET']),
+        Route('/art/{key}', art, methods=['GET']),
+        Route('/spotify/link', spotify_link, methods=['POST']),
+        Route('/spotify/unlink', spotify_unlink, methods=['POST']),
+        Route('/spotify/status', spotify_status, methods=['GET']),
+        Route('/latency', report_latency, methods=['POST']),
+        Route('/admin/latency', admin_latency, methods=['GET', 'DELETE']),
+        Route('/admin/memory', admin_memory, methods=['GET']),
+        Route('/cluster', cluster_info, methods=['GET']),
+        Route('/admin/cluster', admin_cluster, methods=['GET', 'PUT']),
+        Route('/admin/cluster/handoff', admin_cluster_handoff, methods=['POST']),
+        Mount('/static', StaticFiles(directory=os.path.join(BASE_DIR, 'static')), name='static'),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])],
+    lifespan=lifespan,
+)
+
+# --- WebSocket Handlers for Live Chat ---
+@sio.event
+async def connect(sid, environ, auth=None):
+    # A connection belongs to a room (?room=, the default room otherwise); its owner serves it.
+    query = urllib.parse.parse_qs(environ.get('QUERY_STRING', ''))
+    room = room_service.room_name(query.get('room', [None])[0])
+    node = cluster.owner_elsewhere(room)
+    if node is not None:
+        raise socketio.exceptions.ConnectionRefusedError({"message": "Room lives on another node", "node": node})
+    if not service.admit_connection():
+        return False  # At MAX_CONNECTIONS; python-socketio refuses the connection
+    print('Chat client connected')
+    # Flask-SocketIO handlers can read the request; here the IP and room are kept in the session.
+    ip = rate_limit.client_address(environ.get('HTTP_X_FORWARDED_FOR'), environ.get('REMOTE_ADDR'))
+    await sio.save_session(sid, {"ip": ip, "room": room})
+    if trace is not None:
+        trace.connect(sid, ip)
+    # Chat is per room: the connection enters its Socket.IO room and gets that room's recent
+    # chat replayed, so a reconnect after a redeploy doesn't show an empty chat.
+    await sio.enter_room(sid, room)
+    messages = service.chat_history(room)
+    if messages:
+        await sio.emit('chat_history', messages, to=sid)
+
+@sio.event
+async def disconnect(sid, *args):
+    service.connection_closed()
+    print('Chat client disconnected')
+    if trace is not None:
+        trace.disconnect(sid)
+
+@sio.on('clock_sync')
+async def handle_clock_sync(sid, data):
+    """Same NTP-style exchange as app.handle_clock_sync; the return value is the ack."""
+    t1 = time.time()
+    if trace is not None:
+        trace.clock_sync(sid)
+    t0 = data.get('t0') if isinstance(data, dict) else None
+    return {"t0": t0, "t1": t1, "t2": time.time()}
+
+@sio.on('send_message')
+async def handle_send_message(sid, data):
+    """Receives a message from a client and broadcasts it to the clients in its room."""
+    if not isinstance(data, dict):
+        return
+    session = await sio.get_session(sid)
+    room = session.get("room", room_service.DEFAULT_ROOM)
+    node = cluster.owner_elsewhere(room)
+    if node is not None:
+        # The room moved since this client connected; it reconnects to the new owner.
+        await sio.emit('room_moved', {"room": room, "node": node}, to=sid)
+        return
+    allowed, retry_after = service.admit_message(data.get('user'), session.get("ip", "unknown"))
+    if not allowed:
+        # Only the sender hears about it; the message is dropped.
+        await sio.emit('rate_limited', {"event": "send_message", "retry_after": round(retry_after, 2)}, to=sid)
+        return
+    if trace is not None:
+        trace.message(sid, data)
+    message = service.add_message(room, data)
+    if message is None:
+        return
+    print(f"Received message from {message['user']}: {message['message']}")
+    await sio.emit('new_message', message, to=room)
+
+app = socketio.ASGIApp(sio, other_asgi_app=web)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5000)
@@ -0,0 +1,76 @@
+import asyncio
+import ssl
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import certifi
+
+# --- Async networking core for the Qt client ---
+# Everything runs as tasks on one asyncio loop (qasync's QEventLoop, i.e. the Qt event loop).
+# Blocking libraries (spotipy, pyncm, pywin32) go through a small fixed thread pool, which
+# also serves DNS lookups, so the number of threads no longer grows with the work.
+HTTP_TIMEOUT = 5
+BLOCKING_WORKERS = 2
+
+class AsyncRuntime:
+    """Owns the shared HTTP session, the blocking-call pool and every background task."""
+
+    def __init__(self, loop=None, max_workers=BLOCKING_WORKERS):
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="blocking")
+        self.loop.set_default_executor(self.executor)
+        self.session = None
+        self._tasks = set()
+
+    async def start(self):
+        ssl_context = ssl.create_default_context(cafile=certifi.where())
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(ssl=ssl_context),
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+        )
+
+    def spawn(self, coro, name=None):
+        """Starts a tracked task; it is cancelled on shutdown() or via the returned task."""
+        task = self.loop.create_task(coro, name=name)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Task {task.get_name()} failed: {task.exception()!r}")
+
+    async def run_blocking(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, func, *args)
+
+    async def get_json(self, url, **kwargs):
+        async with self.session.get(url, **kwargs) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def get_json_with_headers(self, url, **kwargs):
+        async with self.session.get(url, **kwargs) as response:
+            response.raise_for_status()
+            return await response.json(), response.headers
+
+    async def post_json(self, url, payload, **kwargs):
+        async with self.session.post(url, json=payload, **kwargs) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def get_bytes(self, url, **kwargs):
+        async with self.session.get(url, **kwargs) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    async def shutdown(self):
+        """Cancels all tasks immediately (no waiting on sleeps) and closes the session."""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+        # A detector call already running in the pool can't be interrupted; don't wait for it.
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,223 @@
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import aiohttp
+import socketio
+
+# --- Server mode benchmark: eventlet (app.py) vs asyncio (asgi_app.py) ---
+# Starts each server as a subprocess on this machine and measures, against the same workload:
+#   connections   Socket.IO (websocket) clients connected, and how long that took
+#   messages/s    chat messages delivered to clients (one send is broadcast to every client)
+#   requests/s    /update_state + /get_state calls from concurrent HTTP clients
+#   batched/s     user updates ingested per second through /update_state/batch
+#   memory        server RSS when idle, with all clients connected, and after the load
+# Needs requirements-server.txt and requirements-asgi.txt. Example:
+#   python bench_server.py --clients 500 --senders 10 --messages 20
+HOST = "127.0.0.1"
+
+SERVER_COMMANDS = {
+    "eventlet": [sys.executable, "-c",
+                 "import eventlet; eventlet.monkey_patch(); import app; "
+                 "app.socketio.run(app.app, host='{host}', port={port}, log_output=False)"],
+    "asgi": [sys.executable, "-m", "uvicorn", "asgi_app:app", "--host", "{host}", "--port", "{port}",
+             "--log-level", "warning"],
+}
+
+def server_env():
+    env = dict(os.environ)
+    env["SNAPSHOT_INTERVAL"] = "0"  # Don't read or write the real snapshot
+    # The benchmark comes from one IP with a few users, so admission control would reject most of it.
+    for name in ("UPDATE_RATE_PER_USER", "UPDATE_RATE_PER_IP", "MESSAGE_RATE_PER_USER", "MESSAGE_RATE_PER_IP"):
+        env[name] = "0"
+    return env
+
+def rss_mb(pid):
+    """Resident memory of a process in MB (Linux /proc, or psutil if installed)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss / (1024 * 1024)
+    except (ImportError, Exception):
+        return None
+
+async def wait_until_up(url, timeout=20):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(f"{url}/get_state") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not start")
+
+async def connect_clients(url, count, batch):
+    """Connects `count` clients, `batch` at a time; returns (clients, seconds)."""
+    clients = []
+    start = time.perf_counter()
+    for offset in range(0, count, batch):
+        batch_clients = [socketio.AsyncClient(reconnection=False) for _ in range(min(batch, count - offset))]
+        results = await asyncio.gather(
+            *(c.connect(url, transports=["websocket"], wait_timeout=10) for c in batch_clients),
+            return_exceptions=True)
+        clients.extend(c for c, result in zip(batch_clients, results) if not isinstance(result, Exception))
+    return clients, time.perf_counter() - start
+
+async def chat_throughput(clients, senders, messages, timeout):
+    """Every sender emits `messages` chat messages; returns (delivered, expected, seconds)."""
+    expected = senders * messages * len(clients)
+    received = 0
+    done = asyncio.Event()
+
+    def on_message(data):
+        nonlocal received
+        received += 1
+        if received >= expected:
+            done.set()
+
+    for client in clients:
+        client.on("new_message", on_message)
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        client.emit("send_message", {"user": f"bench{i}", "message": f"message {n}"})
+        for i, client in enumerate(clients[:senders]) for n in range(messages)))
+    try:
+        await asyncio.wait_for(done.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    return received, expected, time.perf_counter() - start
+
+async def http_throughput(url, workers, duration):
+    """Each worker alternates /update_state and /get_state for `duration` seconds."""
+    counts = {"ok": 0, "failed": 0}
+
+    async def worker(session, i):
+        deadline = time.monotonic() + duration
+        n = 0
+        while time.monotonic() < deadline:
+            try:
+                if n % 2 == 0:
+                    request = session.post(f"{url}/update_state", json={"user": f"bench{i}", "song": f"Song {n % 5} - Artist"})
+                else:
+                    request = session.get(f"{url}/get_state")
+                async with request as response:
+                    await response.read()
+                    counts["ok" if response.status == 200 else "failed"] += 1
+            except aiohttp.ClientError:
+                counts["failed"] += 1
+            n += 1
+
+    connector = aiohttp.TCPConnector(limit=workers)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(session, i) for i in range(workers)))
+        elapsed = time.perf_counter() - start
+    return counts["ok"], counts["failed"], elapsed
+
+async def batch_throughput(url, workers, duration, batch_size):
+    """Each worker posts batches of `batch_size` user updates; returns (updates, failed batches, seconds)."""
+    counts = {"updates": 0, "failed": 0}
+
+    async def worker(session, i):
+        deadline = time.monotonic() + duration
+        n = 0
+        while time.monotonic() < deadline:
+            batch = [{"user": f"relay{i}-{u}", "song": f"Song {(n + u) % 5} - Artist"} for u in range(batch_size)]
+            try:
+                async with session.post(f"{url}/update_state/batch", json=batch) as response:
+                    body = await response.json()
+                    if response.status == 200:
+                        counts["updates"] += sum(1 for r in body["results"] if r["status"] == "success")
+                    else:
+                        counts["failed"] += 1
+            except aiohttp.ClientError:
+                counts["failed"] += 1
+            n += 1
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=workers)) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(session, i) for i in range(workers)))
+        elapsed = time.perf_counter() - start
+    return counts["updates"], counts["failed"], elapsed
+
+async def run_mode(mode, args):
+    url = f"http://{HOST}:{args.port}"
+    command = [part.format(host=HOST, port=args.port) for part in SERVER_COMMANDS[mode]]
+    server = subprocess.Popen(command, env=server_env(), cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        await wait_until_up(url)
+        result = {"mode": mode, "rss_idle_mb": rss_mb(server.pid)}
+        clients, connect_s = await connect_clients(url, args.clients, args.connect_batch)
+        result.update(connected=len(clients), connect_s=connect_s, rss_connected_mb=rss_mb(server.pid))
+        delivered, expected, chat_s = await chat_throughput(clients, min(args.senders, len(clients)), args.messages, args.timeout)
+        result.update(delivered=delivered, expected=expected, messages_per_s=delivered / chat_s if chat_s else 0.0)
+        ok, failed, http_s = await http_throughput(url, args.http_workers, args.http_seconds)
+        result.update(http_ok=ok, http_failed=failed, requests_per_s=ok / http_s if http_s else 0.0)
+        updates, failed, batch_s = await batch_throughput(url, args.batch_workers, args.http_seconds, args.batch_size)
+        result.update(batch_failed=failed, batched_per_s=updates / batch_s if batch_s else 0.0,
+                      rss_after_mb=rss_mb(server.pid))
+        await asyncio.gather(*(c.disconnect() for c in clients), return_exceptions=True)
+        return result
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+def fmt_mb(value):
+    return "n/a" if value is None else f"{value:.1f}"
+
+def print_report(results):
+    rows = [
+        ("connected clients", lambda r: f"{r['connected']}"),
+        ("connect time (s)", lambda r: f"{r['connect_s']:.2f}"),
+        ("chat deliveries", lambda r: f"{r['delivered']}/{r['expected']}"),
+        ("messages/s", lambda r: f"{r['messages_per_s']:.0f}"),
+        ("HTTP requests/s", lambda r: f"{r['requests_per_s']:.0f}"),
+        ("HTTP failures", lambda r: f"{r['http_failed']}"),
+        ("batched updates/s", lambda r: f"{r['batched_per_s']:.0f}"),
+        ("batch failures", lambda r: f"{r['batch_failed']}"),
+        ("RSS idle (MB)", lambda r: fmt_mb(r["rss_idle_mb"])),
+        ("RSS connected (MB)", lambda r: fmt_mb(r["rss_connected_mb"])),
+        ("RSS after load (MB)", lambda r: fmt_mb(r["rss_after_mb"])),
+    ]
+    print(f"{'':22}" + "".join(f"{r['mode']:>14}" for r in results))
+    for label, cell in rows:
+        print(f"{label:22}" + "".join(f"{cell(r):>14}" for r in results))
+
+async def main():
+    parser = argparse.ArgumentParser(description="Compare the eventlet and asyncio server modes.")
+    parser.add_argument("--modes", nargs="+", choices=sorted(SERVER_COMMANDS), default=["eventlet", "asgi"])
+    parser.add_argument("--port", type=int, default=5100)
+    parser.add_argument("--clients", type=int, default=200, help="Socket.IO clients to connect")
+    parser.add_argument("--connect-batch", type=int, default=50, help="clients connecting at the same time")
+    parser.add_argument("--senders", type=int, default=5, help="clients sending chat messages")
+    parser.add_argument("--messages", type=int, default=20, help="messages per sender")
+    parser.add_argument("--timeout", type=float, default=30, help="max seconds to wait for chat deliveries")
+    parser.add_argument("--http-workers", type=int, default=50)
+    parser.add_argument("--http-seconds", type=float, default=5)
+    parser.add_argument("--batch-workers", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=100, help="user updates per /update_state/batch call")
+    args = parser.parse_args()
+    results = []
+    for mode in args.modes:
+        print(f"Benchmarking {mode}...")
+        results.append(await run_mode(mode, args))
+    print_report(results)
+
+if __name__ == "__main__":
+    asyncio.run(main())
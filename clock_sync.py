@@ -0,0 +1,48 @@
+import time
+
+# --- NTP-style clock offset estimation ---
+# t0: client send time, t1: server receive time, t2: server send time, t3: client receive time.
+# offset = server clock - client clock; rtt excludes the server's own processing time.
+
+def offset_and_rtt(t0, t1, t2, t3):
+    offset = ((t1 - t0) + (t2 - t3)) / 2
+    rtt = (t3 - t0) - (t2 - t1)
+    return offset, rtt
+
+class ClockOffsetEstimator:
+    """
+    Keeps the last few exchanges and trusts the one with the smallest round trip,
+    since that one has the least room for asymmetric network delay.
+    """
+
+    def __init__(self, max_samples=8):
+        self.max_samples = max_samples
+        self._samples = []  # (rtt, offset)
+
+    def add_sample(self, t0, t1, t2, t3):
+        offset, rtt = offset_and_rtt(t0, t1, t2, t3)
+        if rtt < 0:
+            return
+        self._samples.append((rtt, offset))
+        if len(self._samples) > self.max_samples:
+            self._samples.pop(0)
+
+    @property
+    def offset(self):
+        """Seconds to add to the local clock to get server time, or None before the first sample."""
+        if not self._samples:
+            return None
+        return min(self._samples)[1]
+
+    def to_server_time(self, local_time):
+        offset = self.offset
+        return None if offset is None else local_time + offset
+
+# --- Playback position ---
+def extrapolate_position(progress_ms, duration_ms, sampled_at, now=None):
+    """Where a track that was at `progress_ms` at server time `sampled_at` is at `now`."""
+    now = time.time() if now is None else now
+    position = progress_ms + max(0.0, now - sampled_at) * 1000
+    if duration_ms:
+        position = min(position, duration_ms)
+    return int(position)
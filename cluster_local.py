@@ -0,0 +1,200 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import secrets
+import subprocess
+import time
+
+import aiohttp
+
+import bench_server
+import room_cluster
+
+# --- A cluster of local server processes (see room_cluster.py) ---
+# Starts app.py nodes on consecutive ports, each knowing all the others, and:
+#   run        keeps them running until Ctrl+C, e.g. to point clients or replay_trace.py at them
+#   scale      measures /update_state + /get_state requests/s for 1..N nodes; load generators
+#              send each room's requests straight to its owner, as clients that follow the 307s do
+#   rebalance  fills rooms through one node (following its redirects), adds a node, then removes
+#              one, and checks after each step that every user is still found in its room
+# Scaling is only linear while the machine has a core per node and per load process. Example:
+#   python cluster_local.py scale --max-nodes 4 --rooms 200
+HOST = bench_server.HOST
+ADMIN_TOKEN = secrets.token_hex(16)
+
+def node_url(port):
+    return f"http://{HOST}:{port}"
+
+def start_node(port, nodes, mode="eventlet"):
+    env = bench_server.server_env()
+    env.update(CLUSTER_SELF=node_url(port), CLUSTER_NODES=",".join(nodes), ADMIN_TOKEN=ADMIN_TOKEN,
+               CLUSTER_REBALANCE_INTERVAL="1")
+    command = [part.format(host=HOST, port=port) for part in bench_server.SERVER_COMMANDS[mode]]
+    return subprocess.Popen(command, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def stop_node(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+async def start_cluster(ports, mode):
+    nodes = [node_url(port) for port in ports]
+    processes = {node: start_node(port, nodes, mode) for node, port in zip(nodes, ports)}
+    await asyncio.gather(*(bench_server.wait_until_up(node) for node in nodes))
+    return processes
+
+async def set_membership(session, targets, nodes):
+    """PUT /admin/cluster on every target node; returns their status after the handoffs."""
+    async def put(node):
+        async with session.put(f"{node}/admin/cluster", json={"nodes": nodes},
+                               headers={"X-Admin-Token": ADMIN_TOKEN}) as response:
+            return await response.json()
+    return await asyncio.gather(*(put(node) for node in targets))
+
+def room_name(i):
+    return f"room-{i}"
+
+# --- scale ---
+def load_process(nodes, rooms, workers, duration, seed):
+    """One load generator process; returns (ok, failed, seconds)."""
+    return asyncio.run(route_load(nodes, rooms, workers, duration, seed))
+
+async def route_load(nodes, rooms, workers, duration, seed):
+    ring = room_cluster.HashRing(nodes)
+    counts = {"ok": 0, "failed": 0}
+
+    async def worker(session, i):
+        deadline = time.monotonic() + duration
+        n = 0
+        while time.monotonic() < deadline:
+            room = room_name((seed * workers + i + n * 7919) % rooms)
+            url = ring.owner(room)
+            try:
+                if n % 2 == 0:
+                    request = session.post(f"{url}/update_state", json={
+                        "user": f"load{seed}-{i}", "room": room, "song": f"Song {n % 5} - Artist"})
+                else:
+                    request = session.get(f"{url}/get_state", params={"room": room})
+                async with request as response:
+                    await response.read()
+                    counts["ok" if response.status == 200 else "failed"] += 1
+            except aiohttp.ClientError:
+                counts["failed"] += 1
+            n += 1
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=workers)) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(session, i) for i in range(workers)))
+        elapsed = time.perf_counter() - start
+    return counts["ok"], counts["failed"], elapsed
+
+async def scale(args):
+    results = []
+    for count in range(1, args.max_nodes + 1):
+        ports = list(range(args.port, args.port + count))
+        processes = await start_cluster(ports, args.mode)
+        nodes = list(processes)
+        try:
+            load_processes = args.load_processes or count
+            with multiprocessing.Pool(load_processes) as pool:
+                runs = await asyncio.to_thread(pool.starmap, load_process, [
+                    (nodes, args.rooms, args.workers, args.seconds, seed) for seed in range(load_processes)])
+            ok = sum(run[0] for run in runs)
+            failed = sum(run[1] for run in runs)
+            elapsed = max(run[2] for run in runs)
+            results.append((count, ok / elapsed if elapsed else 0.0, failed))
+            print(f"{count} node(s): {results[-1][1]:.0f} requests/s, {failed} failed")
+        finally:
+            for process in processes.values():
+                stop_node(process)
+    base = results[0][1] or 1.0
+    print(f"{'nodes':>6}{'requests/s':>14}{'speedup':>10}{'failed':>8}")
+    for count, rate, failed in results:
+        print(f"{count:>6}{rate:>14.0f}{rate / base:>10.2f}{failed:>8}")
+
+# --- rebalance ---
+async def fill_rooms(session, entry, rooms, users):
+    """Reports `users` users per room, all through `entry` (which redirects to the owners)."""
+    async def report(i, u):
+        async with session.post(f"{entry}/update_state", json={
+                "user": f"user-{i}-{u}", "room": room_name(i), "song": f"Song {u} - Artist"}) as response:
+            await response.read()
+            return response.status == 200
+    results = await asyncio.gather(*(report(i, u) for i in range(rooms) for u in range(users)))
+    return sum(results)
+
+async def check_rooms(session, entry, rooms, users):
+    """Counts rooms that lost users, reading every room through `entry`."""
+    async def missing(i):
+        async with session.get(f"{entry}/get_state", params={"room": room_name(i)}) as response:
+            return users - len(await response.json()) if response.status == 200 else users
+    return sum(1 for lost in await asyncio.gather(*(missing(i) for i in range(rooms))) if lost)
+
+def moved(statuses):
+    return sum(status["handed_off_rooms"] for status in statuses)
+
+async def rebalance(args):
+    ports = list(range(args.port, args.port + args.nodes))
+    processes = await start_cluster(ports, args.mode)
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=50)) as session:
+            entry = node_url(ports[0])
+            stored = await fill_rooms(session, entry, args.rooms, args.users)
+            print(f"{args.nodes} nodes: stored {stored}/{args.rooms * args.users} users through {entry}")
+
+            new_port = args.port + args.nodes
+            nodes = list(processes) + [node_url(new_port)]
+            processes[node_url(new_port)] = start_node(new_port, nodes, args.mode)
+            await bench_server.wait_until_up(node_url(new_port))
+            statuses = await set_membership(session, nodes, nodes)
+            print(f"Added {node_url(new_port)}: {moved(statuses)} of {args.rooms} rooms moved "
+                  f"(about {args.rooms / len(nodes):.0f} expected), "
+                  f"{await check_rooms(session, entry, args.rooms, args.users)} rooms lost users")
+
+            leaving = nodes[0]
+            remaining = nodes[1:]
+            before = moved(statuses)
+            statuses = await set_membership(session, nodes, remaining)
+            stop_node(processes.pop(leaving))
+            print(f"Removed {leaving}: {moved(statuses) - before} rooms handed off, "
+                  f"{await check_rooms(session, remaining[0], args.rooms, args.users)} rooms lost users")
+    finally:
+        for process in processes.values():
+            stop_node(process)
+
+async def run(args):
+    ports = list(range(args.port, args.port + args.nodes))
+    processes = await start_cluster(ports, args.mode)
+    print(f"Nodes: {', '.join(processes)}")
+    print(f"Admin token: {ADMIN_TOKEN}")
+    try:
+        while all(process.poll() is None for process in processes.values()):
+            await asyncio.sleep(1)
+    finally:
+        for process in processes.values():
+            stop_node(process)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run rooms partitioned across local server processes.")
+    parser.add_argument("command", choices=["run", "scale", "rebalance"])
+    parser.add_argument("--mode", choices=sorted(bench_server.SERVER_COMMANDS), default="eventlet")
+    parser.add_argument("--port", type=int, default=5200, help="first node's port; the others follow")
+    parser.add_argument("--nodes", type=int, default=3, help="nodes for run and rebalance")
+    parser.add_argument("--max-nodes", type=int, default=4, help="scale measures 1..max-nodes")
+    parser.add_argument("--rooms", type=int, default=200)
+    parser.add_argument("--users", type=int, default=5, help="users per room for rebalance")
+    parser.add_argument("--workers", type=int, default=50, help="concurrent requests per load process")
+    parser.add_argument("--load-processes", type=int, help="defaults to one per node")
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+    try:
+        asyncio.run({"run": run, "scale": scale, "rebalance": rebalance}[args.command](args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
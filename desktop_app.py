@@ -1,24 +1,24 @@
+import startup_profiler # Imported first so the startup clock starts early
 import sys
 import os # Import os module
-import time
-import requests
-import certifi
-from PySide6.QtWidgets import QApplication, QMainWindow
-from PySide6.QtCore import QThread, QObject, Signal, Slot, QUrl
-from PySide6.QtWebEngineWidgets import QWebEngineView
-from PySide6.QtWebEngineCore import QWebEnginePage
-from PySide6.QtWebChannel import QWebChannel
-
-# Import our existing detector logic
-import spotify_detector
-from desktop_assistant import get_current_netease_song
+import asyncio
+with startup_profiler.timed("import PySide6"):
+    from PySide6.QtWidgets import QApplication, QMainWindow, QLabel
+    from PySide6.QtCore import QCoreApplication, QThread, QObject, Signal, Slot, Qt, QTimer, QUrl
+
+# QtWebEngine is loaded by MainWindow after the window has been painted once, and the
+# detector daemon (with spotipy / pywin32) is loaded by Worker once a platform is chosen.
 
 # --- Configuration ---
 WEB_APP_URL = "https://listeningtogether.onrender.com/" 
-SERVER_URL = f"{WEB_APP_URL}update_song"
 
-# --- Background Worker (Unchanged) ---
+# --- Background Worker ---
 class Worker(QObject):
+    """
+    Hosts the detector daemon (music_daemon.py) on this thread's own asyncio loop, so the web
+    view and any other MusicFriend UI share one detection loop. If a daemon already runs,
+    it reports for us and there is nothing to do.
+    """
     status_updated = Signal(str)
     error_occurred = Signal(str)
 
@@ -26,52 +26,47 @@ class Worker(QObject):
         super().__init__()
         self.username = username
         self.platform = platform
-        self._is_running = True
-        self.get_song_function = None
+        self.loop = None
+        self._stop_requested = None
 
     def run(self):
-        if self.platform == 'spotify':
-            if not spotify_detector.initialize_spotify():
-                self.error_occurred.emit("Spotify initialization failed.")
-                return
-            self.get_song_function = spotify_detector.get_current_spotify_song
-        else:
-            self.get_song_function = get_current_netease_song
-
+        import music_daemon
+        if music_daemon.daemon_running():
+            self.status_updated.emit("The MusicFriend daemon is already reporting.")
+            return
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self._host(music_daemon))
+        finally:
+            self.loop.close()
+
+    async def _host(self, music_daemon):
+        from async_core import AsyncRuntime
+        self._stop_requested = asyncio.Event()
+        runtime = AsyncRuntime(self.loop)
+        await runtime.start()
+        daemon = music_daemon.MusicDaemon(runtime, self.username, self.platform)
+        try:
+            await daemon.start()
+        except OSError:
+            self.status_updated.emit("The MusicFriend daemon is already reporting.")
+            await runtime.shutdown()
+            return
         self.status_updated.emit(f"Monitoring {self.platform}...")
-        last_song_title = None
-
-        while self._is_running:
-            try:
-                song_info = self.get_song_function()
-                if song_info:
-                    song, artist = song_info
-                    current_song_title = f"{song} - {artist}"
-                    if current_song_title != last_song_title:
-                        last_song_title = current_song_title
-                        self.post_to_server(current_song_title)
-                else:
-                    if last_song_title is not None:
-                        self.status_updated.emit("Playback stopped.")
-                        last_song_title = None
-                time.sleep(5)
-            except Exception as e:
-                self.error_occurred.emit(f"Error in main loop: {e}")
-                time.sleep(10)
-
-    def post_to_server(self, song_title):
+        daemon.hub.subscribe(self._on_message)
         try:
-            payload = {"user": self.username, "song": song_title, "platform": self.platform}
-            response = requests.post(SERVER_URL, json=payload, timeout=7, verify=certifi.where())
-            if response.status_code == 200:
-                self.status_updated.emit("Update sent successfully.")
-            else:
-                self.status_updated.emit(f"Server Error: {response.status_code}")
-        except requests.exceptions.RequestException as e:
-            self.error_occurred.emit(f"Connection Failed: {e}")
+            await self._stop_requested.wait()
+        finally:
+            await daemon.stop()
+            await runtime.shutdown()
+
+    def _on_message(self, message):
+        if message["type"] == "health":
+            self.status_updated.emit(message["status"])
 
     def stop(self):
-        self._is_running = False
+        if self.loop is not None and self._stop_requested is not None:
+            self.loop.call_soon_threadsafe(self._stop_requested.set)
 
 # --- Python-JS Bridge ---
 class Bridge(QObject):
@@ -89,19 +84,38 @@ class MainWindow(QMainWindow):
         self.setWindowTitle("MusicFriend Room")
         self.setGeometry(100, 100, 1280, 720)
 
+        # Show a lightweight placeholder first; the web view replaces it on the next event loop turn.
+        loading_label = QLabel("Loading room...")
+        loading_label.setAlignment(Qt.AlignCenter)
+        self.setCentralWidget(loading_label)
+        self.browser = None
+
+        self.bridge = Bridge()
+        self.thread = None
+        self.worker = None
+        self.bridge.sync_started.connect(self.on_sync_start_requested)
+        self._browser_scheduled = False
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self._browser_scheduled:
+            self._browser_scheduled = True
+            QTimer.singleShot(0, self._load_browser)
+
+    def _load_browser(self):
+        with startup_profiler.timed("import QtWebEngine"):
+            from PySide6.QtWebEngineWidgets import QWebEngineView
+            from PySide6.QtWebChannel import QWebChannel
         self.browser = QWebEngineView()
         self.setCentralWidget(self.browser)
 
         self.channel = QWebChannel()
-        self.bridge = Bridge()
         self.channel.registerObject("qt_bridge", self.bridge)
         self.browser.page().setWebChannel(self.channel)
 
         self.browser.setUrl(QUrl(WEB_APP_URL))
-
-        self.thread = None
-        self.worker = None
-        self.bridge.sync_started.connect(self.on_sync_start_requested)
+        startup_profiler.mark("web view created")
+        self.browser.loadFinished.connect(lambda ok: (startup_profiler.mark("room page loaded"), startup_profiler.report()))
 
     @Slot(str, str)
     def on_sync_start_requested(self, username, platform):
@@ -132,8 +146,12 @@ if __name__ == '__main__':
     # --- THE CHANGE IS HERE ---
     # Set environment variable to enable remote debugging on port 8888
     os.environ['QTWEBENGINE_REMOTE_DEBUGGING'] = "8888"
+    # Required when QtWebEngine is imported after the QApplication has been created.
+    QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
     
+    startup_profiler.mark("modules imported")
     app = QApplication(sys.argv)
     window = MainWindow()
+    startup_profiler.watch_first_paint(window, "window first paint")
     window.show()
     sys.exit(app.exec())
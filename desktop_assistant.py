@@ -1,11 +1,7 @@
-import requests
-import time
+import asyncio
 import win32gui
 import spotify_detector
 
-# --- Configuration ---
-SERVER_URL = "https://listeningtogether.onrender.com" # Remember to replace this
-
 # --- NetEase Detector (kept from before) ---
 def get_current_netease_song():
     try:
@@ -19,82 +15,85 @@ def get_current_netease_song():
     except Exception:
         return None
 
-def main():
-    """
-    Main loop for the desktop assistant.
-    """
-    # --- User Setup at Startup ---
-    username = input("Please enter your username for the listening room: ")
-    if not username:
-        print("Username cannot be empty. Exiting.")
-        return
+last_song_title = None
 
-    platform_choice = ''
-    while platform_choice not in ['1', '2']:
-        platform_choice = input("Which music platform do you want to detect?\n1: NetEase Cloud Music\n2: Spotify\nEnter 1 or 2: ")
+def print_message(message):
+    global last_song_title
+    if message["type"] == "song":
+        song = message["data"].get("song")
+        if song != last_song_title:
+            last_song_title = song
+            print(f"Now playing: {song or 'nothing'}")
+    elif message["type"] == "health":
+        print(f"Server: {message['status']}")
+    elif message["type"] == "room":
+        print(f"Room: {len(message['state'])} listener(s)")
 
-    platform_name = ''
-    get_song_function = None
+async def follow_daemon():
+    """Prints what the running daemon publishes instead of detecting a second time."""
+    import music_daemon
+    await music_daemon.follow(print_message)
+    print("The daemon stopped.")
 
-    if platform_choice == '1':
-        platform_name = 'netease'
-        get_song_function = get_current_netease_song
-        print("Selected NetEase Cloud Music.")
-    else:
-        platform_name = 'spotify'
-        # Initialize Spotify client, which may require user browser authorization
-        if not spotify_detector.initialize_spotify():
-            print("Could not initialize Spotify. Please check your credentials and try again.")
-            return
-        get_song_function = spotify_detector.get_current_spotify_song
-        print("Selected Spotify.")
+async def run_daemon(username, platform_name):
+    """Hosts the detector daemon in this console, so other UIs can subscribe to it."""
+    import music_daemon
+    from async_core import AsyncRuntime
+    runtime = AsyncRuntime(asyncio.get_running_loop())
+    await runtime.start()
+    daemon = music_daemon.MusicDaemon(runtime, username, platform_name)
+    try:
+        await daemon.start()
+    except OSError:
+        await runtime.shutdown()
+        print("Another daemon started meanwhile; showing its updates instead.")
+        await follow_daemon()
+        return
+    try:
+        daemon.hub.subscribe(print_message)
+        await asyncio.Event().wait()
+    finally:
+        await daemon.stop()
+        await runtime.shutdown()
 
-    print(f"Welcome, {username}! Starting song reporting for {platform_name}...")
-    print("Press Ctrl+C to stop.")
-    
-    last_song_title = None
+def main():
+    """
+    Main loop for the desktop assistant: hosts the detector daemon (see music_daemon.py),
+    or shows what an already running one reports.
+    """
+    import music_daemon
+    try:
+        if music_daemon.daemon_running():
+            print("A MusicFriend daemon is already running; showing its updates. Press Ctrl+C to stop.")
+            asyncio.run(follow_daemon())
+            return
 
-    while True:
-        try:
-            song_info = get_song_function()
-            
-            if song_info:
-                song, artist = song_info
-                current_song_title = f"{song} - {artist}"
+        # --- User Setup at Startup ---
+        username = input("Please enter your username for the listening room: ")
+        if not username:
+            print("Username cannot be empty. Exiting.")
+            return
 
-                if current_song_title != last_song_title:
-                    print(f"New song detected: {current_song_title}")
-                    last_song_title = current_song_title
-                    
-                    try:
-                        payload = {
-                            "user": username,
-                            "song": current_song_title,
-                            "platform": platform_name  # Add platform info
-                        }
-                        response = requests.post(SERVER_URL, json=payload, timeout=5)
-                        
-                        if response.status_code == 200:
-                            print("Successfully sent update to the server.")
-                        else:
-                            print(f"Failed to send update. Server responded with: {response.status_code}")
-                            
-                    except requests.exceptions.RequestException as e:
-                        print(f"Error connecting to the server: {e}")
+        platform_choice = ''
+        while platform_choice not in ['1', '2']:
+            platform_choice = input("Which music platform do you want to detect?\n1: NetEase Cloud Music\n2: Spotify\nEnter 1 or 2: ")
 
-            else:
-                if last_song_title is not None:
-                    print("Playback stopped or music client closed.")
-                    last_song_title = None
-            
-            time.sleep(5)
+        if platform_choice == '1':
+            platform_name = 'netease'
+            print("Selected NetEase Cloud Music.")
+        else:
+            platform_name = 'spotify'
+            # Initialize Spotify client, which may require user browser authorization
+            if not spotify_detector.initialize_spotify():
+                print("Could not initialize Spotify. Please check your credentials and try again.")
+                return
+            print("Selected Spotify.")
 
-        except KeyboardInterrupt:
-            print("\nStopping the assistant. Goodbye!")
-            break
-        except Exception as e:
-            print(f"An unexpected error occurred: {e}")
-            time.sleep(10)
+        print(f"Welcome, {username}! Starting song reporting for {platform_name}...")
+        print("Press Ctrl+C to stop.")
+        asyncio.run(run_daemon(username, platform_name))
+    except KeyboardInterrupt:
+        print("\nStopping the assistant. Goodbye!")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,127 @@
+import bisect
+from collections import OrderedDict
+
+# --- End-to-end latency of track changes ---
+# A client that detects a new track tags its /update_state with a trace_id, plus when it
+# detected and sent the change (server time, via its clock offset estimate). The server notes
+# when the update arrived and was stored; every friend whose screen then shows it reports when
+# the room reached their client and when it was drawn (POST /latency). Each stage feeds its own
+# histogram, so the effect of a transport change shows up in the stage it touched.
+STAGES = (
+    ("detect", "detected_at", "sent_at"),       # detection until the update leaves the sender
+    ("upload", "sent_at", "received_at"),       # network and server queueing
+    ("server", "received_at", "stored_at"),     # request handling until the room changed
+    ("delivery", "stored_at", "delivered_at"),  # until a friend's client has the new room
+    ("render", "delivered_at", "rendered_at"),  # until that client drew it
+    ("total", "detected_at", "rendered_at"),
+)
+SERVER_STAGES = ("detect", "upload", "server")  # known once the update is stored
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+MAX_PENDING_TRACES = 10000
+MAX_REPORTS = 100  # per POST /latency
+# Clock offset estimates are only so good: slightly negative stages count as 0, anything
+# further off (or absurdly long) is discarded rather than skewing the histograms.
+MAX_CLOCK_ERROR = 1.0
+MAX_STAGE_SECONDS = 10 * 60
+
+class LatencyHistogram:
+    """Fixed log-spaced buckets; percentiles are the upper bound of the bucket they fall in."""
+
+    def __init__(self, bounds_ms=BUCKETS_MS):
+        self.bounds_ms = bounds_ms
+        self.counts = [0] * (len(bounds_ms) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(self.bounds_ms, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.bounds_ms[i] if i < len(self.bounds_ms) else round(self.max_ms, 1)
+        return round(self.max_ms, 1)
+
+    def summary(self):
+        buckets = {f"le_{bound}": count for bound, count in zip(self.bounds_ms, self.counts)}
+        buckets["inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 1) if self.count else None,
+            "p50_ms": self.percentile(0.50),
+            "p90_ms": self.percentile(0.90),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max_ms, 1),
+            "buckets": buckets,
+        }
+
+def stage_seconds(times, start, end):
+    """Seconds from `start` to `end` in a dict of timestamps; None if unknown or implausible."""
+    if not isinstance(times.get(start), (int, float)) or not isinstance(times.get(end), (int, float)):
+        return None
+    seconds = times[end] - times[start]
+    if seconds < -MAX_CLOCK_ERROR or seconds > MAX_STAGE_SECONDS:
+        return None
+    return max(0.0, seconds)
+
+class LatencyTracker:
+    """Timestamps of recently stored traces, and one histogram per stage."""
+
+    def __init__(self, max_pending=MAX_PENDING_TRACES):
+        self.max_pending = max_pending
+        self.pending = OrderedDict()  # trace_id -> timestamps, oldest first
+        self.histograms = {stage: LatencyHistogram() for stage, _, _ in STAGES}
+        self.reports = 0
+        self.unknown = 0  # reports for traces that were never stored or already forgotten
+        self.discarded = 0  # stages dropped as implausible (clock error)
+
+    def stored(self, trace_id, detected_at, sent_at, received_at, stored_at):
+        times = {"detected_at": detected_at, "sent_at": sent_at, "received_at": received_at, "stored_at": stored_at}
+        self.pending[trace_id] = times
+        self.pending.move_to_end(trace_id)
+        if len(self.pending) > self.max_pending:
+            self.pending.popitem(last=False)
+        self._observe(times, SERVER_STAGES)
+
+    def report(self, trace_id, delivered_at, rendered_at):
+        """One client showed the traced change; returns False for unknown traces."""
+        times = self.pending.get(trace_id)
+        if times is None:
+            self.unknown += 1
+            return False
+        self.reports += 1
+        self._observe(dict(times, delivered_at=delivered_at, rendered_at=rendered_at),
+                      [stage for stage, _, _ in STAGES if stage not in SERVER_STAGES])
+        return True
+
+    def _observe(self, times, stages):
+        for stage, start, end in STAGES:
+            if stage not in stages or times.get(start) is None or times.get(end) is None:
+                continue
+            seconds = stage_seconds(times, start, end)
+            if seconds is None:
+                self.discarded += 1
+            else:
+                self.histograms[stage].add(seconds * 1000)
+
+    def summary(self):
+        return {
+            "stages": {stage: histogram.summary() for stage, histogram in self.histograms.items()},
+            "pending_traces": len(self.pending),
+            "reports": self.reports,
+            "unknown_traces": self.unknown,
+            "discarded": self.discarded,
+        }
+
+    def reset(self):
+        self.histograms = {stage: LatencyHistogram() for stage, _, _ in STAGES}
+        self.reports = self.unknown = self.discarded = 0
@@ -0,0 +1,331 @@
+import bisect
+import time
+from collections import deque
+
+# --- Ranked counter ---
+class RankedCounter:
+    """
+    Counts keys and keeps them ranked at all times, so top_k(k) costs O(k).
+    Keys live in buckets of equal count; the buckets form a doubly linked list ordered by
+    count, and a +1/-1 only ever moves a key to the neighbouring bucket (the classic
+    "stream-summary" layout).
+    """
+
+    class _Bucket:
+        __slots__ = ("count", "keys", "higher", "lower")
+
+        def __init__(self, count):
+            self.count = count
+            self.keys = {}  # used as an insertion-ordered set
+            self.higher = None
+            self.lower = None
+
+    def __init__(self):
+        self._bucket_of = {}  # key -> _Bucket
+        self._top = None  # bucket with the highest count
+        self._bottom = None  # bucket with the lowest count
+
+    def __len__(self):
+        return len(self._bucket_of)
+
+    def count(self, key):
+        bucket = self._bucket_of.get(key)
+        return bucket.count if bucket else 0
+
+    def increment(self, key):
+        bucket = self._bucket_of.get(key)
+        if bucket is None:
+            # New keys start at 1, which is always the lowest bucket.
+            lowest = self._bottom
+            if lowest is not None and lowest.count == 1:
+                target = lowest
+            else:
+                target = self._Bucket(1)
+                self._link_below(target, lowest)
+        else:
+            target = bucket.higher
+            if target is None or target.count != bucket.count + 1:
+                target = self._Bucket(bucket.count + 1)
+                self._link_above(target, bucket)
+            self._remove_key(key, bucket)
+        target.keys[key] = None
+        self._bucket_of[key] = target
+
+    def decrement(self, key):
+        bucket = self._bucket_of.get(key)
+        if bucket is None:
+            return
+        if bucket.count == 1:
+            self._remove_key(key, bucket)
+            del self._bucket_of[key]
+            return
+        target = bucket.lower
+        if target is None or target.count != bucket.count - 1:
+            target = self._Bucket(bucket.count - 1)
+            self._link_below(target, bucket)
+        self._remove_key(key, bucket)
+        target.keys[key] = None
+        self._bucket_of[key] = target
+
+    def top_k(self, k):
+        """Returns up to k (key, count) pairs, highest count first."""
+        result = []
+        bucket = self._top
+        while bucket is not None and len(result) < k:
+            for key in bucket.keys:
+                result.append((key, bucket.count))
+                if len(result) == k:
+                    break
+            bucket = bucket.lower
+        return result
+
+    def _link_above(self, new, bucket):
+        new.lower = bucket
+        new.higher = bucket.higher
+        if bucket.higher is not None:
+            bucket.higher.lower = new
+        else:
+            self._top = new
+        bucket.higher = new
+
+    def _link_below(self, new, bucket):
+        if bucket is None:
+            # Empty list: the new bucket is both top and bottom.
+            self._top = new
+            self._bottom = new
+            return
+        new.higher = bucket
+        new.lower = bucket.lower
+        if bucket.lower is not None:
+            bucket.lower.higher = new
+        else:
+            self._bottom = new
+        bucket.lower = new
+
+    def _remove_key(self, key, bucket):
+        del bucket.keys[key]
+        if bucket.keys:
+            return
+        if bucket.higher is not None:
+            bucket.higher.lower = bucket.lower
+        else:
+            self._top = bucket.lower
+        if bucket.lower is not None:
+            bucket.lower.higher = bucket.higher
+        else:
+            self._bottom = bucket.higher
+
+class RankedTotals:
+    """
+    Per-key totals that change by arbitrary amounts (so RankedCounter's +1/-1 steps don't
+    apply), kept in a list sorted by total: top_k(k) is a slice, an update is two bisects.
+    """
+
+    def __init__(self):
+        self._totals = {}  # key -> total
+        self._ranked = []  # (-total, key), highest total first
+
+    def __len__(self):
+        return len(self._totals)
+
+    def total(self, key):
+        return self._totals.get(key, 0)
+
+    def add(self, key, amount):
+        """Adds `amount` (may be negative) to key's total; totals that reach zero are dropped."""
+        old = self._totals.get(key)
+        if old is not None:
+            del self._ranked[bisect.bisect_left(self._ranked, (-old, key))]
+        total = (old or 0) + amount
+        if total > 1e-6:
+            self._totals[key] = total
+            bisect.insort(self._ranked, (-total, key))
+        else:
+            self._totals.pop(key, None)
+
+    def top_k(self, k):
+        """Returns up to k (key, total) pairs, highest total first."""
+        return [(key, -total) for total, key in self._ranked[:k]]
+
+# --- Aggregates per room and window ---
+class _RoomAggregates:
+    def __init__(self):
+        self.tracks = RankedCounter()
+        self.artists = RankedCounter()
+        self.listening_time = RankedTotals()  # user -> seconds
+
+class _Window:
+    """Keeps the plays that ended within the last `seconds`, plus their aggregates."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.events = deque()
+        self.rooms = {}
+
+    def add(self, event):
+        self.events.append(event)
+        self._apply(event, +1)
+
+    def evict(self, now, max_events):
+        cutoff = now - self.seconds
+        while self.events and (self.events[0]["end"] < cutoff or len(self.events) > max_events):
+            self._apply(self.events.popleft(), -1)
+
+    def _apply(self, event, sign):
+        room = event["room"]
+        aggregates = self.rooms.get(room)
+        if aggregates is None:
+            aggregates = self.rooms[room] = _RoomAggregates()
+        update = aggregates.tracks.increment if sign > 0 else aggregates.tracks.decrement
+        update(event["song"])
+        update_artist = aggregates.artists.increment if sign > 0 else aggregates.artists.decrement
+        for artist in split_artists(event["song"]):
+            update_artist(artist)
+
+        aggregates.listening_time.add(event["user"], sign * (event["end"] - event["start"]))
+        if not aggregates.listening_time and not aggregates.tracks:
+            del self.rooms[room]
+
+def valid_play(play, fields):
+    """`play` if it is a dict with string user/song, a platform and numeric times, else None."""
+    if not isinstance(play, dict) or not all(field in play for field in fields):
+        return None
+    if not isinstance(play["user"], str) or not isinstance(play["song"], str) or not play["song"]:
+        return None
+    times = [play[field] for field in fields if field in ("start", "end", "last_seen")]
+    if not all(isinstance(t, (int, float)) and not isinstance(t, bool) for t in times):
+        return None
+    return play
+
+def split_artists(song):
+    """Extracts the artists from a "song - artist1, artist2" title."""
+    if not isinstance(song, str) or " - " not in song:
+        return []
+    artists = song.rsplit(" - ", 1)[1]
+    return [a.strip() for a in artists.split(",") if a.strip()]
+
+# --- History store ---
+class ListeningHistory:
+    """
+    Append-only log of finished plays, each a dict with
+    room, user, song, platform, start and end.
+    A play is opened when a user reports a new song and closed when they switch songs,
+    pause, or go inactive. Aggregates for every window are updated as plays close and as
+    they fall out of the window, so queries never rescan the log.
+    """
+
+    def __init__(self, windows, max_events=100000):
+        self.windows = {name: _Window(seconds) for name, seconds in windows.items()}
+        self.max_events = max_events
+        self._open = {}  # (room, user) -> {"song", "platform", "start", "last_seen"}
+
+    def record(self, room, user, song, platform, now=None):
+        """Feeds one state update from a user; opens/closes plays as the song changes."""
+        now = time.time() if now is None else now
+        key = (room, user)
+        current = self._open.get(key)
+        if current and current["song"] == song:
+            current["last_seen"] = now
+            return
+        if current:
+            self._close(key, now)
+        if song:
+            self._open[key] = {"song": song, "platform": platform, "start": now, "last_seen": now}
+
+    def close(self, room, user, now=None):
+        """Ends the user's current play (e.g. they went inactive) at the time they were last seen."""
+        key = (room, user)
+        if key in self._open:
+            self._close(key, self._open[key]["last_seen"] if now is None else now)
+
+    def _close(self, key, end):
+        play = self._open.pop(key)
+        event = {
+            "room": key[0], "user": key[1], "song": play["song"], "platform": play["platform"],
+            "start": play["start"], "end": max(end, play["start"]),
+        }
+        for window in self.windows.values():
+            window.add(event)
+            window.evict(event["end"], self.max_events)
+
+    # --- Handing rooms between nodes (see room_cluster.py) ---
+    def export(self, rooms):
+        """
+        The plays of the given rooms as JSON-ready {room: {"events": [...], "open": [...]}}, for
+        another node's adopt(). Open plays travel open, so the receiver continues them.
+        """
+        rooms = set(rooms)
+        exported = {}
+        # Every window holds a suffix of the longest one's log, so that one has all events.
+        longest = max(self.windows.values(), key=lambda window: window.seconds, default=None)
+        for event in (longest.events if longest is not None else ()):
+            if event["room"] in rooms:
+                exported.setdefault(event["room"], {"events": [], "open": []})["events"].append(dict(event))
+        for (room, user), play in self._open.items():
+            if room in rooms:
+                exported.setdefault(room, {"events": [], "open": []})["open"].append(dict(play, user=user))
+        return exported
+
+    def adopt(self, exported, now=None):
+        """
+        Merges plays from another node's export(). Handoffs are rare, so the windows are simply
+        re-sorted by end time afterwards, which keeps eviction from the front correct.
+        """
+        now = time.time() if now is None else now
+        added = []
+        for room, plays in exported.items():
+            if not isinstance(plays, dict):
+                continue
+            for event in plays.get("events") or []:
+                event = valid_play(event, ("user", "song", "platform", "start", "end"))
+                if event is not None:
+                    added.append({
+                        "room": room, "user": event["user"], "song": event["song"], "platform": event["platform"],
+                        "start": event["start"], "end": max(event["end"], event["start"]),
+                    })
+            for play in plays.get("open") or []:
+                play = valid_play(play, ("user", "song", "platform", "start", "last_seen"))
+                if play is not None and (room, play["user"]) not in self._open:
+                    self._open[(room, play["user"])] = {f: play[f] for f in ("song", "platform", "start", "last_seen")}
+        if not added:
+            return
+        for window in self.windows.values():
+            for event in added:
+                window._apply(event, +1)
+            window.events = deque(sorted(list(window.events) + added, key=lambda event: event["end"]))
+            window.evict(now, self.max_events)
+
+    def room_names(self):
+        """Rooms with an open play or a play in some window."""
+        names = {room for room, _ in self._open}
+        for window in self.windows.values():
+            names.update(window.rooms)
+        return names
+
+    def forget(self, rooms):
+        """Drops all plays of the given rooms (after handing them off), without closing open ones."""
+        rooms = set(rooms)
+        for key in [key for key in self._open if key[0] in rooms]:
+            del self._open[key]
+        for window in self.windows.values():
+            window.events = deque(event for event in window.events if event["room"] not in rooms)
+            for room in rooms:
+                window.rooms.pop(room, None)
+
+    def sizes(self):
+        """Open plays and logged events per window, for memory accounting."""
+        return {"open_plays": len(self._open),
+                "events": {name: len(window.events) for name, window in self.windows.items()}}
+
+    def stats(self, room, window_name, k=10, now=None):
+        """Returns the top-k tracks, artists and listeners (by listening time) for a room and window."""
+        window = self.windows[window_name]
+        window.evict(time.time() if now is None else now, self.max_events)
+        aggregates = window.rooms.get(room)
+        if aggregates is None:
+            return {"top_tracks": [], "top_artists": [], "listening_time": {}}
+        return {
+            "top_tracks": [{"song": s, "plays": n} for s, n in aggregates.tracks.top_k(k)],
+            "top_artists": [{"artist": a, "plays": n} for a, n in aggregates.artists.top_k(k)],
+            "listening_time": {u: round(t, 1) for u, t in aggregates.listening_time.top_k(k)},
+        }
@@ -0,0 +1,211 @@
+import asyncio
+import time
+
+from dbus_next import BusType, Message, MessageType
+from dbus_next.aio import MessageBus
+
+# --- Linux MPRIS detector (event driven) ---
+# Every Linux player worth supporting (Spotify desktop, NetEase for Linux, browsers, mpv...)
+# publishes org.mpris.MediaPlayer2 on the session bus and emits PropertiesChanged whenever the
+# track or playback status changes. Subscribing to those signals replaces polling entirely:
+# nothing runs until a player has something to say, and nothing goes over the network.
+MPRIS_PREFIX = "org.mpris.MediaPlayer2."
+MPRIS_PATH = "/org/mpris/MediaPlayer2"
+PLAYER_INTERFACE = "org.mpris.MediaPlayer2.Player"
+PROPERTIES_INTERFACE = "org.freedesktop.DBus.Properties"
+
+MATCH_RULES = [
+    f"type='signal',interface='{PROPERTIES_INTERFACE}',member='PropertiesChanged',path='{MPRIS_PATH}'",
+    f"type='signal',interface='{PLAYER_INTERFACE}',member='Seeked',path='{MPRIS_PATH}'",
+    "type='signal',sender='org.freedesktop.DBus',interface='org.freedesktop.DBus',"
+    f"member='NameOwnerChanged',arg0namespace='{MPRIS_PREFIX.rstrip('.')}'",
+]
+
+IDLE = {"song": "", "art_url": None}
+
+def unwrap(value):
+    """Variant -> plain Python value (recursively for the metadata dict)."""
+    value = getattr(value, "value", value)
+    if isinstance(value, dict):
+        return {key: unwrap(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [unwrap(item) for item in value]
+    return value
+
+class PlayerState:
+    """What one player last told us."""
+    def __init__(self, name):
+        self.name = name
+        self.status = "Stopped"
+        self.metadata = {}
+        self.position_us = None
+        self.position_at = None  # time.time() when position_us was read
+        self.playing_since = 0.0  # for picking the most recently started player
+
+    def apply(self, changed, now):
+        if "PlaybackStatus" in changed:
+            if changed["PlaybackStatus"] == "Playing" and self.status != "Playing":
+                self.playing_since = now
+            self.status = changed["PlaybackStatus"]
+        if "Metadata" in changed:
+            self.metadata = changed["Metadata"]
+        if "Position" in changed:
+            self.set_position(changed["Position"], now)
+
+    def set_position(self, position_us, now):
+        self.position_us = position_us if isinstance(position_us, int) and position_us >= 0 else None
+        self.position_at = now
+
+    def song_data(self):
+        """The fields the detectors emit (see SongDetectorWorker), or IDLE."""
+        title = self.metadata.get("xesam:title")
+        if self.status != "Playing" or not title:
+            return dict(IDLE)
+        artists = self.metadata.get("xesam:artist") or []
+        if isinstance(artists, str):
+            artists = [artists]
+        art_url = self.metadata.get("mpris:artUrl")
+        album = self.metadata.get("xesam:album")
+        created = self.metadata.get("xesam:contentCreated")  # an ISO 8601 date, if the player knows it
+        data = {
+            "song": f"{title} - {', '.join(artists)}" if artists else title,
+            "title": title,
+            "artist": ', '.join(artists),
+            "album": album if isinstance(album, str) and album else None,
+            "year": created[:4] if isinstance(created, str) and created[:4].isdigit() else None,
+            # file:// covers (e.g. from local players) mean nothing to the other listeners.
+            "art_url": art_url if isinstance(art_url, str) and art_url.startswith(("http://", "https://")) else None,
+            "platform": self.name[len(MPRIS_PREFIX):].split(".")[0].lower(),
+        }
+        length_us = self.metadata.get("mpris:length")
+        if self.position_us is not None:
+            data["progress_ms"] = self.position_us // 1000
+            data["duration_ms"] = length_us // 1000 if isinstance(length_us, int) and length_us > 0 else None
+            data["sampled_at"] = self.position_at
+        return data
+
+class MprisDetector:
+    """
+    Calls on_change(song_data) whenever the active player's track, status or position jumps.
+    The active player is the one that most recently started playing.
+    """
+
+    def __init__(self, on_change):
+        self.on_change = on_change
+        self.bus = None
+        self.players = {}  # well-known name -> PlayerState
+        self.owners = {}  # unique bus name (signal sender) -> well-known name
+        self.last_emitted = None
+
+    async def connect(self):
+        self.bus = await MessageBus(bus_type=BusType.SESSION).connect()
+        self.bus.add_message_handler(self._on_message)
+        for rule in MATCH_RULES:
+            await self._call("org.freedesktop.DBus", "/org/freedesktop/DBus", "org.freedesktop.DBus", "AddMatch", "s", [rule])
+        names = await self._call("org.freedesktop.DBus", "/org/freedesktop/DBus", "org.freedesktop.DBus", "ListNames")
+        for name in names[0] if names else []:
+            if name.startswith(MPRIS_PREFIX):
+                owner = await self._call("org.freedesktop.DBus", "/org/freedesktop/DBus", "org.freedesktop.DBus",
+                                         "GetNameOwner", "s", [name])
+                if owner:
+                    await self._add_player(name, owner[0])
+        self._emit()
+
+    async def run(self):
+        """Connects and then just waits; everything else happens in signal handlers."""
+        await self.connect()
+        try:
+            await self.bus.wait_for_disconnect()
+        finally:
+            self.bus.disconnect()
+
+    def current(self):
+        """Song data of the active player (IDLE if nothing plays)."""
+        playing = [p for p in self.players.values() if p.status == "Playing"]
+        if not playing:
+            return dict(IDLE)
+        return max(playing, key=lambda p: p.playing_since).song_data()
+
+    async def heartbeat(self):
+        """
+        current() with the active player's Position read afresh. Signals only catch jumps, so a
+        heartbeat resending the old sample would go stale once the server stops extrapolating it.
+        """
+        playing = [p for p in self.players.values() if p.status == "Playing"]
+        if playing:
+            player = max(playing, key=lambda p: p.playing_since)
+            await self._read_position(player)
+        self.last_emitted = self.current()
+        return dict(self.last_emitted)
+
+    # --- Players ---
+    async def _add_player(self, name, owner):
+        player = self.players[name] = PlayerState(name)
+        self.owners[owner] = name
+        # One read when a player shows up; from then on its signals keep us current.
+        reply = await self._call(name, MPRIS_PATH, PROPERTIES_INTERFACE, "GetAll", "s", [PLAYER_INTERFACE])
+        if reply:
+            player.apply(unwrap(reply[0]), time.time())
+            if player.status == "Playing":
+                player.playing_since = time.time()
+
+    def _remove_player(self, name):
+        self.players.pop(name, None)
+        for owner in [o for o, n in self.owners.items() if n == name]:
+            del self.owners[owner]
+
+    async def _refresh_position(self, player):
+        # Players don't signal Position (it changes constantly), so read it on every track or
+        # status change and heartbeat; the server extrapolates in between.
+        await self._read_position(player)
+        self._emit()
+
+    async def _read_position(self, player):
+        reply = await self._call(player.name, MPRIS_PATH, PROPERTIES_INTERFACE, "Get", "ss", [PLAYER_INTERFACE, "Position"])
+        player.set_position(unwrap(reply[0]) if reply else None, time.time())
+
+    # --- Signals ---
+    def _on_message(self, message):
+        if message.message_type != MessageType.SIGNAL:
+            return
+        if message.member == "NameOwnerChanged":
+            name, old_owner, new_owner = message.body
+            if old_owner:
+                self._remove_player(name)
+            if new_owner:
+                asyncio.ensure_future(self._added(name, new_owner))
+            else:
+                self._emit()
+            return
+        name = self.owners.get(message.sender)
+        player = self.players.get(name)
+        if player is None:
+            return
+        now = time.time()
+        if message.member == "Seeked":
+            player.set_position(message.body[0], now)
+            self._emit()
+        elif message.member == "PropertiesChanged" and message.body[0] == PLAYER_INTERFACE:
+            changed = unwrap(message.body[1])
+            player.apply(changed, now)
+            if ("Metadata" in changed or "PlaybackStatus" in changed) and "Position" not in changed:
+                asyncio.ensure_future(self._refresh_position(player))
+            else:
+                self._emit()
+
+    async def _added(self, name, owner):
+        await self._add_player(name, owner)
+        self._emit()
+
+    def _emit(self):
+        data = self.current()
+        if data != self.last_emitted:
+            self.last_emitted = data
+            self.on_change(dict(data))
+
+    async def _call(self, destination, path, interface, member, signature="", body=None):
+        reply = await self.bus.call(Message(destination=destination, path=path, interface=interface,
+                                            member=member, signature=signature, body=body or []))
+        if reply is None or reply.message_type == MessageType.ERROR:
+            return None
+        return reply.body
@@ -0,0 +1,468 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import time
+import uuid
+from collections import OrderedDict
+
+import aiohttp
+from aiohttp import web
+
+import album_art
+import startup_profiler
+from async_core import AsyncRuntime
+from clock_sync import ClockOffsetEstimator
+from update_outbox import UpdateOutbox, RetryLater
+
+# Platform backends (spotify_detector / netease_api_utils / desktop_assistant / mpris_detector)
+# are imported lazily in SongDetector, once a platform has been picked.
+
+# --- Local detector daemon ---
+# One process per machine owns detection (Spotify, NetEase or MPRIS), album art lookup and the
+# server sync (update outbox + /get_state long-poll), and publishes the results to any number of
+# local UIs over a WebSocket on localhost. Running two UIs no longer doubles the API calls, and
+# a UI that starts while the daemon runs gets the room from its cache without any setup.
+# Whichever process starts first hosts it: `python music_daemon.py --user rex --platform spotify`
+# runs it headless, and a UI that finds no daemon runs one in-process (see DaemonSubscriber in
+# pure_desktop_app.py).
+#
+# Messages are JSON objects with a "type"; the newest of each type is replayed on subscribe:
+#   {"type": "hello", "user", "platform"}      who the daemon reports as
+#   {"type": "song", "data": {...}}            the local detection: the /update_state fields plus
+#                                              title, artist, album and year, resolved once per track
+#   {"type": "room", "state": {...}, "version", "received_at", "clock_offset"}
+#                                              the room, as returned by /get_state, when it
+#                                              arrived (local time) and local -> server offset
+#   {"type": "health", "status": "..."}        the connection to the server
+BASE_URL = "https://listeningtogether.onrender.com/"
+UPDATE_URL = f"{BASE_URL}update_state"
+GET_URL = f"{BASE_URL}get_state"
+LATENCY_URL = f"{BASE_URL}latency"
+# /get_state long-poll: the server holds the request until the room changes or this many seconds pass.
+LONG_POLL_WAIT = 25
+MIN_POLL_INTERVAL = 1
+DETECT_INTERVAL = 5
+# Delivery/render times of friends' traced track changes are sent in batches this often.
+LATENCY_REPORT_INTERVAL = 10
+
+# MPRIS reports changes as they happen; the current state is only re-sent this often so the
+# server (INACTIVE_THRESHOLD = 30 s) keeps us in the room.
+PRESENCE_INTERVAL = 10
+
+DAEMON_HOST = "127.0.0.1"
+DAEMON_PORT = int(os.environ.get("MUSICFRIEND_DAEMON_PORT", "47615"))
+DAEMON_URL = f"http://{DAEMON_HOST}:{DAEMON_PORT}/ws"
+SUBSCRIBER_QUEUE = 16  # messages buffered per slow subscriber before the oldest are dropped
+
+# Network errors the async workers recover from
+NETWORK_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+# --- Detection and server sync ---
+class SongDetector:
+    """Calls on_song(song_data) every DETECT_INTERVAL (or on every MPRIS change)."""
+
+    def __init__(self, runtime, platform, on_song, art_size=album_art.SEAT_ART_SIZE):
+        self.runtime = runtime
+        self.platform = platform
+        self.on_song = on_song
+        self.art_size = art_size
+        self.last_song_title = None
+        self.current_metadata = None # To cache art url, album and year for the same song
+
+    def _load_backend(self):
+        """Imports only the detector the chosen platform needs (spotipy, pyncm + pywin32 or dbus-next)."""
+        if self.platform == 'mpris':
+            with startup_profiler.timed("import mpris_detector"):
+                import mpris_detector
+            self.mpris_detector = mpris_detector
+        elif self.platform == 'spotify':
+            with startup_profiler.timed("import spotify_detector"):
+                import spotify_detector
+            spotify_detector.initialize_spotify()
+            self.spotify_detector = spotify_detector
+        else:
+            with startup_profiler.timed("import netease backend"):
+                import netease_api_utils
+                from desktop_assistant import get_current_netease_song
+            self.netease_api_utils = netease_api_utils
+            self.get_current_netease_song = get_current_netease_song
+
+    def _detect_once(self):
+        """One blocking detection pass; runs on the runtime's thread pool."""
+        song_data = {"song": "", "art_url": None}
+        if self.platform == 'spotify':
+            playback = self.spotify_detector.get_current_spotify_playback(self.art_size)
+            if playback:
+                song_data = {
+                    "song": f"{playback['song']} - {playback['artist']}",
+                    "title": playback["song"],
+                    "artist": playback["artist"],
+                    "album": playback.get("album"),
+                    "year": playback.get("release_year"),
+                    "art_url": playback["art_url"],
+                    "progress_ms": playback["progress_ms"],
+                    "duration_ms": playback["duration_ms"],
+                    "sampled_at": playback["sampled_at"],
+                }
+        else: # netease
+            song_info = self.get_current_netease_song()
+            if song_info:
+                song, artist = song_info
+                current_song_title = f"{song} - {artist}"
+                if current_song_title != self.last_song_title:
+                    self.last_song_title = current_song_title
+                    self.current_metadata = self.netease_api_utils.get_netease_track_metadata(song, artist, self.art_size)
+                song_data = {"song": current_song_title, "title": song, "artist": artist, **self.current_metadata}
+            else:
+                self.last_song_title = None
+                self.current_metadata = None
+        return song_data
+
+    async def run(self):
+        await self.runtime.run_blocking(self._load_backend)
+        if self.platform == 'mpris':
+            await self._run_mpris()
+            return
+        startup_profiler.report()
+        while True:
+            song_data = await self.runtime.run_blocking(self._detect_once)
+            self.on_song(song_data)
+            await asyncio.sleep(DETECT_INTERVAL)
+
+    async def _run_mpris(self):
+        """Linux: players push their changes over D-Bus, so there is nothing to poll."""
+        detector = self.mpris_detector.MprisDetector(self.on_song)
+        await detector.connect()
+        startup_profiler.report()
+        try:
+            while True:
+                await asyncio.sleep(PRESENCE_INTERVAL)
+                self.on_song(await detector.heartbeat())
+        finally:
+            detector.bus.disconnect()
+
+class StateUpdater:
+    """Posts the newest detected state to /update_state through an UpdateOutbox."""
+
+    def __init__(self, runtime, username, platform, on_health=None):
+        self.runtime = runtime
+        self.username = username
+        self.platform = platform
+        self.clock = ClockOffsetEstimator()
+        # Only the newest detected state is kept while the server is slow or unreachable.
+        self.outbox = UpdateOutbox(self.send, on_health=on_health)
+        self.last_song = None
+        self.trace = {"trace_id": None, "detected_at": None}
+
+    def update_song(self, song_data):
+        # A track change starts a latency trace; the heartbeats that follow carry the same id.
+        if song_data.get("song") != self.last_song:
+            self.last_song = song_data.get("song")
+            self.trace = {"trace_id": uuid.uuid4().hex[:16], "detected_at": song_data.get("detected_at", time.time())}
+        # Every field is always set, so a state without progress clears the previous song's.
+        self.outbox.put({
+            **self.trace,
+            "song": song_data.get("song"),
+            "art_url": song_data.get("art_url"),
+            "platform": song_data.get("platform"),
+            "progress_ms": song_data.get("progress_ms"),
+            "duration_ms": song_data.get("duration_ms"),
+            "sampled_at": song_data.get("sampled_at"),
+        })
+
+    async def run(self):
+        await self.outbox.run()
+
+    async def send(self, song_data):
+        """Sends one state; raises on failure so the outbox can retry it."""
+        try:
+            payload = {
+                "user": self.username,
+                "song": song_data.get("song"),
+                # MPRIS names the actual player (spotify, chromium, ...); other detectors don't.
+                "platform": song_data.get("platform") or self.platform,
+                "art_url": song_data.get("art_url")
+            }
+            if song_data.get("progress_ms") is not None:
+                payload["progress_ms"] = song_data["progress_ms"]
+                payload["duration_ms"] = song_data.get("duration_ms")
+                payload["sampled_at"] = self.clock.to_server_time(song_data["sampled_at"])
+            t0 = time.time()
+            if song_data.get("trace_id"):
+                payload["trace_id"] = song_data["trace_id"]
+                payload["detected_at"] = self.clock.to_server_time(song_data["detected_at"])
+                payload["sent_at"] = self.clock.to_server_time(t0)
+            body = await self.runtime.post_json(UPDATE_URL, payload)
+            t3 = time.time()
+            self._add_clock_sample(body, t0, t3)
+        except aiohttp.ClientResponseError as e:
+            print(f"Update failed: {e}")
+            if e.status == 429:
+                retry_after = (e.headers or {}).get("Retry-After", "5")
+                raise RetryLater(float(retry_after) if retry_after.isdigit() else 5.0)
+            raise
+        except NETWORK_ERRORS as e:
+            print(f"Update failed: {e}")
+            raise
+
+    def _add_clock_sample(self, body, t0, t3):
+        # Every update doubles as a clock offset exchange, so no extra requests are needed.
+        try:
+            self.clock.add_sample(t0, body["received_at"], body["server_time"], t3)
+        except (KeyError, TypeError):
+            pass
+
+class StateFetcher:
+    """Long-polls /get_state and calls on_state(room_state, version, received_at) on every change."""
+
+    def __init__(self, runtime, on_state):
+        self.runtime = runtime
+        self.on_state = on_state
+
+    async def run(self):
+        version = None
+        while True:
+            started = time.monotonic()
+            params = {} if version is None else {"since": version, "wait": LONG_POLL_WAIT}
+            try:
+                state, headers = await self.runtime.get_json_with_headers(
+                    GET_URL, params=params, timeout=aiohttp.ClientTimeout(total=LONG_POLL_WAIT + 5))
+                version = headers.get("X-Room-Version")
+                self.on_state(state, version, time.time())
+            except NETWORK_ERRORS as e:
+                print(f"Fetch failed: {e}")
+                version = None
+                await asyncio.sleep(5)
+                continue
+            if version is None:
+                await asyncio.sleep(5)  # Server without long-poll support: plain polling
+            else:
+                # Re-poll right away, but never spin if the room changes constantly.
+                await asyncio.sleep(max(0, MIN_POLL_INTERVAL - (time.monotonic() - started)))
+
+# --- Publishing to local UIs ---
+class LocalHub:
+    """
+    Fans messages out to in-process listeners (subscribe) and to WebSocket clients at /ws.
+    A slow client only ever misses old messages: its queue drops the oldest when full.
+    """
+
+    def __init__(self):
+        self.latest = {}  # message type -> newest message, replayed to every new subscriber
+        self.listeners = set()
+        self._queues = set()  # one per connected WebSocket
+        self._runner = None
+
+    def subscribe(self, listener):
+        for message in self.latest.values():
+            listener(message)
+        self.listeners.add(listener)
+
+    def publish(self, message):
+        self.latest[message["type"]] = message
+        for listener in list(self.listeners):
+            listener(message)
+        for queue in self._queues:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
+
+    async def start(self, host=DAEMON_HOST, port=DAEMON_PORT):
+        """Starts serving; raises OSError when the port is taken (another daemon runs)."""
+        app = web.Application()
+        app.router.add_get("/ws", self._handle_ws)
+        app.router.add_get("/state", self._handle_state)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        try:
+            await web.TCPSite(self._runner, host, port).start()
+        except OSError:
+            await self._runner.cleanup()
+            self._runner = None
+            raise
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _forbidden(self, request):
+        # Browsers always send Origin; native subscribers don't. This keeps web pages from
+        # reading what the user listens to through the localhost port.
+        return request.headers.get("Origin") is not None
+
+    async def _handle_state(self, request):
+        if self._forbidden(request):
+            return web.json_response({"status": "error", "message": "Forbidden"}, status=403)
+        return web.json_response(self.latest)
+
+    async def _handle_ws(self, request):
+        if self._forbidden(request):
+            return web.json_response({"status": "error", "message": "Forbidden"}, status=403)
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE)
+        for message in self.latest.values():
+            queue.put_nowait(message)
+        self._queues.add(queue)
+        sender = asyncio.ensure_future(self._send_loop(ws, queue))
+        try:
+            async for _ in ws:
+                pass  # Subscribers don't talk back; this only notices them leaving
+        finally:
+            self._queues.discard(queue)
+            sender.cancel()
+        return ws
+
+    async def _send_loop(self, ws, queue):
+        while True:
+            message = await queue.get()
+            try:
+                await ws.send_str(json.dumps(message))
+            except ConnectionError:
+                return
+
+class MusicDaemon:
+    """Detection, server sync and the local hub on one asyncio loop (standalone or inside a UI)."""
+
+    def __init__(self, runtime, username, platform, art_size=album_art.SEAT_ART_SIZE):
+        self.runtime = runtime
+        self.username = username
+        self.platform = platform
+        self.hub = LocalHub()
+        self.detector = SongDetector(runtime, platform, self._on_song, art_size)
+        self.updater = StateUpdater(runtime, username, platform, self._on_health)
+        self.fetcher = StateFetcher(runtime, self._on_room)
+        self._tasks = []
+
+    async def start(self, host=DAEMON_HOST, port=DAEMON_PORT):
+        """Claims the port first (OSError if another daemon has it), then starts the workers."""
+        await self.hub.start(host, port)
+        self.hub.publish({"type": "hello", "user": self.username, "platform": self.platform})
+        self._tasks = [
+            self.runtime.spawn(self.detector.run(), name="detector"),
+            self.runtime.spawn(self.updater.run(), name="updater"),
+            self.runtime.spawn(self.fetcher.run(), name="fetcher"),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.hub.stop()
+
+    def _on_song(self, song_data):
+        song_data = dict(song_data, detected_at=time.time())
+        self.updater.update_song(song_data)
+        self.hub.publish({"type": "song", "data": song_data})
+
+    def _on_health(self, status):
+        self.hub.publish({"type": "health", "status": status})
+
+    def _on_room(self, state, version, received_at):
+        self.hub.publish({"type": "room", "state": state, "version": version,
+                          "received_at": received_at, "clock_offset": self.updater.clock.offset})
+
+class LatencyReporter:
+    """
+    Reports when friends' traced track changes reached this machine and were drawn (see
+    latency_stats.py on the server). delivered(message) is fed every room message and
+    rendered(room_state) every drawn state; run() posts what was collected.
+    """
+
+    def __init__(self, runtime, own_user=None, max_traces=1000):
+        self.runtime = runtime
+        self.own_user = own_user
+        self.max_traces = max_traces
+        self.first_seen = OrderedDict()  # trace_id -> local time it arrived, None once reported
+        self.clock_offset = None
+        self.reports = []
+
+    def delivered(self, message):
+        self.clock_offset = message.get("clock_offset")
+        for user, data in message["state"].items():
+            trace_id = data.get("trace_id")
+            if trace_id and user != self.own_user and trace_id not in self.first_seen:
+                self.first_seen[trace_id] = message.get("received_at")
+                if len(self.first_seen) > self.max_traces:
+                    self.first_seen.popitem(last=False)
+
+    def rendered(self, room_state):
+        if self.clock_offset is None:
+            return  # No server time yet, so nothing comparable to report
+        rendered_at = time.time() + self.clock_offset
+        for data in room_state.values():
+            trace_id = data.get("trace_id")
+            delivered_at = self.first_seen.get(trace_id)
+            if delivered_at is None:
+                continue
+            self.first_seen[trace_id] = None
+            self.reports.append({"trace_id": trace_id, "delivered_at": delivered_at + self.clock_offset,
+                                 "rendered_at": rendered_at})
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(LATENCY_REPORT_INTERVAL)
+            if not self.reports:
+                continue
+            reports, self.reports = self.reports, []
+            try:
+                await self.runtime.post_json(LATENCY_URL, {"reports": reports})
+            except NETWORK_ERRORS as e:
+                print(f"Latency report failed: {e}")  # Measurements only; not worth retrying
+
+# --- Subscribing ---
+def daemon_running(host=DAEMON_HOST, port=DAEMON_PORT, timeout=0.3):
+    """Whether something listens on the daemon port (a quick, blocking localhost check)."""
+    try:
+        socket.create_connection((host, port), timeout=timeout).close()
+        return True
+    except OSError:
+        return False
+
+async def follow(on_message, url=DAEMON_URL):
+    """Calls on_message(message) for everything a running daemon publishes; returns when it goes away."""
+    async with aiohttp.ClientSession() as session:
+        async with session.ws_connect(url, heartbeat=30) as ws:
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    on_message(json.loads(msg.data))
+
+async def main():
+    parser = argparse.ArgumentParser(description="Detect what this machine plays, sync it and serve it to local UIs.")
+    parser.add_argument("--user", required=True, help="nickname in the listening room")
+    parser.add_argument("--platform", choices=["spotify", "netease", "mpris"], required=True)
+    parser.add_argument("--port", type=int, default=DAEMON_PORT)
+    args = parser.parse_args()
+    runtime = AsyncRuntime(asyncio.get_running_loop())
+    await runtime.start()
+    daemon = MusicDaemon(runtime, args.user, args.platform)
+    try:
+        await daemon.start(port=args.port)
+    except OSError:
+        print(f"Daemon: Port {args.port} is taken; is another daemon running?")
+        await runtime.shutdown()
+        return
+    last_song = None
+    def log(message):
+        nonlocal last_song
+        if message["type"] == "health":
+            print(f"Daemon: {message['status']}")
+        elif message["type"] == "song" and message["data"].get("song") != last_song:
+            last_song = message["data"].get("song")
+            print(f"Daemon: Now playing {last_song or 'nothing'}")
+    daemon.hub.subscribe(log)
+    print(f"Daemon: Serving ws://{DAEMON_HOST}:{args.port}/ws as '{args.user}' ({args.platform}). Ctrl+C stops.")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await daemon.stop()
+        await runtime.shutdown()
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -1,17 +1,47 @@
 # Use the correct library name and functions
+import datetime
+from collections import OrderedDict
 from pyncm import apis
+import album_art
+from track_index import canonical_track_key
 
-def get_netease_album_art_url(song_name, artist_name):
+# Track metadata by canonical track key, so "Song (Live)" and "Song" share one lookup
+METADATA_CACHE_SIZE = 256
+_metadata_cache = OrderedDict()
+NO_METADATA = {"art_url": None, "album": None, "year": None}
+
+def get_netease_track_metadata(song_name, artist_name, size=None):
     """
-    Searches for a song on NetEase Cloud Music and returns the album art URL.
+    Searches for a song on NetEase Cloud Music and returns what the UIs show besides its name.
     
     Args:
         song_name (str): The name of the song.
         artist_name (str): The name of the artist.
+        size (int): Optional edge length in pixels; art_url is then a NetEase thumbnail of that size.
         
     Returns:
-        str: The URL of the album art, or None if not found.
+        dict: {"art_url", "album", "year"}, each None if not found.
     """
+    cache_key = canonical_track_key(song_name, artist_name)
+    if cache_key in _metadata_cache:
+        _metadata_cache.move_to_end(cache_key)
+        metadata = _metadata_cache[cache_key]
+    else:
+        metadata = _search_track_metadata(song_name, artist_name)
+        if metadata:
+            _metadata_cache[cache_key] = metadata
+            if len(_metadata_cache) > METADATA_CACHE_SIZE:
+                _metadata_cache.popitem(last=False)
+    metadata = dict(metadata or NO_METADATA)
+    if metadata["art_url"] and size:
+        metadata["art_url"] = album_art.sized_url(metadata["art_url"], size)
+    return metadata
+
+def get_netease_album_art_url(song_name, artist_name, size=None):
+    """The album art URL of a song (see get_netease_track_metadata), or None if not found."""
+    return get_netease_track_metadata(song_name, artist_name, size)["art_url"]
+
+def _search_track_metadata(song_name, artist_name):
     query = f"{song_name} {artist_name}"
     print(f"Netease API: Searching for '{query}'...")
     
@@ -22,16 +52,19 @@ def get_netease_album_art_url(song_name, artist_name):
         if search_result and search_result.get('result', {}).get('songs'):
             first_song = search_result['result']['songs'][0]
             
+            album = first_song.get('al') or {}
             # The album art URL is in the 'al' (album) dictionary under 'picUrl'
-            if 'al' in first_song and 'picUrl' in first_song['al']:
-                art_url = first_song['al']['picUrl']
-                # Netease sometimes returns http links, let's upgrade them to https for safety
-                if art_url.startswith('http://'):
-                    art_url = art_url.replace('http://', 'https://', 1)
-                print(f"Netease API: Found album art URL: {art_url}")
-                return art_url
+            art_url = album.get('picUrl')
+            # Netease sometimes returns http links, let's upgrade them to https for safety
+            if art_url and art_url.startswith('http://'):
+                art_url = art_url.replace('http://', 'https://', 1)
+            # publishTime is in milliseconds; 0 means NetEase doesn't know it
+            publish_time = first_song.get('publishTime')
+            year = datetime.datetime.fromtimestamp(publish_time / 1000).strftime('%Y') if publish_time else None
+            print(f"Netease API: Found '{first_song.get('name')}', album art URL: {art_url}")
+            return {"art_url": art_url, "album": album.get('name'), "year": year}
         
-        print("Netease API: No songs or album art found for the query.")
+        print("Netease API: No songs found for the query.")
         return None
             
     except Exception as e:
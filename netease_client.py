@@ -1,7 +1,20 @@
 import pyncm
 from pyncm.apis import cloudsearch, album
 import datetime
+import time
+import requests
 import win32gui
+import album_art
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# --- Metadata pipeline ---
+# After the search returns, the album lookup and the cover download run side by side.
+# Album info is cached by album id, since many tracks share an album.
+COVER_SIZE = 200
+ALBUM_CACHE_SIZE = 256
+_album_info_cache = OrderedDict()
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="netease")
 
 def get_current_netease_song():
     """
@@ -25,33 +38,69 @@ def get_current_netease_song():
         print(f"Error getting current song: {e}")
         return None, "An error occurred while detecting the song."
 
+def get_album_info(album_id):
+    """Returns pyncm's GetAlbumInfo result, cached by album id."""
+    if album_id in _album_info_cache:
+        _album_info_cache.move_to_end(album_id)
+        return _album_info_cache[album_id]
+    album_info = album.GetAlbumInfo(album_id)
+    if album_info:
+        _album_info_cache[album_id] = album_info
+        if len(_album_info_cache) > ALBUM_CACHE_SIZE:
+            _album_info_cache.popitem(last=False)
+    return album_info
+
+def download_cover(cover_url):
+    """Downloads the cover image and returns its bytes."""
+    response = requests.get(cover_url, timeout=5)
+    response.raise_for_status()
+    return response.content
+
+def _timed(timings, stage, func, *args):
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        timings[stage] = round((time.perf_counter() - start) * 1000, 1)
+
 def get_track_info(song_name, artist_name):
     """
     Searches for a track and returns a dictionary with its detailed information,
     including the album cover URL.
+    The dictionary also carries 'cover_future', a future resolving to the cover image bytes
+    (downloaded while the album info was being looked up), and 'timings' in milliseconds
+    for each stage: search, album_info, cover (filled in when the download finishes) and total.
     """
     keywords = f"{song_name} {artist_name}"
+    timings = {}
+    start = time.perf_counter()
     try:
-        search_results = cloudsearch.GetSearchResult(keywords, limit=1, stype=1)
+        search_results = _timed(timings, "search", lambda: cloudsearch.GetSearchResult(keywords, limit=1, stype=1))
         
         if not search_results or not search_results['result']['songs']:
             return None, f"Could not find '{song_name}' by {artist_name}."
 
         track = search_results['result']['songs'][0]
-        
+        cover_url = album_art.sized_url(track['al']['picUrl'], COVER_SIZE) # Request a 200x200 image
+
+        # Start the cover download right away; it doesn't depend on the album info.
+        cover_future = _executor.submit(_timed, timings, "cover", download_cover, cover_url)
         album_id = track['al']['id']
-        album_info = album.GetAlbumInfo(album_id)
+        album_info = _timed(timings, "album_info", get_album_info, album_id)
         release_year = "an unknown year"
         if album_info and 'album' in album_info and 'publishTime' in album_info['album']:
             publish_time = album_info['album']['publishTime'] / 1000
             release_year = datetime.datetime.fromtimestamp(publish_time).strftime('%Y')
+        timings["total"] = round((time.perf_counter() - start) * 1000, 1)
 
         track_details = {
             "name": track['name'],
             "artist": ', '.join(artist['name'] for artist in track['ar']),
             "album": track['al']['name'],
             "release_year": release_year,
-            "cover_url": track['al']['picUrl'] + "?param=200y200" # Request a 200x200 image
+            "cover_url": cover_url,
+            "cover_future": cover_future,
+            "timings": timings,
         }
         
         return track_details, None
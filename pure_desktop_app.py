@@ -1,45 +1,36 @@
+import startup_profiler # Imported first so the startup clock starts early
 import sys
 import time
-import requests
-import certifi
-from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QGridLayout, 
-                               QLabel, QVBoxLayout, QDialog, QLineEdit, 
-                               QGroupBox, QRadioButton, QDialogButtonBox, QHBoxLayout) # Add QHBoxLayout
-from PySide6.QtCore import QThread, QObject, Signal, Slot, Qt
-from PySide6.QtGui import QPixmap, QImage
-from urllib.request import urlopen
+import asyncio
+with startup_profiler.timed("import PySide6"):
+    from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QGridLayout, 
+                                   QLabel, QVBoxLayout, QDialog, QLineEdit, 
+                                   QGroupBox, QRadioButton, QDialogButtonBox, QHBoxLayout) # Add QHBoxLayout
+    from PySide6.QtCore import QObject, Signal, Slot, Qt, QTimer
+    from PySide6.QtGui import QPixmap, QImage
+with startup_profiler.timed("import qasync/aiohttp"):
+    import aiohttp
+    import qasync
+from async_core import AsyncRuntime
+import album_art
+import music_daemon
+from ui_scheduler import RenderScheduler
 
-# Import detector logic
-import spotify_detector
-import netease_api_utils
-from desktop_assistant import get_current_netease_song
+# Detection and the server sync live in music_daemon: this window either subscribes to a
+# daemon that is already running, or runs one in-process that other UIs can subscribe to.
 
-# --- Configuration ---
-BASE_URL = "https://listeningtogether.onrender.com/"
-UPDATE_URL = f"{BASE_URL}update_state"
-GET_URL = f"{BASE_URL}get_state"
+# Network errors the async workers recover from
+NETWORK_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
 
-# --- Image Downloader (Unchanged) ---
-class ImageDownloader(QObject):
-    image_ready = Signal(QPixmap)
-    def __init__(self, url):
-        super().__init__()
-        self.url = url
-    @Slot()
-    def run(self):
-        try:
-            data = urlopen(self.url).read()
-            image = QImage()
-            image.loadFromData(data)
-            pixmap = QPixmap.fromImage(image)
-            self.image_ready.emit(pixmap)
-        except Exception as e:
-            print(f"Image download failed: {e}")
+def format_ms(ms):
+    seconds = int(ms // 1000)
+    return f"{seconds // 60}:{seconds % 60:02d}"
 
 # --- UI Components (Unchanged) ---
 class SeatWidget(QWidget):
-    def __init__(self, parent=None):
+    def __init__(self, runtime, parent=None):
         super().__init__(parent)
+        self.runtime = runtime
         self.setFixedSize(220, 100)
         self.setStyleSheet("""
             SeatWidget { background-color: #40444b; border-radius: 10px; border: 2px solid #40444b; }
@@ -55,162 +46,207 @@ class SeatWidget(QWidget):
         self.user_label = QLabel("Empty Seat")
         self.song_label = QLabel("...")
         self.song_label.setWordWrap(True)
+        self.progress_label = QLabel("")
+        self.progress_label.setStyleSheet("color: #aaa;")
         text_layout.addWidget(self.user_label)
         text_layout.addWidget(self.song_label)
+        text_layout.addWidget(self.progress_label)
         text_layout.addStretch()
         main_layout.addWidget(self.album_art_label)
         main_layout.addLayout(text_layout)
         self.setProperty("occupied", False)
         self.current_art_url = None
-        self.downloader_thread = None
+        self.art_task = None
+        self.position_ms = None
+        self.duration_ms = None
+        self.position_received = 0
 
-    def update_seat(self, user, song, platform, art_url):
+    def update_seat(self, user, song, platform, art_url, position_ms=None, duration_ms=None):
+        was_occupied = self.property("occupied")
         self.setProperty("occupied", True)
         icon = '🟢' if platform == 'spotify' else '🎵'
         self.user_label.setText(f"{icon} {user}")
         self.song_label.setText(song if song else "Playback Paused")
-        self.style().polish(self)
+        self.set_position(position_ms if song else None, duration_ms)
+        # Re-polishing re-resolves the whole stylesheet; only needed when [occupied] flips.
+        if not was_occupied:
+            self.style().polish(self)
+        # Ask the CDN for a seat-sized variant instead of the full-size cover.
+        art_url = album_art.sized_url(art_url, round(album_art.SEAT_ART_SIZE * self.devicePixelRatioF()))
         if art_url and art_url != self.current_art_url:
             self.current_art_url = art_url
             self.album_art_label.setText("...")
-            self.downloader = ImageDownloader(art_url)
-            self.downloader_thread = QThread()
-            self.downloader.moveToThread(self.downloader_thread)
-            self.downloader.image_ready.connect(self.set_album_art)
-            self.downloader_thread.started.connect(self.downloader.run)
-            self.downloader_thread.start()
+            self._cancel_art_download()
+            self.art_task = self.runtime.spawn(self._download_art(art_url), name="art")
         elif not art_url:
             self.set_default_art()
 
+    async def _download_art(self, url):
+        try:
+            data = await self.runtime.get_bytes(url)
+        except NETWORK_ERRORS as e:
+            print(f"Image download failed: {e}")
+            return
+        image = QImage()
+        if image.loadFromData(data):
+            self.set_album_art(QPixmap.fromImage(image))
+
+    def _cancel_art_download(self):
+        # A seat only ever shows one cover, so a newer URL supersedes any download in flight.
+        if self.art_task is not None:
+            self.art_task.cancel()
+            self.art_task = None
+
     def set_album_art(self, pixmap):
         self.album_art_label.setPixmap(pixmap.scaled(80, 80, Qt.KeepAspectRatio, Qt.SmoothTransformation))
-        if self.downloader_thread:
-            self.downloader_thread.quit()
-            self.downloader_thread.wait()
 
     def set_default_art(self):
+        self._cancel_art_download()
         self.current_art_url = None
         self.album_art_label.setText("🎵")
         self.album_art_label.setFont(self.font())
 
+    def set_position(self, position_ms, duration_ms):
+        # The server already extrapolated the position; keep advancing it locally between polls.
+        self.position_ms = position_ms
+        self.duration_ms = duration_ms
+        self.position_received = time.monotonic()
+        self.refresh_progress()
+
+    def refresh_progress(self):
+        if self.position_ms is None:
+            self.progress_label.setText("")
+            return
+        position = self.position_ms + (time.monotonic() - self.position_received) * 1000
+        if self.duration_ms:
+            position = min(position, self.duration_ms)
+            self.progress_label.setText(f"{format_ms(position)} / {format_ms(self.duration_ms)}")
+        else:
+            self.progress_label.setText(format_ms(position))
+
     def set_empty(self):
+        was_occupied = self.property("occupied")
         self.setProperty("occupied", False)
         self.user_label.setText("Empty Seat")
         self.song_label.setText("...")
+        self.set_position(None, None)
         self.set_default_art()
-        self.style().polish(self)
-
-# --- Logic Components (Unchanged) ---
-class SongDetectorWorker(QObject):
-    song_detected = Signal(dict)
-    def __init__(self, platform):
-        super().__init__()
-        self.platform = platform
-        self._is_running = True
-    def run(self):
-        last_song_title = None
-        current_art_url = None # To cache the art url for the same song
-        while self._is_running:
-            song_data = {"song": "", "art_url": None}
-            if self.platform == 'spotify':
-                song_info = spotify_detector.get_current_spotify_song()
-                if song_info:
-                    song, artist, art_url = song_info
-                    song_data = {"song": f"{song} - {artist}", "art_url": art_url}
-            else: # netease
-                song_info = get_current_netease_song()
-                if song_info:
-                    song, artist = song_info
-                    current_song_title = f"{song} - {artist}"
-                    if current_song_title != last_song_title:
-                        last_song_title = current_song_title
-                        current_art_url = netease_api_utils.get_netease_album_art_url(song, artist)
-                    song_data = {"song": current_song_title, "art_url": current_art_url}
-                else:
-                    last_song_title = None
-                    current_art_url = None
-            
-            self.song_detected.emit(song_data)
-            time.sleep(5)
-    def stop(self): self._is_running = False
+        if was_occupied:
+            self.style().polish(self)
 
-class StateUpdaterWorker(QObject):
-    def __init__(self, username, platform):
-        super().__init__()
-        self.username = username
-        self.platform = platform
-    @Slot(dict)
-    def update_song(self, song_data):
-        try:
-            payload = {
-                "user": self.username,
-                "song": song_data.get("song"),
-                "platform": self.platform,
-                "art_url": song_data.get("art_url")
-            }
-            requests.post(UPDATE_URL, json=payload, timeout=5, verify=certifi.where())
-        except requests.RequestException as e:
-            print(f"Update failed: {e}")
-
-class StateFetcherWorker(QObject):
+# --- Logic Components (async tasks on the Qt event loop) ---
+class DaemonSubscriber(QObject):
+    """
+    Feeds the window from music_daemon. With a username it first tries to host the daemon
+    in-process; if another process already has the port (or nobody should host), it follows
+    that daemon over its socket. When the followed daemon goes away, it takes over as the
+    user the daemon reported as.
+    """
     state_updated = Signal(dict)
-    def __init__(self):
+    health_changed = Signal(str)
+    def __init__(self, runtime, art_size=album_art.SEAT_ART_SIZE):
         super().__init__()
-        self._is_running = True
-    def run(self):
-        while self._is_running:
+        self.runtime = runtime
+        self.art_size = art_size
+        self.identity = None # (user, platform) from the daemon's hello
+        self.latency = music_daemon.LatencyReporter(runtime)
+    def on_message(self, message):
+        kind = message.get("type")
+        if kind == "room":
+            self.latency.delivered(message)
+            self.state_updated.emit(message["state"])
+        elif kind == "health":
+            self.health_changed.emit(message["status"])
+        elif kind == "hello":
+            self.identity = (message["user"], message["platform"])
+            self.latency.own_user = message["user"]
+    @Slot(dict)
+    def on_rendered(self, room_state):
+        self.latency.rendered(room_state)
+    async def run(self, username=None, platform=None):
+        if username is not None:
+            self.identity = (username, platform)
+        self.runtime.spawn(self.latency.run(), name="latency")
+        while True:
+            if self.identity is not None and await self._host(*self.identity):
+                return
             try:
-                response = requests.get(GET_URL, timeout=5, verify=certifi.where())
-                if response.status_code == 200:
-                    self.state_updated.emit(response.json())
-            except requests.RequestException as e:
-                print(f"Fetch failed: {e}")
-            time.sleep(5)
-    def stop(self): self._is_running = False
+                self.health_changed.emit("Connecting to the local daemon...")
+                await music_daemon.follow(self.on_message)
+            except NETWORK_ERRORS as e:
+                print(f"Daemon connection failed: {e}")
+            await asyncio.sleep(1)
+    async def _host(self, username, platform):
+        """Runs the daemon in this process until shutdown; False if another process has the port."""
+        daemon = music_daemon.MusicDaemon(self.runtime, username, platform, self.art_size)
+        try:
+            await daemon.start()
+        except OSError:
+            return False
+        daemon.hub.subscribe(self.on_message)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await daemon.stop()
 
 # --- Main Window (Unchanged) ---
 class RoomWindow(QMainWindow):
-    def __init__(self):
+    rendered = Signal(dict) # emitted after a state has been drawn (for latency reports)
+    def __init__(self, runtime):
         super().__init__()
+        self.runtime = runtime
         self.seats = []
+        self.user_to_seat = {} # user -> index into self.seats
+        self.applied = {} # user -> (song, platform, art_url) currently drawn
+        self.scheduler = RenderScheduler(self.render_state, parent=self)
         self.setWindowTitle("MusicFriend Room (Polling)")
         self.setGeometry(100, 100, 1000, 400)
         container = QWidget()
         self.grid_layout = QGridLayout(container)
         self.setCentralWidget(container)
         self._setup_seats()
+        self.statusBar().showMessage("Connecting...")
+        self.progress_timer = QTimer(self)
+        self.progress_timer.timeout.connect(self.refresh_progress)
+        self.progress_timer.start(1000)
     def _setup_seats(self, num_seats=12, cols=4):
         for i in range(num_seats):
-            seat = SeatWidget()
+            seat = SeatWidget(self.runtime)
             row, col = divmod(i, cols)
             self.grid_layout.addWidget(seat, row, col)
             self.seats.append(seat)
+    def refresh_progress(self):
+        for seat in self.seats:
+            if seat.position_ms is not None:
+                seat.refresh_progress()
+    @Slot(str)
+    def on_health_changed(self, status):
+        self.statusBar().showMessage(status)
     @Slot(dict)
     def on_state_update(self, room_state):
-        occupied_seats = set()
-        user_to_seat_map = {}
-        for user, data in room_state.items():
-            found_seat = False
-            for i, seat in enumerate(self.seats):
-                if seat.property("occupied") and seat.user_label.text().endswith(user):
-                    seat.update_seat(user, data.get('song'), data.get('platform'), data.get('art_url'))
-                    occupied_seats.add(i)
-                    user_to_seat_map[user] = i
-                    found_seat = True
-                    break
-            if not found_seat: pass
+        # Don't draw from inside the slot; the scheduler renders the newest state once per frame.
+        self.scheduler.submit(room_state)
+    def render_state(self, room_state):
+        """Applies a room state, touching only the seats whose user or song changed."""
+        for user in [u for u in self.user_to_seat if u not in room_state]:
+            self.seats[self.user_to_seat.pop(user)].set_empty()
+            self.applied.pop(user, None)
+        taken = set(self.user_to_seat.values())
+        free_seats = [i for i in range(len(self.seats)) if i not in taken]
         for user, data in room_state.items():
-            if user not in user_to_seat_map:
-                for i, seat in enumerate(self.seats):
-                    if i not in occupied_seats:
-                        seat.update_seat(user, data.get('song'), data.get('platform'), data.get('art_url'))
-                        occupied_seats.add(i)
-                        user_to_seat_map[user] = i
-                        break
-        for i, seat in enumerate(self.seats):
-            if i not in occupied_seats:
-                seat.set_empty()
-        QApplication.processEvents()
+            index = self.user_to_seat.get(user)
+            if index is None:
+                if not free_seats:
+                    continue # Room is full
+                index = self.user_to_seat[user] = free_seats.pop(0)
+            seat = self.seats[index]
+            shown = (data.get('song'), data.get('platform'), data.get('art_url'))
+            if self.applied.get(user) != shown:
+                seat.update_seat(user, *shown, data.get('position_ms'), data.get('duration_ms'))
+                self.applied[user] = shown
+            else:
+                seat.set_position(data.get('position_ms') if data.get('song') else None, data.get('duration_ms'))
+        self.rendered.emit(room_state)
 
 # --- Settings Dialog (Unchanged) ---
 class SettingsDialog(QDialog):
@@ -218,7 +254,7 @@ class SettingsDialog(QDialog):
         super().__init__(parent)
         self.setWindowTitle("MusicFriend Setup")
         self.setModal(True)
-        self.setFixedSize(300, 200)
+        self.setFixedSize(300, 230 if sys.platform.startswith("linux") else 200)
         layout = QVBoxLayout(self)
         layout.addWidget(QLabel("Enter your nickname:"))
         self.username_input = QLineEdit()
@@ -230,6 +266,11 @@ class SettingsDialog(QDialog):
         self.netease_radio.setChecked(True)
         platform_layout.addWidget(self.netease_radio)
         platform_layout.addWidget(self.spotify_radio)
+        self.mpris_radio = None
+        if sys.platform.startswith('linux'):
+            self.mpris_radio = QRadioButton("Any player (Linux MPRIS)")
+            self.mpris_radio.setChecked(True)
+            platform_layout.addWidget(self.mpris_radio)
         platform_group.setLayout(platform_layout)
         layout.addWidget(platform_group)
         self.button_box = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
@@ -243,42 +284,49 @@ class SettingsDialog(QDialog):
         if not self.username:
             self.username_input.setStyleSheet("border: 1px solid red;")
             return
-        self.platform = 'spotify' if self.spotify_radio.isChecked() else 'netease'
+        if self.mpris_radio is not None and self.mpris_radio.isChecked():
+            self.platform = 'mpris'
+        else:
+            self.platform = 'spotify' if self.spotify_radio.isChecked() else 'netease'
         super().accept()
 
 # --- Main Application Execution (Unchanged) ---
 if __name__ == '__main__':
+    startup_profiler.mark("modules imported")
     app = QApplication(sys.argv)
     app.setStyleSheet("QWidget { background-color: #2c2f33; color: #ffffff; } QLabel { background-color: transparent; }")
-    settings_dialog = SettingsDialog()
-    if settings_dialog.exec() != QDialog.Accepted:
-        sys.exit(0)
-    main_window = RoomWindow()
-    detector = SongDetectorWorker(settings_dialog.platform)
-    updater = StateUpdaterWorker(settings_dialog.username, settings_dialog.platform)
-    fetcher = StateFetcherWorker()
-    detector_thread = QThread()
-    updater_thread = QThread()
-    fetcher_thread = QThread()
-    detector.moveToThread(detector_thread)
-    updater.moveToThread(updater_thread)
-    fetcher.moveToThread(fetcher_thread)
-    detector.song_detected.connect(updater.update_song)
-    fetcher.state_updated.connect(main_window.on_state_update)
-    detector_thread.started.connect(detector.run)
-    fetcher_thread.started.connect(fetcher.run)
-    def on_about_to_quit():
-        detector.stop()
-        fetcher.stop()
-        detector_thread.quit()
-        updater_thread.quit()
-        fetcher_thread.quit()
-        detector_thread.wait()
-        updater_thread.wait()
-        fetcher_thread.wait()
-    app.aboutToQuit.connect(on_about_to_quit)
-    detector_thread.start()
-    updater_thread.start()
-    fetcher_thread.start()
-    main_window.show()
-    sys.exit(app.exec())
+    # A running daemon already knows who we are and has the room cached: no setup needed.
+    username = platform = None
+    hosting = not music_daemon.daemon_running()
+    if hosting:
+        settings_dialog = SettingsDialog()
+        startup_profiler.watch_first_paint(settings_dialog, "settings dialog first paint")
+        if settings_dialog.exec() != QDialog.Accepted:
+            sys.exit(0)
+        username, platform = settings_dialog.username, settings_dialog.platform
+    # From here on the Qt event loop is driven by asyncio (qasync), so every worker is a task.
+    loop = qasync.QEventLoop(app)
+    asyncio.set_event_loop(loop)
+    runtime = AsyncRuntime(loop)
+    main_window = RoomWindow(runtime)
+    if not hosting:
+        startup_profiler.watch_first_paint(main_window, "room window first paint")
+    art_size = round(album_art.SEAT_ART_SIZE * app.devicePixelRatio())
+    subscriber = DaemonSubscriber(runtime, art_size)
+    subscriber.health_changed.connect(main_window.on_health_changed)
+    subscriber.state_updated.connect(main_window.on_state_update)
+    main_window.rendered.connect(subscriber.on_rendered)
+    # Closing the window ends main() below, which shuts the tasks down before the loop stops.
+    quit_requested = asyncio.Event()
+    app.setQuitOnLastWindowClosed(False)
+    app.lastWindowClosed.connect(quit_requested.set)
+    async def main():
+        await runtime.start()
+        runtime.spawn(subscriber.run(username, platform), name="daemon")
+        main_window.show()
+        await quit_requested.wait()
+        # Cancelling the tasks interrupts their sleeps, so quitting is immediate.
+        await runtime.shutdown()
+        print(f"UI: Render stats {main_window.scheduler.stats()}")
+    with loop:
+        loop.run_until_complete(main())
@@ -1,21 +1,30 @@
+import startup_profiler # Imported first so the startup clock starts early
 import sys
 import time
-import requests
-import certifi
-from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QGridLayout, 
-                               QLabel, QVBoxLayout, QDialog, QLineEdit, 
-                               QDialogButtonBox, QHBoxLayout)
-from PySide6.QtCore import QThread, QObject, Signal, Slot, Qt
-from PySide6.QtGui import QPixmap, QImage
+with startup_profiler.timed("import requests"):
+    import requests
+    import certifi
+with startup_profiler.timed("import PySide6"):
+    from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QGridLayout, 
+                                   QLabel, QVBoxLayout, QDialog, QLineEdit, 
+                                   QDialogButtonBox, QHBoxLayout)
+    from PySide6.QtCore import QThread, QObject, Signal, Slot, Qt, QTimer
+    from PySide6.QtGui import QPixmap, QImage
 from urllib.request import urlopen
+from clock_sync import ClockOffsetEstimator
+import album_art
+from ui_scheduler import RenderScheduler
 
-# Only import the cross-platform detector
-import spotify_detector
+# The cross-platform detector (spotipy) is imported lazily in SongDetectorWorker.run,
+# so the setup dialog doesn't wait for it.
 
 # --- Configuration ---
 BASE_URL = "https://listeningtogether.onrender.com/"
 UPDATE_URL = f"{BASE_URL}update_state"
 GET_URL = f"{BASE_URL}get_state"
+# /get_state long-poll. Kept short: a request in flight delays quitting by up to this long.
+LONG_POLL_WAIT = 5
+MIN_POLL_INTERVAL = 1
 
 # --- Image Downloader (Upgraded to use requests) ---
 class ImageDownloader(QObject):
@@ -36,6 +45,10 @@ class ImageDownloader(QObject):
         except Exception as e:
             print(f"ImageDownloader (macOS): ERROR - {e}")
 
+def format_ms(ms):
+    seconds = int(ms // 1000)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
 # --- UI Components (with logging) ---
 class SeatWidget(QWidget):
     def __init__(self, parent=None):
@@ -55,21 +68,33 @@ class SeatWidget(QWidget):
         self.user_label = QLabel("Empty Seat")
         self.song_label = QLabel("...")
         self.song_label.setWordWrap(True)
+        self.progress_label = QLabel("")
+        self.progress_label.setStyleSheet("color: #aaa;")
         text_layout.addWidget(self.user_label)
         text_layout.addWidget(self.song_label)
+        text_layout.addWidget(self.progress_label)
         text_layout.addStretch()
         main_layout.addWidget(self.album_art_label)
         main_layout.addLayout(text_layout)
         self.setProperty("occupied", False)
         self.current_art_url = None
         self.downloader_thread = None
+        self.position_ms = None
+        self.duration_ms = None
+        self.position_received = 0
 
-    def update_seat(self, user, song, platform, art_url):
+    def update_seat(self, user, song, platform, art_url, position_ms=None, duration_ms=None):
+        was_occupied = self.property("occupied")
         self.setProperty("occupied", True)
         icon = '🟢' 
         self.user_label.setText(f"{icon} {user}")
         self.song_label.setText(song if song else "Playback Paused")
-        self.style().polish(self)
+        self.set_position(position_ms if song else None, duration_ms)
+        # Re-polishing re-resolves the whole stylesheet; only needed when [occupied] flips.
+        if not was_occupied:
+            self.style().polish(self)
+        # Ask the CDN for a seat-sized variant instead of the full-size cover.
+        art_url = album_art.sized_url(art_url, round(album_art.SEAT_ART_SIZE * self.devicePixelRatioF()))
         if art_url and art_url != self.current_art_url:
             self.current_art_url = art_url
             self.album_art_label.setText("...")
@@ -98,34 +123,64 @@ class SeatWidget(QWidget):
         self.album_art_label.setText("🟢")
         self.album_art_label.setFont(self.font())
 
+    def set_position(self, position_ms, duration_ms):
+        # The server already extrapolated the position; keep advancing it locally between polls.
+        self.position_ms = position_ms
+        self.duration_ms = duration_ms
+        self.position_received = time.monotonic()
+        self.refresh_progress()
+
+    def refresh_progress(self):
+        if self.position_ms is None:
+            self.progress_label.setText("")
+            return
+        position = self.position_ms + (time.monotonic() - self.position_received) * 1000
+        if self.duration_ms:
+            position = min(position, self.duration_ms)
+            self.progress_label.setText(f"{format_ms(position)} / {format_ms(self.duration_ms)}")
+        else:
+            self.progress_label.setText(format_ms(position))
+
     def set_empty(self):
+        was_occupied = self.property("occupied")
         self.setProperty("occupied", False)
         self.user_label.setText("Empty Seat")
         self.song_label.setText("...")
+        self.set_position(None, None)
         self.set_default_art()
-        self.style().polish(self)
+        if was_occupied:
+            self.style().polish(self)
 
 # --- Logic Components with Diagnostics ---
 class SongDetectorWorker(QObject):
     song_detected = Signal(dict)
-    def __init__(self):
+    def __init__(self, art_size=album_art.SEAT_ART_SIZE):
         super().__init__()
+        self.art_size = art_size
         self._is_running = True
     def run(self):
         print("SongDetector (macOS): Worker thread started.")
+        with startup_profiler.timed("import spotify_detector"):
+            import spotify_detector
+        startup_profiler.report()
         if not spotify_detector.initialize_spotify(): 
             print("SongDetector (macOS): Initialization failed. Worker will not run.")
             return
         
-        get_song_function = spotify_detector.get_current_spotify_song
+        get_song_function = spotify_detector.get_current_spotify_playback
         
         while self._is_running:
             print("SongDetector (macOS): Loop running, checking for song...")
             song_data = {"song": "", "art_url": None}
-            song_info = get_song_function()
-            if song_info:
-                song, artist, art_url = song_info
-                song_data = {"song": f"{song} - {artist}", "art_url": art_url}
+            playback = get_song_function(self.art_size)
+            if playback:
+                song_data = {
+                    "song": f"{playback['song']} - {playback['artist']}",
+                    "art_url": playback["art_url"],
+                    "progress_ms": playback["progress_ms"],
+                    "duration_ms": playback["duration_ms"],
+                    "sampled_at": playback["sampled_at"],
+                }
             
             print(f"SongDetector (macOS): Emitting song_detected signal with data: {song_data}")
             self.song_detected.emit(song_data)
@@ -136,14 +191,27 @@ class StateUpdaterWorker(QObject):
     def __init__(self, username):
         super().__init__()
         self.username = username
+        self.clock = ClockOffsetEstimator()
     @Slot(dict)
     def update_song(self, song_data):
         print(f"StateUpdater (macOS): Received song_detected signal. Preparing to POST.")
         try:
             payload = { "user": self.username, "song": song_data.get("song"), "platform": "spotify", "art_url": song_data.get("art_url") }
+            if song_data.get("progress_ms") is not None:
+                payload["progress_ms"] = song_data["progress_ms"]
+                payload["duration_ms"] = song_data.get("duration_ms")
+                payload["sampled_at"] = self.clock.to_server_time(song_data["sampled_at"])
             print(f"StateUpdater (macOS): Sending payload: {payload}")
-            requests.post(UPDATE_URL, json=payload, timeout=5, verify=certifi.where())
+            t0 = time.time()
+            response = requests.post(UPDATE_URL, json=payload, timeout=5, verify=certifi.where())
+            t3 = time.time()
             print("StateUpdater (macOS): POST request sent successfully.")
+            # Every update doubles as a clock offset exchange, so no extra requests are needed.
+            try:
+                body = response.json()
+                self.clock.add_sample(t0, body["received_at"], body["server_time"], t3)
+            except (ValueError, KeyError, TypeError):
+                pass
         except requests.RequestException as e:
             print(f"StateUpdater (macOS): ERROR - POST request failed: {e}")
 
@@ -153,14 +221,23 @@ class StateFetcherWorker(QObject):
         super().__init__()
         self._is_running = True
     def run(self):
+        version = None
         while self._is_running:
+            started = time.monotonic()
+            params = {} if version is None else {"since": version, "wait": LONG_POLL_WAIT}
             try:
-                response = requests.get(GET_URL, timeout=5, verify=certifi.where())
+                response = requests.get(GET_URL, params=params, timeout=LONG_POLL_WAIT + 5, verify=certifi.where())
                 if response.status_code == 200:
                     self.state_updated.emit(response.json())
+                    version = response.headers.get("X-Room-Version")
+                else:
+                    version = None
             except requests.RequestException:
-                pass # Fail silently, as this is a background polling task
-            time.sleep(5)
+                version = None # Fail silently, as this is a background polling task
+            if version is None:
+                time.sleep(5)
+            else:
+                time.sleep(max(0, MIN_POLL_INTERVAL - (time.monotonic() - started)))
     def stop(self): self._is_running = False
 
 # --- Main Window (Unchanged) ---
@@ -168,44 +245,52 @@ class RoomWindow(QMainWindow):
     def __init__(self):
         super().__init__()
         self.seats = []
+        self.user_to_seat = {} # user -> index into self.seats
+        self.applied = {} # user -> (song, platform, art_url) currently drawn
+        self.scheduler = RenderScheduler(self.render_state, parent=self)
         self.setWindowTitle("MusicFriend Room (macOS)")
         self.setGeometry(100, 100, 1000, 400)
         container = QWidget()
         self.grid_layout = QGridLayout(container)
         self.setCentralWidget(container)
         self._setup_seats()
+        self.progress_timer = QTimer(self)
+        self.progress_timer.timeout.connect(self.refresh_progress)
+        self.progress_timer.start(1000)
     def _setup_seats(self, num_seats=12, cols=4):
         for i in range(num_seats):
             seat = SeatWidget()
             row, col = divmod(i, cols)
             self.grid_layout.addWidget(seat, row, col)
             self.seats.append(seat)
+    def refresh_progress(self):
+        for seat in self.seats:
+            if seat.position_ms is not None:
+                seat.refresh_progress()
     @Slot(dict)
     def on_state_update(self, room_state):
-        occupied_seats = set()
-        user_to_seat_map = {}
-        for user, data in room_state.items():
-            found_seat = False
-            for i, seat in enumerate(self.seats):
-                if seat.property("occupied") and seat.user_label.text().endswith(user):
-                    seat.update_seat(user, data.get('song'), data.get('platform'), data.get('art_url'))
-                    occupied_seats.add(i)
-                    user_to_seat_map[user] = i
-                    found_seat = True
-                    break
-            if not found_seat: pass
+        # Don't draw from inside the slot; the scheduler renders the newest state once per frame.
+        self.scheduler.submit(room_state)
+    def render_state(self, room_state):
+        """Applies a room state, touching only the seats whose user or song changed."""
+        for user in [u for u in self.user_to_seat if u not in room_state]:
+            self.seats[self.user_to_seat.pop(user)].set_empty()
+            self.applied.pop(user, None)
+        taken = set(self.user_to_seat.values())
+        free_seats = [i for i in range(len(self.seats)) if i not in taken]
         for user, data in room_state.items():
-            if user not in user_to_seat_map:
-                for i, seat in enumerate(self.seats):
-                    if i not in occupied_seats:
-                        seat.update_seat(user, data.get('song'), data.get('platform'), data.get('art_url'))
-                        occupied_seats.add(i)
-                        user_to_seat_map[user] = i
-                        break
-        for i, seat in enumerate(self.seats):
-            if i not in occupied_seats:
-                seat.set_empty()
-        QApplication.processEvents()
+            index = self.user_to_seat.get(user)
+            if index is None:
+                if not free_seats:
+                    continue # Room is full
+                index = self.user_to_seat[user] = free_seats.pop(0)
+            seat = self.seats[index]
+            shown = (data.get('song'), data.get('platform'), data.get('art_url'))
+            if self.applied.get(user) != shown:
+                seat.update_seat(user, *shown, data.get('position_ms'), data.get('duration_ms'))
+                self.applied[user] = shown
+            else:
+                seat.set_position(data.get('position_ms') if data.get('song') else None, data.get('duration_ms'))
 
 # --- Settings Dialog (macOS - Spotify Only, Unchanged) ---
 class SettingsDialog(QDialog):
@@ -235,13 +320,16 @@ class SettingsDialog(QDialog):
 
 # --- Main Application Execution (Unchanged) ---
 if __name__ == '__main__':
+    startup_profiler.mark("modules imported")
     app = QApplication(sys.argv)
     app.setStyleSheet("QWidget { background-color: #2c2f33; color: #ffffff; } QLabel { background-color: transparent; }")
     settings_dialog = SettingsDialog()
+    startup_profiler.watch_first_paint(settings_dialog, "settings dialog first paint")
     if settings_dialog.exec() != QDialog.Accepted:
         sys.exit(0)
     main_window = RoomWindow()
-    detector = SongDetectorWorker()
+    art_size = round(album_art.SEAT_ART_SIZE * app.devicePixelRatio())
+    detector = SongDetectorWorker(art_size)
     updater = StateUpdaterWorker(settings_dialog.username)
     fetcher = StateFetcherWorker()
     detector_thread = QThread()
@@ -263,6 +351,7 @@ if __name__ == '__main__':
         detector_thread.wait()
         updater_thread.wait()
         fetcher_thread.wait()
+        print(f"UI: Render stats {main_window.scheduler.stats()}")
     app.aboutToQuit.connect(on_about_to_quit)
     detector_thread.start()
     updater_thread.start()
@@ -0,0 +1,62 @@
+import math
+import os
+import time
+from collections import OrderedDict
+
+# Per-IP limits key on the address the platform proxy accepted the connection from. Each proxy
+# appends the address it saw to X-Forwarded-For, and anything to the left of that came from the
+# client. TRUSTED_PROXY_HOPS is the number of proxies in front of the server (ProxyFix's x_for,
+# 1 on Render), so the client is that many entries from the right; 0 means no proxy.
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", "1"))
+
+def client_address(forwarded, remote_addr, hops=TRUSTED_PROXY_HOPS):
+    """The address to rate-limit a request on, from its X-Forwarded-For and socket peer."""
+    addresses = [hop.strip() for hop in (forwarded or "").split(",") if hop.strip()]
+    if hops > 0 and len(addresses) >= hops:
+        return addresses[-hops]
+    return remote_addr or "unknown"
+
+class TokenBucketLimiter:
+    """
+    Token-bucket rate limiter keyed by an arbitrary string (user name, IP, ...).
+    Each key may spend `burst` calls at once and regains `rate` calls per second.
+    Bookkeeping is O(1) per call and bounded: at most `max_keys` buckets are kept,
+    the least recently used one is dropped when a new key arrives.
+    """
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> [tokens, last_refill_time]
+
+    def allow(self, key, now=None):
+        """
+        Takes one token for `key`.
+        Returns (True, 0) when the call is admitted, or (False, retry_after_seconds).
+        """
+        if self.rate <= 0:
+            return True, 0
+        now = now or time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [self.burst, now]
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True, 0
+        return False, (1 - bucket[0]) / self.rate
+
+    def __len__(self):
+        return len(self._buckets)
+
+def retry_after_header(seconds):
+    """Formats a Retry-After value (whole seconds, at least 1)."""
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+import aiohttp
+import socketio
+
+import traffic_trace
+
+# --- Trace replay ---
+# Plays a trace recorded with TRACE_PATH (see traffic_trace.py) against a server, keeping the
+# recorded timing (open loop: requests go out on schedule whether or not earlier ones finished),
+# optionally sped up. Anonymized ids are turned back into stable synthetic names, so the same
+# users share the same tracks and rooms as in the original traffic, and every replay of a
+# trace sends exactly the same requests. Each recorded user/connection gets its own
+# X-Forwarded-For address: the replay stands in for the platform proxy, so with the server's
+# default TRUSTED_PROXY_HOPS=1 per-IP limits behave as in production.
+# Example:
+#   python replay_trace.py trace.jsonl.gz --url http://127.0.0.1:5000 --speed 10
+
+MESSAGE_GRACE = 2  # seconds to wait for chat broadcasts before hanging up
+
+def user_name(anon_id):
+    return f"user-{anon_id}"
+
+def room_name(anon_id):
+    return "default" if anon_id is None else f"room-{anon_id}"
+
+def song_name(anon_id):
+    # Title and artist both come from the track id, so equal ids share a canonical key.
+    return f"Track {anon_id} - Artist {anon_id}" if anon_id else ""
+
+def fake_ip(anon_id):
+    value = int(anon_id or "0", 16)
+    return f"10.{(value >> 16) & 255}.{(value >> 8) & 255}.{value & 255}"
+
+def update_payload(record):
+    payload = {"user": user_name(record["u"]), "room": room_name(record.get("r")), "song": song_name(record.get("s")),
+               "platform": record.get("p", "unknown")}
+    if record.get("a"):
+        payload["art_url"] = f"https://example.invalid/art/{record.get('s')}.jpg"
+    if "pr" in record:
+        payload["progress_ms"] = record["pr"]
+        payload["duration_ms"] = record.get("d")
+    return payload
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class Replayer:
+    def __init__(self, url, speed, timeout):
+        self.url = url.rstrip('/')
+        self.speed = speed
+        self.timeout = timeout
+        self.session = None
+        self.latencies = {}  # kind -> [seconds]
+        self.errors = {}  # kind -> count
+        self.statuses = {}  # "kind status" -> count
+        self.max_lag = 0.0
+        self.sockets = {}  # anonymized connection id -> AsyncClient
+        self.connecting = {}  # anonymized connection id -> task of its connect()
+        self.pending_messages = {}  # token -> (sent at, connection id)
+        self._tokens = itertools.count()
+        self.versions = {}  # room -> last X-Room-Version seen
+
+    def _done(self, kind, started, ok=True, status=None):
+        if ok:
+            self.latencies.setdefault(kind, []).append(time.perf_counter() - started)
+        else:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+        if status is not None:
+            key = f"{kind} {status}"
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+
+    async def run(self, records):
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+            self.session = session
+            tasks = []
+            first = records[0]["at"]
+            start = time.perf_counter()
+            for record in records:
+                due = (record["at"] - first) / self.speed
+                delay = due - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self.max_lag = max(self.max_lag, -delay)
+                tasks.append(asyncio.create_task(self.dispatch(record)))
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Give the last chat broadcasts a moment to arrive, then hang up.
+            if self.pending_messages:
+                await asyncio.sleep(MESSAGE_GRACE)
+            await asyncio.gather(*(client.disconnect() for client in self.sockets.values()), return_exceptions=True)
+            return time.perf_counter() - start
+
+    async def dispatch(self, record):
+        kind = record["k"]
+        handler = getattr(self, f"replay_{kind}", None)
+        if handler is None:
+            return
+        try:
+            await handler(record)
+        except (aiohttp.ClientError, asyncio.TimeoutError, socketio.exceptions.SocketIOError):
+            self._done(kind, 0, ok=False)
+
+    # --- HTTP ---
+    async def _post(self, kind, path, payload, ip):
+        started = time.perf_counter()
+        async with self.session.post(f"{self.url}{path}", json=payload, headers={"X-Forwarded-For": ip}) as response:
+            await response.read()
+            self._done(kind, started, response.status < 500, response.status)
+
+    async def replay_update(self, record):
+        await self._post("update", "/update_state", update_payload(record), fake_ip(record["u"]))
+
+    async def replay_batch(self, record):
+        items = [update_payload(item) for item in record["i"]]
+        await self._post("batch", "/update_state/batch", items, fake_ip(record["i"][0]["u"] if record["i"] else None))
+
+    async def replay_get(self, record):
+        room = room_name(record.get("r"))
+        params = {"room": room}
+        kind = "get"
+        if record.get("w") and room in self.versions:
+            params.update(since=self.versions[room], wait=record["w"])
+            kind = "get (long-poll)"
+        started = time.perf_counter()
+        async with self.session.get(f"{self.url}/get_state", params=params) as response:
+            await response.read()
+            if response.headers.get("X-Room-Version"):
+                self.versions[room] = response.headers["X-Room-Version"]
+            self._done(kind, started, response.status < 500, response.status)
+
+    # --- Socket.IO ---
+    async def replay_connect(self, record):
+        client = socketio.AsyncClient(reconnection=False)
+        client.on("new_message", self._on_message)
+        self.sockets[record["c"]] = client
+        self.connecting[record["c"]] = asyncio.current_task()
+        started = time.perf_counter()
+        await client.connect(self.url, transports=["websocket"], headers={"X-Forwarded-For": fake_ip(record.get("ip"))},
+                             wait_timeout=self.timeout)
+        self._done("connect", started)
+
+    async def _connected(self, connection):
+        """The connection's client once its connect() finished (events may follow it within ms)."""
+        task = self.connecting.get(connection)
+        if task is not None and task is not asyncio.current_task():
+            await asyncio.wait([task])
+        client = self.sockets.get(connection)
+        return client if client is not None and client.connected else None
+
+    async def replay_disconnect(self, record):
+        client = await self._connected(record["c"])
+        # Let the connection's own chat messages come back before hanging up.
+        deadline = time.perf_counter() + MESSAGE_GRACE
+        while time.perf_counter() < deadline and any(c == record["c"] for _, c in self.pending_messages.values()):
+            await asyncio.sleep(0.01)
+        self.sockets.pop(record["c"], None)
+        self.connecting.pop(record["c"], None)
+        if client is not None:
+            await client.disconnect()
+
+    async def replay_message(self, record):
+        client = await self._connected(record["c"])
+        if client is None:
+            return
+        token = f"{record['c']}:{next(self._tokens)}"
+        # Same length as the recorded message (at least the token).
+        text = token.ljust(record.get("n", 0), ".")
+        self.pending_messages[token] = (time.perf_counter(), record["c"])
+        await client.emit("send_message", {"user": user_name(record.get("u")), "message": text})
+
+    def _on_message(self, data):
+        # Latency of a chat message = until its broadcast comes back (first copy counts).
+        token = (data.get("message") or "").rstrip(".")
+        pending = self.pending_messages.pop(token, None)
+        if pending is not None:
+            self._done("message", pending[0])
+
+    async def replay_clock_sync(self, record):
+        client = await self._connected(record["c"])
+        if client is None:
+            return
+        started = time.perf_counter()
+        await client.call("clock_sync", {"t0": time.time()}, timeout=self.timeout)
+        self._done("clock_sync", started)
+
+    # --- Report ---
+    def report(self, records, elapsed):
+        trace_span = records[-1]["at"] - records[0]["at"]
+        kinds = sorted(set(self.latencies) | set(self.errors))
+        summary = {
+            "records": len(records),
+            "trace_seconds": round(trace_span, 2),
+            "replay_seconds": round(elapsed, 2),
+            "speed": self.speed,
+            "throughput_per_s": round(sum(len(v) for v in self.latencies.values()) / elapsed, 1) if elapsed else 0.0,
+            "max_dispatch_lag_ms": round(self.max_lag * 1000, 1),
+            "lost_messages": len(self.pending_messages),
+            "statuses": self.statuses,
+            "kinds": {},
+        }
+        for kind in kinds:
+            values = sorted(self.latencies.get(kind, []))
+            summary["kinds"][kind] = {
+                "count": len(values),
+                "errors": self.errors.get(kind, 0),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+                "max_ms": round((values[-1] if values else 0.0) * 1000, 1),
+            }
+        return summary
+
+def print_summary(summary):
+    print(f"Replayed {summary['records']} records ({summary['trace_seconds']} s of traffic) "
+          f"in {summary['replay_seconds']} s at {summary['speed']}x")
+    print(f"Throughput {summary['throughput_per_s']}/s, max dispatch lag {summary['max_dispatch_lag_ms']} ms, "
+          f"lost chat messages {summary['lost_messages']}")
+    print(f"{'kind':18}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for kind, row in summary["kinds"].items():
+        print(f"{kind:18}{row['count']:>8}{row['errors']:>8}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}")
+    print("Status codes: " + ", ".join(f"{key}: {count}" for key, count in sorted(summary["statuses"].items())))
+
+async def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded traffic trace against a server.")
+    parser.add_argument("trace", help="file written by a server running with TRACE_PATH")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 = recorded pace, 10 = ten times faster")
+    parser.add_argument("--timeout", type=float, default=40, help="per-request timeout (covers long-polls)")
+    parser.add_argument("--json", help="also write the summary to this file, e.g. to compare runs")
+    args = parser.parse_args()
+    records = traffic_trace.read_trace(args.trace)
+    if not records:
+        print("Trace is empty.")
+        return
+    replayer = Replayer(args.url, args.speed, args.timeout)
+    elapsed = await replayer.run(records)
+    summary = replayer.report(records, elapsed)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,122 @@
+import bisect
+import hashlib
+import json
+import os
+import urllib.error
+import urllib.request
+
+# --- Rooms partitioned across server nodes (opt-in) ---
+# CLUSTER_NODES lists the base URLs of all nodes, CLUSTER_SELF is this node's own URL among
+# them. Every room is owned by one node, picked by consistent hashing: each node sits at
+# VNODES points of a hash ring and a room belongs to the first point after its own hash, so
+# adding or removing a node only moves the rooms next to its points (about 1/N of them).
+# A node answers requests for a room it doesn't own with a 307 to the owner (X-Room-Node
+# names it) and refuses Socket.IO connections for it, so there is no extra proxy hop and
+# throughput grows with the nodes. Socket.IO clients pick their room with ?room= (the
+# default room otherwise); GET /cluster?room= says where a room lives.
+#
+# Membership changes are sent to every node as PUT /admin/cluster {"nodes": [...]}, including
+# a node that is leaving. Each node then hands the rooms it no longer owns to their new owner
+# (POST /admin/cluster/handoff), users, chat and listening history alike, and forgets them; the
+# receiver keeps whichever entry of a user is newer. Rooms whose handoff failed stay put and are retried every REBALANCE_INTERVAL.
+# cluster_local.py runs a cluster of local processes.
+VNODES = 100
+HANDOFF_TIMEOUT = 10
+REBALANCE_INTERVAL = float(os.environ.get("CLUSTER_REBALANCE_INTERVAL", "10"))
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+def normalize_node(url):
+    return url.strip().rstrip("/")
+
+def parse_nodes(value):
+    """Node URLs from a comma-separated string or a list, normalized, without duplicates."""
+    if isinstance(value, str):
+        value = value.split(",")
+    return sorted({normalize_node(url) for url in value if isinstance(url, str) and url.strip()})
+
+class HashRing:
+    """Consistent hashing of room names onto nodes."""
+
+    def __init__(self, nodes=(), vnodes=VNODES):
+        self.nodes = parse_nodes(list(nodes))
+        self.vnodes = vnodes
+        points = sorted((ring_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def owner(self, room):
+        if not self._hashes:
+            return None
+        i = bisect.bisect_right(self._hashes, ring_hash(room)) % len(self._hashes)
+        return self._owners[i]
+
+class Cluster:
+    """This node's view of the cluster; with no nodes configured it owns every room."""
+
+    def __init__(self, self_url=None, nodes=(), vnodes=VNODES):
+        self.self_url = normalize_node(self_url) if self_url else None
+        self.ring = HashRing(nodes, vnodes)
+        self.rebalance_pending = self.enabled
+        self.handed_off_rooms = 0
+        self.adopted_rooms = 0
+        self.failed_handoffs = 0
+
+    @property
+    def enabled(self):
+        return self.self_url is not None and len(self.ring) > 0
+
+    def owner(self, room):
+        return self.ring.owner(room) if self.enabled else self.self_url
+
+    def owner_elsewhere(self, room):
+        """The URL of the node that owns `room`, or None when it is this one."""
+        if not self.enabled:
+            return None
+        owner = self.ring.owner(room)
+        return None if owner == self.self_url else owner
+
+    def set_nodes(self, nodes):
+        self.ring = HashRing(nodes, self.ring.vnodes)
+        self.rebalance_pending = True
+
+    def moved_rooms(self, room_names):
+        """{new owner: [room, ...]} for the rooms held here that belong to another node now."""
+        moved = {}
+        for name in room_names:
+            owner = self.owner_elsewhere(name)
+            if owner is not None:
+                moved.setdefault(owner, []).append(name)
+        return moved
+
+    def status(self):
+        return {
+            "enabled": self.enabled,
+            "self": self.self_url,
+            "nodes": self.ring.nodes,
+            "vnodes": self.ring.vnodes,
+            "rebalance_pending": self.rebalance_pending,
+            "handed_off_rooms": self.handed_off_rooms,
+            "adopted_rooms": self.adopted_rooms,
+            "failed_handoffs": self.failed_handoffs,
+        }
+
+def cluster_from_env():
+    return Cluster(os.environ.get("CLUSTER_SELF"), parse_nodes(os.environ.get("CLUSTER_NODES", "")),
+                   int(os.environ.get("CLUSTER_VNODES", str(VNODES))))
+
+def send_handoff(node, handoff, token, timeout=HANDOFF_TIMEOUT):
+    """Posts a RoomService.export_rooms() handoff to a node. Blocking; returns True once it took it."""
+    request = urllib.request.Request(
+        f"{node}/admin/cluster/handoff", data=json.dumps(handoff).encode("utf-8"), method="POST",
+        headers={"Content-Type": "application/json", "X-Admin-Token": token or ""})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status == 200
+    except (urllib.error.URLError, OSError) as e:
+        print(f"Cluster: Handoff to {node} failed: {e}")
+        return False
@@ -0,0 +1,825 @@
+import bisect
+import json
+import os
+import sys
+import time
+from collections import OrderedDict, deque
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import art_proxy
+import clock_sync
+import latency_stats
+import listening_history
+import rate_limit
+import room_snapshot
+import track_index
+
+# --- Room state shared by both server modes ---
+# app.py (Flask + eventlet) and asgi_app.py (python-socketio + uvicorn) are thin adapters
+# around RoomService: it owns the rooms, versions, history, same-song index, chat history and
+# rate limits. Anything that blocks or waits (long-polls, file I/O, art fetches) stays in the
+# adapters, since green threads and asyncio tasks wait differently.
+
+# rooms maps a room name to {user: state}. Clients that don't send a room use the default one.
+DEFAULT_ROOM = "default"
+MAX_ROOM_NAME_LENGTH = 64
+INACTIVE_THRESHOLD = 30
+
+# Fields whose change is visible to clients; heartbeats that only refresh the rest don't count.
+VISIBLE_FIELDS = ("song", "platform", "art_url")
+LONG_POLL_MAX_WAIT = 30
+# /get_state?since=V&delta=1 answers with only the users that changed or left after version V
+# (see RoomChanges). Each room remembers this many departures; older versions get the full room.
+MAX_REMEMBERED_REMOVALS = 1000
+
+# Window name -> length in seconds. /stats?window=<name> picks one.
+STATS_WINDOWS = {"1h": 60 * 60, "24h": 24 * 60 * 60}
+HISTORY_MAX_EVENTS = int(os.environ.get("HISTORY_MAX_EVENTS", "100000"))
+MAX_STATS_K = 100
+
+# Clients may report progress_ms/duration_ms with the server-clock time they sampled it at
+# (sampled_at, from the clock offset exchange). get_state extrapolates each position to "now".
+MAX_SAMPLE_AGE = 60
+
+# /get_state?limit=&after=&fields= pages through a room in user-name order; the cursor is the
+# last user of the previous page, so it stays valid while other users come and go.
+MAX_PAGE_SIZE = 200
+PAGE_FIELDS = ("user", "song", "platform", "art_url", "timestamp", "track_key", "trace_id",
+               "progress_ms", "duration_ms", "sampled_at", "position_ms", "position_at")
+
+# The page at / is served with its room inlined (see initial_state), so it draws on the first
+# response and then long-polls /get_state from that version. The JSON is built once per version.
+INITIAL_STATE_CACHE_SIZE = 256
+
+# Track changes may carry a trace_id (see latency_stats.py); longer ids are ignored.
+MAX_TRACE_ID_LENGTH = 64
+
+# Chat is kept per room (Socket.IO clients join the room of their ?room=), so it moves with
+# the room between nodes. People may chat in a room nobody reports to, so the chats have their
+# own least recently used order, capped at MAX_ROOMS like the rooms.
+CHAT_HISTORY_LIMIT = 100
+CHAT_HISTORY_MAX_AGE = 24 * 60 * 60
+# The history is snapshotted and replayed to every new connection, so only these fields of a
+# message are kept, cut to these lengths.
+CHAT_MESSAGE_MAX_LENGTH = int(os.environ.get("CHAT_MESSAGE_MAX_LENGTH", "500"))
+CHAT_USER_MAX_LENGTH = 64
+
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", "room_snapshot.bin")
+SNAPSHOT_INTERVAL = float(os.environ.get("SNAPSHOT_INTERVAL", "10"))
+
+# Rates are calls per second, bursts are how many calls may arrive back to back.
+# Set a rate to 0 to disable that limit.
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("RATE_LIMIT_MAX_KEYS", "10000"))
+
+# /update_state/batch: most user reports one request may carry.
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "500"))
+
+# Capacity: a flood of made-up user or room names must not grow the process without bound.
+# Past a cap the least recently updated user (or least recently active room) is dropped as if
+# it had gone inactive; real listeners report every few seconds, so they stay at the fresh
+# end. Every RECLAIM_INTERVAL seconds expired users are also swept out of rooms nobody polls.
+# Set a cap to 0 to disable it.
+MAX_USERS = int(os.environ.get("MAX_USERS", "20000"))
+MAX_USERS_PER_ROOM = int(os.environ.get("MAX_USERS_PER_ROOM", "1000"))
+MAX_ROOMS = int(os.environ.get("MAX_ROOMS", "5000"))
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", "10000"))
+RECLAIM_INTERVAL = float(os.environ.get("RECLAIM_INTERVAL", "10"))
+
+# Album art proxy (optional, needs Pillow). When enabled, room state references /art/<key>
+# instead of the CDN URL; each cover is fetched and resized once, then served from disk.
+ART_PROXY_ENABLED = os.environ.get("ART_PROXY", "0") == "1" and art_proxy.available()
+ART_CACHE_DIR = os.environ.get("ART_CACHE_DIR", "art_cache")
+ART_CACHE_MAX_BYTES = int(os.environ.get("ART_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+ART_PROXY_BASE_URL = os.environ.get("ART_PROXY_BASE_URL")  # defaults to the URL the client used
+ART_MAX_AGE = 365 * 24 * 60 * 60
+
+def room_name(value):
+    return str(value or DEFAULT_ROOM)[:MAX_ROOM_NAME_LENGTH]
+
+def stats_k(value):
+    return max(1, min(value if isinstance(value, int) else 10, MAX_STATS_K))
+
+def playback_fields(data, received_at):
+    progress_ms = data.get("progress_ms")
+    if not isinstance(progress_ms, (int, float)) or progress_ms < 0:
+        return {}
+    duration_ms = data.get("duration_ms")
+    sampled_at = data.get("sampled_at")
+    if not isinstance(sampled_at, (int, float)):
+        sampled_at = received_at
+    # A badly synced client clock must not push positions into the future or far past.
+    sampled_at = min(received_at, max(received_at - MAX_SAMPLE_AGE, sampled_at))
+    return {
+        "progress_ms": int(progress_ms),
+        "duration_ms": int(duration_ms) if isinstance(duration_ms, (int, float)) and duration_ms > 0 else None,
+        "sampled_at": sampled_at,
+    }
+
+# Reported fields stored as text. Reports with anything else in them are rejected before the
+# history, the same-song index or a trace sees them.
+TEXT_FIELDS = ("song", "platform", "art_url")
+
+def update_error(data):
+    """Why an /update_state report can't be stored (the message of the 400), or None."""
+    if not isinstance(data, dict):
+        return "Invalid data"
+    user = data.get("user")
+    if not isinstance(user, (str, int)) or isinstance(user, bool):
+        return "Invalid data"
+    for field in TEXT_FIELDS:
+        if data.get(field) is not None and not isinstance(data[field], str):
+            return f"'{field}' must be a string"
+    return None
+
+def chat_entry(data, timestamp):
+    """The stored form of a chat message, {user, message, timestamp}, or None if it is malformed."""
+    if not isinstance(data, dict):
+        return None
+    user, message = data.get("user"), data.get("message")
+    if not isinstance(user, (str, int)) or isinstance(user, bool) or not isinstance(message, str) or not message:
+        return None
+    return {"user": str(user)[:CHAT_USER_MAX_LENGTH], "message": message[:CHAT_MESSAGE_MAX_LENGTH], "timestamp": timestamp}
+
+def chat_entries(messages, max_age=CHAT_HISTORY_MAX_AGE, now=None):
+    """The well-formed, recent messages of a snapshotted or handed-off chat, oldest first."""
+    if not isinstance(messages, list):
+        return []
+    messages = [m for m in messages if isinstance(m, dict) and isinstance(m.get("timestamp"), (int, float))]
+    messages = room_snapshot.fresh_messages(messages, max_age, now)
+    entries = [entry for entry in (chat_entry(m, m["timestamp"]) for m in messages) if entry is not None]
+    return sorted(entries, key=lambda entry: entry["timestamp"])[-CHAT_HISTORY_LIMIT:]
+
+def handoff_rooms(handoff):
+    """The names of all rooms in a handoff (see RoomService.export_rooms)."""
+    return {name for part in ("rooms", "chat", "history") if isinstance(handoff.get(part), dict)
+            for name in handoff[part]}
+
+def trace_times(data):
+    """The sender's detected_at/sent_at (server time) of a traced update; non-numbers become None."""
+    return [data.get(key) if isinstance(data.get(key), (int, float)) else None for key in ("detected_at", "sent_at")]
+
+def user_view(data, now):
+    """One user's entry as served to clients, with a reported position extrapolated to `now`."""
+    if "progress_ms" not in data:
+        return data
+    return dict(data,
+                position_ms=clock_sync.extrapolate_position(data["progress_ms"], data["duration_ms"], data["sampled_at"], now),
+                position_at=now)
+
+def room_view(room, now):
+    """The room as served to clients, with each reported position extrapolated to `now`."""
+    return {user: user_view(data, now) for user, data in room.items()}
+
+def html_safe_json(value):
+    """JSON that can sit inside a <script> element (no "</script>", no HTML-significant characters)."""
+    text = json.dumps(value, separators=(",", ":"))
+    return text.replace("<", "\\u003c").replace(">", "\\u003e").replace("&", "\\u0026").replace("'", "\\u0027")
+
+def page_args(limit, fields):
+    """Checks /get_state page arguments: returns (limit, fields tuple or None), raises ValueError."""
+    limit = max(1, min(limit if isinstance(limit, int) else MAX_PAGE_SIZE, MAX_PAGE_SIZE))
+    if not fields:
+        return limit, None
+    fields = tuple(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    unknown = [f for f in fields if f not in PAGE_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields {unknown}, use any of {list(PAGE_FIELDS)}")
+    return limit, fields
+
+def deep_size(value):
+    """Approximate bytes held by JSON-like data (dicts, lists, strings, numbers)."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(key) + deep_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple, deque)):
+        size += sum(deep_size(item) for item in value)
+    return size
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def limiter_from_env(action, scope, rate, burst):
+    """e.g. limiter_from_env("UPDATE", "USER", "1", "5") reads UPDATE_RATE_PER_USER / UPDATE_BURST_PER_USER."""
+    return rate_limit.TokenBucketLimiter(
+        float(os.environ.get(f"{action}_RATE_PER_{scope}", rate)),
+        float(os.environ.get(f"{action}_BURST_PER_{scope}", burst)),
+        RATE_LIMIT_MAX_KEYS)
+
+class SortedUsers:
+    """The users of one room in name order, so a page is a bisect and a slice."""
+
+    def __init__(self):
+        self.names = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, user):
+        i = bisect.bisect_left(self.names, user)
+        if i == len(self.names) or self.names[i] != user:
+            self.names.insert(i, user)
+
+    def remove(self, user):
+        i = bisect.bisect_left(self.names, user)
+        if i < len(self.names) and self.names[i] == user:
+            del self.names[i]
+
+    def page(self, after, limit):
+        """Up to `limit` users sorting after `after` (from the start if None), and whether more follow."""
+        start = 0 if after is None else bisect.bisect_right(self.names, after)
+        return self.names[start:start + limit], start + limit < len(self.names)
+
+class RoomChanges:
+    """
+    The version at which each user of one room last changed visibly or left, so a client at
+    version V can be sent just what differs. mark() notes a user as touched; the next version
+    bump (RoomService.touch) stamps all marked users at once, however many changed in between.
+    """
+
+    def __init__(self, floor):
+        self.floor = floor  # deltas are complete for any `since` from here on
+        self.marked = set()
+        self.changed = {}  # user -> version of their last visible change
+        self.removed = OrderedDict()  # user -> version they left at, oldest first
+
+    def mark(self, user):
+        self.marked.add(user)
+
+    def stamp(self, version, room):
+        for user in self.marked:
+            if user in room:
+                self.changed[user] = version
+                self.removed.pop(user, None)
+            else:
+                self.changed.pop(user, None)
+                self.removed[user] = version
+                self.removed.move_to_end(user)
+        self.marked.clear()
+        while len(self.removed) > MAX_REMEMBERED_REMOVALS:
+            _, version = self.removed.popitem(last=False)
+            self.floor = max(self.floor, version)
+
+    def since(self, version):
+        """(changed users, removed users) after `version`, or None if it is older than the floor."""
+        if version < self.floor:
+            return None
+        return ([user for user, changed in self.changed.items() if changed > version],
+                [user for user, removed in self.removed.items() if removed > version])
+
+class RoomService:
+    """
+    All room state of one server process. The server adapter passes callbacks:
+    on_change(room, version) when something visible in a room changed (wake long-polls),
+    on_shared(payload) when a track becomes shared in a room (emit 'now_shared').
+    """
+
+    def __init__(self, on_change=None, on_shared=None):
+        # Rooms and each room's users are kept least recently updated first (see the caps).
+        self.rooms = OrderedDict([(DEFAULT_ROOM, OrderedDict())])
+        self.indexes = {DEFAULT_ROOM: SortedUsers()}  # room -> its users in page order
+        self.recent = OrderedDict()  # (room, user) -> None, across all rooms
+        self.versions = {}
+        self.initial_states = OrderedDict()  # room -> (version, inlinable JSON), see initial_state
+        # Versions start from the clock so they keep increasing across restarts.
+        self._last_version = int(time.time() * 1000)
+        self.changes = {DEFAULT_ROOM: RoomChanges(self._last_version)}  # room -> its RoomChanges
+        self.history = listening_history.ListeningHistory(STATS_WINDOWS, max_events=HISTORY_MAX_EVENTS)
+        self.same_song = track_index.SameSongIndex()
+        self.chats = OrderedDict()  # room -> deque of its recent messages, least recently used first
+        self.on_change = on_change or (lambda name, version: None)
+        self.on_shared = on_shared or (lambda payload: None)
+        self.update_user_limiter = limiter_from_env("UPDATE", "USER", "1", "5")
+        self.update_ip_limiter = limiter_from_env("UPDATE", "IP", "10", "20")
+        self.message_user_limiter = limiter_from_env("MESSAGE", "USER", "1", "5")
+        self.message_ip_limiter = limiter_from_env("MESSAGE", "IP", "5", "10")
+        self.art_cache = art_proxy.ThumbnailCache(ART_CACHE_DIR, ART_CACHE_MAX_BYTES) if ART_PROXY_ENABLED else None
+        self.latency = latency_stats.LatencyTracker()
+        # Instrumentation
+        self.connections = 0
+        self.expired_users = 0
+        self.evicted_users = 0
+        self.evicted_rooms = 0
+        self.refused_connections = 0
+
+    # --- Rooms and versions ---
+    def get_room(self, name):
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = OrderedDict()
+            self.indexes[name] = SortedUsers()
+            self.changes[name] = RoomChanges(self._last_version)
+        return room
+
+    def version(self, name):
+        return self.versions.get(name, 0)
+
+    def touch(self, name):
+        self._last_version += 1
+        self.versions[name] = self._last_version
+        changes = self.changes.get(name)
+        if changes is not None:
+            changes.stamp(self._last_version, self.rooms.get(name, {}))
+        self.on_change(name, self._last_version)
+
+    def cleanup_inactive_users(self, name=DEFAULT_ROOM, now=None):
+        room = self.rooms.get(name)
+        if room is None:
+            return
+        now = time.time() if now is None else now
+        # The room is in update order, so the inactive users are the ones at its front.
+        inactive_users = []
+        for user, data in room.items():
+            if now - data.get("timestamp", 0) <= INACTIVE_THRESHOLD:
+                break
+            inactive_users.append(user)
+        for user in inactive_users:
+            self._remove_user(name, user)
+        self.expired_users += len(inactive_users)
+        if inactive_users:
+            self.touch(name)
+        if not room:
+            self._drop_room(name)
+
+    def reclaim(self, now=None):
+        """Expires inactive users of every room, including rooms nobody polls. O(expired users)."""
+        now = time.time() if now is None else now
+        stale_rooms = set()
+        for name, user in self.recent:
+            if now - self.rooms[name][user].get("timestamp", 0) <= INACTIVE_THRESHOLD:
+                break
+            stale_rooms.add(name)
+        for name in stale_rooms:
+            self.cleanup_inactive_users(name, now)
+
+    def _remove_user(self, name, user):
+        self.history.close(name, user)
+        self.same_song.remove(name, user)
+        del self.rooms[name][user]
+        self.indexes[name].remove(user)
+        self.changes[name].mark(user)
+        self.recent.pop((name, user), None)
+
+    def _drop_room(self, name):
+        if name == DEFAULT_ROOM:
+            return
+        self.rooms.pop(name, None)
+        self.indexes.pop(name, None)
+        self.changes.pop(name, None)
+        self.versions.pop(name, None)
+        self.initial_states.pop(name, None)
+
+    def _enforce_caps(self, name):
+        """Evicts past MAX_USERS_PER_ROOM/MAX_USERS/MAX_ROOMS; returns True if room `name` lost users."""
+        touched = set()
+        room = self.rooms[name]
+        while MAX_USERS_PER_ROOM and len(room) > MAX_USERS_PER_ROOM:
+            self._remove_user(name, next(iter(room)))
+            self.evicted_users += 1
+            touched.add(name)
+        while MAX_USERS and len(self.recent) > MAX_USERS:
+            victim_room, victim = next(iter(self.recent))
+            self._remove_user(victim_room, victim)
+            self.evicted_users += 1
+            touched.add(victim_room)
+        while MAX_ROOMS and len(self.rooms) > MAX_ROOMS:
+            victim_room = next(iter(self.rooms))
+            if victim_room == DEFAULT_ROOM:
+                self.rooms.move_to_end(DEFAULT_ROOM)  # never evicted
+                continue
+            for user in list(self.rooms[victim_room]):
+                self._remove_user(victim_room, user)
+            self.evicted_rooms += 1
+            self.touch(victim_room)
+            self._drop_room(victim_room)
+            touched.discard(victim_room)
+        for other in touched - {name}:
+            self.touch(other)
+            if not self.rooms.get(other):
+                self._drop_room(other)
+        return name in touched
+
+    def view(self, name, now=None):
+        return room_view(self.rooms.get(name, {}), time.time() if now is None else now)
+
+    def delta(self, name, since, now=None):
+        """
+        What a client at version `since` is missing: {"full": False, "users": {user: view} for
+        users that changed since, "removed": [users that left]}. When `since` is older than the
+        room remembers, or not one of its versions, it is {"full": True, "users": view(name)}.
+        """
+        now = time.time() if now is None else now
+        changes = self.changes.get(name)
+        delta = None
+        if changes is not None and since is not None and since <= self.version(name):
+            delta = changes.since(since)
+        if delta is None:
+            return {"full": True, "users": self.view(name, now), "removed": []}
+        changed, removed = delta
+        room = self.rooms[name]
+        return {"full": False, "users": {user: user_view(room[user], now) for user in changed}, "removed": removed}
+
+    def initial_state(self, name, now=None):
+        """
+        {"room", "version", "users": view} as script-safe JSON for inlining into a page. Built once
+        per room version; positions are extrapolated to when it was built (see position_at).
+        """
+        version = self.version(name)
+        cached = self.initial_states.get(name)
+        if cached is not None and cached[0] == version:
+            self.initial_states.move_to_end(name)
+            return cached[1]
+        state = html_safe_json({"room": name, "version": version, "users": self.view(name, now)})
+        self.initial_states[name] = (version, state)
+        self.initial_states.move_to_end(name)
+        if len(self.initial_states) > INITIAL_STATE_CACHE_SIZE:
+            self.initial_states.popitem(last=False)
+        return state
+
+    def page(self, name, limit=MAX_PAGE_SIZE, after=None, fields=None, now=None):
+        """
+        One page of the room in user order: {"users": [{"user": ..., <field>: ...}], "next": cursor,
+        "total": users in the room}. `next` is None on the last page. `fields` (see page_args)
+        picks the fields per user; positions are only extrapolated when asked for.
+        """
+        room = self.rooms.get(name, {})
+        index = self.indexes.get(name)
+        users, more = index.page(after, limit) if index is not None else ([], False)
+        now = time.time() if now is None else now
+        positions = fields is None or "position_ms" in fields or "position_at" in fields
+        page = []
+        for user in users:
+            data = user_view(room[user], now) if positions else room[user]
+            if fields is None:
+                page.append(dict(data, user=user))
+            else:
+                page.append({f: user if f == "user" else data.get(f) for f in fields})
+        return {"users": page, "next": users[-1] if more else None, "total": len(room)}
+
+    # --- Updates ---
+    def update(self, name, user, data, art_url, now=None):
+        """Stores one /update_state report (art_url already proxied) and returns the entry."""
+        now = time.time() if now is None else now
+        entry, changed, shared_key = self._apply(name, user, data, art_url, now)
+        if changed:
+            self.touch(name)
+        if shared_key:
+            self._announce_shared(name, shared_key, entry["song"])
+        return entry
+
+    def update_batch(self, items, art_url=lambda url: url, now=None, owner_elsewhere=lambda name: None):
+        """
+        Applies many /update_state reports in one step: nothing else runs in between, each
+        room's version is bumped once and each newly shared track is announced once.
+        art_url maps a reported URL to the one to store (the adapter's proxied_art_url).
+        owner_elsewhere(room) names the node owning a room when it isn't this one (see
+        room_cluster); such items are not applied and their result says where to send them.
+        Returns one result dict per item, in order.
+        """
+        now = time.time() if now is None else now
+        # Every item is checked before any is stored, so a rejected item can't leave the
+        # batch half applied; the results of the accepted ones are filled in when applying.
+        results = []
+        accepted = []  # (result index, room, user, item, art url)
+        for item in items:
+            message = update_error(item)
+            if message is not None:
+                results.append({"status": "error", "message": message})
+                continue
+            user = item['user']
+            name = room_name(item.get('room'))
+            node = owner_elsewhere(name)
+            if node is not None:
+                results.append({"user": user, "room": name, "status": "error", "message": "Room lives on another node",
+                                "node": node})
+                continue
+            allowed, retry_after = self.update_user_limiter.allow(str(user))
+            if not allowed:
+                results.append({"user": user, "status": "error", "message": "Too many updates, slow down",
+                                "retry_after": round(retry_after, 2)})
+                continue
+            accepted.append((len(results), name, user, item, art_url(item.get("art_url"))))
+            results.append(None)
+        changed_rooms = set()
+        shared = {}  # (room, track_key) -> song
+        try:
+            for index, name, user, item, url in accepted:
+                entry, changed, shared_key = self._apply(name, user, item, url, now)
+                if changed:
+                    changed_rooms.add(name)
+                if shared_key:
+                    shared[(name, shared_key)] = entry["song"]
+                results[index] = {"user": user, "room": name, "status": "success", "track_key": entry["track_key"]}
+        finally:
+            # Whatever was stored gets its version bump, so long-polls never miss it.
+            for name in changed_rooms:
+                self.touch(name)
+        for (name, key), song in shared.items():
+            # A later item of the same batch may have moved a listener away again.
+            if len(self.same_song.listeners(name, key)) > 1:
+                self._announce_shared(name, key, song)
+        return results
+
+    def _apply(self, name, user, data, art_url, now):
+        """Stores one report without notifying anyone; returns (entry, visible change, newly shared key)."""
+        user = str(user)  # JSON object keys are strings anyway; the page index sorts by them
+        entry = {
+            "song": data.get("song") or "",
+            "platform": data.get("platform") or "unknown",
+            "art_url": art_url,
+            "timestamp": now
+        }
+        entry.update(playback_fields(data, now))
+        room = self.get_room(name)
+        previous = room.get(user)
+        room[user] = entry
+        room.move_to_end(user)
+        self.rooms.move_to_end(name)
+        self.recent[(name, user)] = None
+        self.recent.move_to_end((name, user))
+        if previous is None:
+            self.indexes[name].add(user)
+        changed = previous is None or any(previous.get(f) != entry[f] for f in VISIBLE_FIELDS)
+        trace_id = data.get("trace_id")
+        if isinstance(trace_id, str) and 0 < len(trace_id) <= MAX_TRACE_ID_LENGTH:
+            entry["trace_id"] = trace_id
+            # Heartbeats repeat the id of the change they belong to; only the change is timed.
+            if changed and (previous is None or previous.get("trace_id") != trace_id):
+                self.latency.stored(trace_id, *trace_times(data), now, time.time())
+        self.history.record(name, user, entry["song"], entry["platform"], now)
+        shared_key = self.same_song.update(name, user, entry["song"])
+        entry["track_key"] = self.same_song.key_of(name, user)
+        if changed:
+            self.changes[name].mark(user)
+        if previous is None and self._enforce_caps(name):
+            changed = True
+        return entry, changed, shared_key
+
+    def _announce_shared(self, name, key, song):
+        self.on_shared({
+            "room": name,
+            "track_key": key,
+            "song": song,
+            "users": sorted(self.same_song.listeners(name, key)),
+        })
+
+    # --- Queries ---
+    def same_song_listeners(self, name, user=None, song=None):
+        if song:
+            key = track_index.canonical_track_key(song)
+        else:
+            key = self.same_song.key_of(name, user)
+        users = sorted(self.same_song.listeners(name, key)) if key else []
+        return {"room": name, "track_key": key, "users": users}
+
+    def stats(self, name, window, k):
+        result = self.history.stats(name, window, k)
+        result.update({"room": name, "window": window})
+        return result
+
+    def report_latency(self, reports):
+        """Feeds POST /latency reports ({trace_id, delivered_at, rendered_at}); returns how many matched."""
+        accepted = 0
+        for report in reports[:latency_stats.MAX_REPORTS]:
+            if isinstance(report, dict) and isinstance(report.get("trace_id"), str):
+                accepted += self.latency.report(report["trace_id"], report.get("delivered_at"), report.get("rendered_at"))
+        return accepted
+
+    # --- Album art proxy ---
+    def proxied_art_url(self, url, url_root):
+        if self.art_cache is None or not art_proxy.allowed_origin(url):
+            return url
+        key = self.art_cache.register(url)
+        base = ART_PROXY_BASE_URL or url_root
+        return f"{base.rstrip('/')}/art/{key}"
+
+    # --- Chat ---
+    def add_message(self, name, data, now=None):
+        """Stores a send_message payload in room `name`; returns the message to broadcast, or None if it is malformed."""
+        entry = chat_entry(data, time.time() if now is None else now)
+        if entry is not None:
+            self._chat(name).append(entry)
+        return entry
+
+    def chat_history(self, name):
+        """The recent messages of room `name`, oldest first, to replay to a new connection."""
+        return list(self.chats.get(name, ()))
+
+    def room_names(self):
+        """Every room this node holds anything for: users, chat or listening history."""
+        return list(dict.fromkeys([*self.rooms, *self.chats, *sorted(self.history.room_names())]))
+
+    def _chat(self, name):
+        chat = self.chats.get(name)
+        if chat is None:
+            chat = self.chats[name] = deque(maxlen=CHAT_HISTORY_LIMIT)
+        self.chats.move_to_end(name)
+        while MAX_ROOMS and len(self.chats) > MAX_ROOMS:
+            self.chats.popitem(last=False)
+        return chat
+
+    # --- Admission control (per-user and per-IP token buckets) ---
+    def admit(self, user_limiter, ip_limiter, user, ip):
+        """Returns (allowed, retry_after) after charging both the IP and the user bucket."""
+        allowed, retry_after = ip_limiter.allow(ip)
+        if allowed:
+            allowed, retry_after = user_limiter.allow(str(user))
+        return allowed, retry_after
+
+    def admit_update(self, user, ip):
+        return self.admit(self.update_user_limiter, self.update_ip_limiter, user, ip)
+
+    def admit_batch(self, ip):
+        """A batch is charged once to the IP bucket; each item still goes through its user's bucket."""
+        return self.update_ip_limiter.allow(ip)
+
+    def admit_message(self, user, ip):
+        return self.admit(self.message_user_limiter, self.message_ip_limiter, user, ip)
+
+    def admit_connection(self):
+        """Counts a new Socket.IO connection; False (refuse it) once MAX_CONNECTIONS are open."""
+        if MAX_CONNECTIONS and self.connections >= MAX_CONNECTIONS:
+            self.refused_connections += 1
+            return False
+        self.connections += 1
+        return True
+
+    def connection_closed(self):
+        self.connections = max(0, self.connections - 1)
+
+    # --- Memory accounting ---
+    def memory(self):
+        """Sizes, caps and eviction counts for operators. Sizing the room state is O(users)."""
+        return {
+            "rooms": len(self.rooms),
+            "users": len(self.recent),
+            "largest_room": max((len(room) for room in self.rooms.values()), default=0),
+            "connections": self.connections,
+            "caps": {
+                "max_users": MAX_USERS,
+                "max_users_per_room": MAX_USERS_PER_ROOM,
+                "max_rooms": MAX_ROOMS,
+                "max_connections": MAX_CONNECTIONS,
+            },
+            "expired_users": self.expired_users,
+            "evicted_users": self.evicted_users,
+            "evicted_rooms": self.evicted_rooms,
+            "refused_connections": self.refused_connections,
+            "room_state_bytes": deep_size(self.rooms),
+            "same_song_entries": len(self.same_song),
+            "history": self.history.sizes(),
+            "chat_rooms": len(self.chats),
+            "chat_messages": sum(len(chat) for chat in self.chats.values()),
+            "cached_initial_states": len(self.initial_states),
+            "rate_limit_keys": {
+                "update_user": len(self.update_user_limiter),
+                "update_ip": len(self.update_ip_limiter),
+                "message_user": len(self.message_user_limiter),
+                "message_ip": len(self.message_ip_limiter),
+            },
+            "peak_rss_bytes": peak_rss_bytes(),
+        }
+
+    # --- Snapshot / warm restore across restarts ---
+    def build_snapshot(self):
+        """Takes a shallow copy of the state to persist, so writing never races with requests."""
+        return {
+            "saved_at": time.time(),
+            "rooms": {name: {user: dict(data) for user, data in users.items()} for name, users in self.rooms.items()},
+            "chat": {name: list(chat) for name, chat in self.chats.items()},
+        }
+
+    # --- Handing rooms between nodes (see room_cluster.py) ---
+    def export_rooms(self, names):
+        """
+        Everything this node holds for the given rooms, JSON-ready for another node's adopt_rooms:
+        {"rooms": {room: {user: entry}} (the snapshot format), "chat": {room: [message]},
+        "history": {room: plays} (see ListeningHistory.export)}. Empty rooms are left out.
+        """
+        return {
+            "rooms": {name: {user: dict(data) for user, data in self.rooms[name].items()}
+                      for name in names if self.rooms.get(name)},
+            "chat": {name: list(self.chats[name]) for name in names if self.chats.get(name)},
+            "history": self.history.export(names),
+        }
+
+    def adopt_rooms(self, handoff, now=None):
+        """
+        Takes over rooms handed off by another node (see export_rooms). A user already reported
+        here keeps whichever entry is newer; chats are merged by time and listening history is
+        added to this node's. Returns the number of users taken over.
+        """
+        now = time.time() if now is None else now
+        rooms = handoff.get("rooms") if isinstance(handoff.get("rooms"), dict) else {}
+        chats = handoff.get("chat") if isinstance(handoff.get("chat"), dict) else {}
+        history = handoff.get("history") if isinstance(handoff.get("history"), dict) else {}
+        for name, messages in chats.items():
+            messages = chat_entries(messages, now=now)
+            if messages:
+                chat = self._chat(room_name(name))
+                merged = sorted([*chat, *messages], key=lambda entry: entry["timestamp"])
+                chat.clear()
+                chat.extend(merged)
+        self.history.adopt({room_name(name): plays for name, plays in history.items()}, now)
+        adopted = 0
+        changed = []
+        for name, users in rooms.items():
+            if not isinstance(users, dict):
+                continue
+            name = room_name(name)
+            users = {user: data for user, data in users.items() if isinstance(data, dict)}
+            fresh = room_snapshot.fresh_users(users, INACTIVE_THRESHOLD, now)
+            if not fresh:
+                continue
+            room = self.get_room(name)
+            for user, data in fresh.items():
+                user = str(user)
+                if user in room and room[user].get("timestamp", 0) >= data.get("timestamp", 0):
+                    continue
+                room[user] = data
+                self.recent[(name, user)] = None
+                self.indexes[name].add(user)
+                self.changes[name].mark(user)
+                self.same_song.update(name, user, data.get("song"))
+                adopted += 1
+            changed.append(name)
+        # Handed-off entries keep their original timestamps, but expiry and eviction expect
+        # rooms and the recency order sorted by them: re-sort in place.
+        timestamp = lambda key: self.rooms[key[0]][key[1]].get("timestamp", 0)
+        for name in changed:
+            room = self.rooms[name]
+            for user in sorted(room, key=lambda user: room[user].get("timestamp", 0)):
+                room.move_to_end(user)
+        if changed:
+            for key in sorted(self.recent, key=timestamp):
+                self.recent.move_to_end(key)
+        for name in changed:
+            if name in self.rooms:
+                self.rooms.move_to_end(name)
+                self._enforce_caps(name)
+                self.touch(name)
+        return adopted
+
+    def drop_rooms(self, names):
+        """Forgets rooms another node took over; their long-polls wake up and find them gone."""
+        # Their plays went along with them, so nothing is closed here.
+        self.history.forget(names)
+        for name in names:
+            self.chats.pop(name, None)
+            room = self.rooms.get(name)
+            if room is None:
+                continue
+            if room:
+                for user in list(room):
+                    self._remove_user(name, user)
+                self.touch(name)
+            self._drop_room(name)
+
+    def restore_snapshot(self, snapshot):
+        """Loads a snapshot, dropping users and messages that went stale meanwhile."""
+        if not snapshot:
+            return
+        entries = []
+        rooms = snapshot.get("rooms")
+        if rooms is None:
+            # Snapshots from before named rooms hold only the default room, as "room_state".
+            rooms = {DEFAULT_ROOM: snapshot.get("room_state", {})}
+        for name, users in rooms.items():
+            for user, data in room_snapshot.fresh_users(users, INACTIVE_THRESHOLD).items():
+                entries.append((data.get("timestamp", 0), name, str(user), data))
+        # Oldest first, so rooms and the recency order come back as they were.
+        entries.sort(key=lambda entry: entry[0])
+        for _, name, user, data in entries:
+            room = self.get_room(name)
+            room[user] = data
+            self.rooms.move_to_end(name)
+            self.recent[(name, user)] = None
+            self.indexes[name].add(user)
+            self.same_song.update(name, user, data.get("song"))
+            self._enforce_caps(name)
+        restored_users = len(self.recent)
+        chats = snapshot.get("chat")
+        if chats is None:
+            # Snapshots from before per-room chat hold one chat, as "chat_history".
+            chats = {DEFAULT_ROOM: snapshot.get("chat_history", [])}
+        restored_messages = 0
+        for name, messages in chats.items():
+            messages = chat_entries(messages)
+            if messages:
+                self._chat(room_name(name)).extend(messages)
+                restored_messages += len(messages)
+        print(f"Snapshot: Restored {restored_users} users and {restored_messages} chat messages.")
+
+    def save_snapshot(self, path=SNAPSHOT_PATH, snapshot=None):
+        """Writes a snapshot (blocking; adapters run it off their event loop)."""
+        try:
+            room_snapshot.write_snapshot(path, snapshot or self.build_snapshot())
+        except OSError as e:
+            print(f"Snapshot: Failed to write '{path}': {e}")
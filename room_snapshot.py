@@ -0,0 +1,60 @@
+import json
+import os
+import time
+import zlib
+
+# --- Snapshot format ---
+# A 4-byte magic header followed by zlib-compressed compact JSON.
+SNAPSHOT_MAGIC = b"LTS1"
+
+def write_snapshot(path, state):
+    """
+    Serializes `state` to `path` atomically.
+    The data is written to a temporary file first and then renamed over the
+    old snapshot, so a crash mid-write never leaves a half-written file behind.
+    """
+    raw = json.dumps(state, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    payload = SNAPSHOT_MAGIC + zlib.compress(raw)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(payload)
+
+def read_snapshot(path):
+    """
+    Reads a snapshot written by write_snapshot.
+    Returns the state dictionary, or None if the file is missing or unreadable.
+    """
+    try:
+        with open(path, "rb") as f:
+            payload = f.read()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        print(f"Snapshot: Could not read '{path}': {e}")
+        return None
+
+    if not payload.startswith(SNAPSHOT_MAGIC):
+        print(f"Snapshot: '{path}' is not a room snapshot, ignoring it.")
+        return None
+    try:
+        return json.loads(zlib.decompress(payload[len(SNAPSHOT_MAGIC):]).decode("utf-8"))
+    except (zlib.error, ValueError) as e:
+        print(f"Snapshot: '{path}' is corrupt, ignoring it: {e}")
+        return None
+
+def fresh_users(users, max_age, now=None):
+    """Returns only the user entries whose 'timestamp' is younger than max_age seconds."""
+    now = now or time.time()
+    return {
+        user: data for user, data in users.items()
+        if now - data.get("timestamp", 0) <= max_age
+    }
+
+def fresh_messages(messages, max_age, now=None):
+    """Returns only the chat messages whose 'timestamp' is younger than max_age seconds."""
+    now = now or time.time()
+    return [m for m in messages if now - m.get("timestamp", 0) <= max_age]
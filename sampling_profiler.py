@@ -0,0 +1,158 @@
+import collections
+import functools
+import os
+import sys
+import time
+
+# Under eventlet, threading and time are monkey-patched: a "thread" would be a green thread
+# on the hub it is supposed to observe, and time.sleep would yield to it. The sampler needs
+# a real OS thread and a real sleep, so take the unpatched modules.
+try:
+    from eventlet import patcher
+    _thread = patcher.original("_thread")
+    _sleep = patcher.original("time").sleep
+except ImportError:
+    import _thread
+    _sleep = time.sleep
+
+try:
+    from greenlet import getcurrent
+except ImportError:
+    getcurrent = None
+
+# --- Opt-in sampling profiler ---
+# While a profiling window is open, a native thread wakes every `interval` seconds, reads the
+# stack the server thread is executing (sys._current_frames) and counts it. Requests that run
+# meanwhile are also sampled on their own, even while suspended: a waiting greenlet keeps its
+# stack in gr_frame. Requests slower than the threshold keep their samples. When no window is
+# open the only cost is one attribute check per request. Output is "folded" stacks
+# (frame;frame;frame count per line), as read by flamegraph.pl, speedscope and inferno.
+DEFAULT_INTERVAL = 0.01
+DEFAULT_SLOW_THRESHOLD = 0.5
+MAX_WINDOW = 10 * 60
+MAX_SLOW_CAPTURES = 50
+STACK_LIMIT = 64
+
+def folded_stack(frame, limit=STACK_LIMIT):
+    """Root-first "file:function;file:function" for a frame."""
+    parts = []
+    while frame is not None and len(parts) < limit:
+        code = frame.f_code
+        parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+def to_folded(counts):
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+class _Capture:
+    def __init__(self, label, greenlet):
+        self.label = label
+        self.greenlet = greenlet
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.counts = collections.Counter()
+
+class SamplingProfiler:
+    def __init__(self, max_slow=MAX_SLOW_CAPTURES):
+        self.active = False
+        self.interval = DEFAULT_INTERVAL
+        self.slow_threshold = DEFAULT_SLOW_THRESHOLD
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.started_at = None
+        self.deadline = 0.0
+        self.slow = collections.deque(maxlen=max_slow)
+        self._inflight = {}  # greenlet -> _Capture
+        self._target = None  # OS thread id of the thread serving requests
+        self._generation = 0
+
+    # --- Window control ---
+    def start(self, seconds, interval=DEFAULT_INTERVAL, slow_threshold=DEFAULT_SLOW_THRESHOLD):
+        """Opens a sampling window of `seconds` (restarting any open one) and clears old samples."""
+        self.interval = max(0.001, interval)
+        self.slow_threshold = slow_threshold
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.started_at = time.time()
+        self.deadline = time.monotonic() + min(seconds, MAX_WINDOW)
+        self._target = _thread.get_ident()
+        self._generation += 1
+        self.active = True
+        _thread.start_new_thread(self._run, (self._generation,))
+
+    def stop(self):
+        self.active = False
+        self._inflight.clear()
+
+    def status(self):
+        return {
+            "active": self.active,
+            "started_at": self.started_at,
+            "remaining_s": round(max(0.0, self.deadline - time.monotonic()), 1) if self.active else 0.0,
+            "interval_ms": round(self.interval * 1000, 2),
+            "slow_threshold_ms": round(self.slow_threshold * 1000, 1),
+            "samples": self.samples,
+            "stacks": len(self.counts),
+            "slow_captures": len(self.slow),
+        }
+
+    def folded(self):
+        return to_folded(self.counts)
+
+    # --- Per-request capture ---
+    def begin(self, label):
+        """Starts sampling the calling request on its own; returns a token for end() (None when off)."""
+        if not self.active or getcurrent is None:
+            return None
+        capture = _Capture(label, getcurrent())
+        self._inflight[capture.greenlet] = capture
+        return capture
+
+    def end(self, capture):
+        if capture is None:
+            return
+        self._inflight.pop(capture.greenlet, None)
+        duration = time.perf_counter() - capture.started
+        if duration >= self.slow_threshold:
+            self.slow.append({
+                "label": capture.label,
+                "started_at": capture.started_at,
+                "duration_ms": round(duration * 1000, 1),
+                "samples": sum(capture.counts.values()),
+                "folded": to_folded(capture.counts),
+            })
+
+    def track(self, label):
+        """Decorator for handlers that don't go through Flask's request hooks (Socket.IO events)."""
+        def decorator(handler):
+            @functools.wraps(handler)
+            def wrapper(*args, **kwargs):
+                capture = self.begin(label) if self.active else None
+                try:
+                    return handler(*args, **kwargs)
+                finally:
+                    self.end(capture)
+            return wrapper
+        return decorator
+
+    # --- Sampler thread ---
+    def _run(self, generation):
+        while self.active and generation == self._generation:
+            if time.monotonic() >= self.deadline:
+                self.stop()
+                break
+            self._sample()
+            _sleep(self.interval)
+
+    def _sample(self):
+        frame = sys._current_frames().get(self._target)
+        if frame is None:
+            return
+        self.samples += 1
+        self.counts[folded_stack(frame)] += 1
+        for greenlet, capture in list(self._inflight.items()):
+            # A suspended greenlet keeps its stack in gr_frame; the running one has none,
+            # in which case it is what the server thread is executing right now.
+            stack = greenlet.gr_frame or frame
+            capture.counts[folded_stack(stack)] += 1
@@ -1,7 +1,9 @@
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 import os
+import time
 import json # Import json for pretty printing
+import album_art
 
 # --- Configuration ---
 SPOTIPY_CLIENT_ID = '46f8721f46e744cbb55391627aaa7d63'
@@ -49,10 +51,23 @@ def initialize_spotify():
         print(f"SpotifyDetector: ERROR - An exception occurred during initialization: {e}")
         return False
 
-def get_current_spotify_song():
+def get_current_spotify_song(art_size=None):
     """
     Fetches the currently playing song from Spotify.
     Returns (song, artist, album_art_url) tuple or None.
+    With art_size (pixels), the album image closest to that size is picked instead of the largest.
+    """
+    playback = get_current_spotify_playback(art_size)
+    if not playback:
+        return None
+    return playback["song"], playback["artist"], playback["art_url"]
+
+def get_current_spotify_playback(art_size=None):
+    """
+    Fetches the currently playing song from Spotify, including where in the track the user is.
+    Returns a dict with song, artist, album, release_year, art_url, progress_ms, duration_ms and
+    sampled_at (local time.time() when the progress was read), or None.
+    With art_size (pixels), the album image closest to that size is picked instead of the largest.
     """
     if not sp: 
         return None
@@ -61,6 +76,7 @@ def get_current_spotify_song():
         # --- THE ULTIMATE DIAGNOSTIC ---
         # Get the raw response from the Spotify API
         current_track = sp.current_user_playing_track()
+        sampled_at = time.time()
         
         # Print the raw response to see exactly what Spotify is sending us
         print("\n--- Spotify API Raw Response ---")
@@ -76,9 +92,21 @@ def get_current_spotify_song():
                 
                 album = item.get('album', {})
                 images = album.get('images', [])
-                album_art_url = images[0].get('url') if images else None
+                if art_size:
+                    album_art_url = album_art.pick_spotify_image(images, art_size)
+                else:
+                    album_art_url = images[0].get('url') if images else None
                 
-                return song_name, artist_name, album_art_url
+                return {
+                    "song": song_name,
+                    "artist": artist_name,
+                    "album": album.get('name'),
+                    "release_year": (album.get('release_date') or '')[:4] or None,
+                    "art_url": album_art_url,
+                    "progress_ms": current_track.get('progress_ms'),
+                    "duration_ms": item.get('duration_ms'),
+                    "sampled_at": sampled_at,
+                }
         
         # If we reach here, it means nothing is playing or the structure is unexpected.
         return None
@@ -0,0 +1,286 @@
+import asyncio
+import base64
+import heapq
+import itertools
+import os
+import time
+
+import aiohttp
+
+import album_art
+import rate_limit
+
+# --- Server-side Spotify poller farm (optional, asyncio server mode only) ---
+# Instead of every client polling Spotify in its own 5 s loop, users link their account once
+# by handing over a refresh token. One asyncio task then polls currently-playing for all of
+# them over a shared connection pool, spacing each user's polls by what they are doing and
+# backing off for everyone when Spotify rate-limits the app. Results go straight into room state.
+SPOTIFY_ACCOUNTS_URL = os.environ.get("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com")
+SPOTIFY_API_URL = os.environ.get("SPOTIFY_API_URL", "https://api.spotify.com/v1")
+HTTP_TIMEOUT = 10
+
+# Per-user intervals (seconds). Playing users are polled again around the end of the track,
+# but at least every PLAYING_INTERVAL to notice skips. Idle users back off up to
+# IDLE_MAX_INTERVAL, which stays below the room's INACTIVE_THRESHOLD so they don't drop out.
+MIN_INTERVAL = 1
+PLAYING_INTERVAL = 10
+TRACK_END_SLACK = 1
+IDLE_MAX_INTERVAL = 20
+ERROR_MAX_INTERVAL = 120
+TOKEN_MARGIN = 60  # refresh access tokens this many seconds before they expire
+
+# App-wide limits: Spotify rate-limits per client id, so all users share one budget.
+GLOBAL_RATE = float(os.environ.get("SPOTIFY_FARM_RATE", "10"))
+GLOBAL_BURST = float(os.environ.get("SPOTIFY_FARM_BURST", "20"))
+MAX_CONCURRENCY = int(os.environ.get("SPOTIFY_FARM_CONCURRENCY", "20"))
+MAX_USERS = int(os.environ.get("SPOTIFY_FARM_MAX_USERS", "1000"))
+
+class AuthError(Exception):
+    """The refresh token was rejected (revoked, expired or never valid)."""
+
+class BadResponse(Exception):
+    """Spotify answered 2xx, but not with the JSON object we expected."""
+
+class RateLimited(Exception):
+    """Spotify answered 429; `seconds` is its Retry-After."""
+    def __init__(self, seconds):
+        super().__init__(f"rate limited for {seconds}s")
+        self.seconds = seconds
+
+class LinkedListener:
+    """One linked account and its polling state."""
+    def __init__(self, user, room, refresh_token, url_root):
+        self.user = user
+        self.room = room
+        self.refresh_token = refresh_token
+        self.link_token = refresh_token  # Spotify may rotate refresh_token; unlinking uses this one
+        self.url_root = url_root
+        self.access_token = None
+        self.expires_at = 0.0
+        self.idle_polls = 0
+        self.failures = 0
+        self.generation = None  # id of the latest heap entry; older entries are skipped
+
+def playback_from(body, sampled_at, art_size=album_art.SEAT_ART_SIZE):
+    """Turns a currently-playing response into the fields a client would report, or None if idle."""
+    if not body or not body.get("is_playing") or not body.get("item"):
+        return None
+    item = body["item"]
+    artists = ', '.join(artist.get('name') for artist in item.get('artists', []))
+    images = (item.get('album') or {}).get('images', [])
+    return {
+        "song": f"{item.get('name')} - {artists}" if artists else item.get('name'),
+        "art_url": album_art.pick_spotify_image(images, art_size),
+        "progress_ms": body.get("progress_ms"),
+        "duration_ms": item.get("duration_ms"),
+        "sampled_at": sampled_at,
+    }
+
+def next_interval(listener, playback):
+    if playback is None:
+        listener.idle_polls += 1
+        return min(IDLE_MAX_INTERVAL, PLAYING_INTERVAL * 2 ** (listener.idle_polls - 1))
+    listener.idle_polls = 0
+    progress_ms, duration_ms = playback.get("progress_ms"), playback.get("duration_ms")
+    if not progress_ms or not duration_ms:
+        return PLAYING_INTERVAL
+    remaining = (duration_ms - progress_ms) / 1000
+    return max(MIN_INTERVAL, min(PLAYING_INTERVAL, remaining + TRACK_END_SLACK))
+
+class SpotifyPollerFarm:
+    """
+    report(room, user, data, url_root) is called after every successful poll with the same
+    fields a client posts to /update_state (song is "" when nothing is playing).
+    """
+
+    def __init__(self, report, client_id, client_secret, api_url=SPOTIFY_API_URL,
+                 accounts_url=SPOTIFY_ACCOUNTS_URL, concurrency=MAX_CONCURRENCY, max_users=MAX_USERS):
+        self.report = report
+        self.api_url = api_url.rstrip('/')
+        self.accounts_url = accounts_url.rstrip('/')
+        self.max_users = max_users
+        self._basic_auth = base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
+        self.listeners = {}  # user -> LinkedListener
+        self.limiter = rate_limit.TokenBucketLimiter(GLOBAL_RATE, GLOBAL_BURST, max_keys=1)
+        self.paused_until = 0.0  # monotonic time until which Spotify asked the whole app to wait
+        self.session = None
+        self._concurrency = concurrency
+        self._slots = asyncio.Semaphore(concurrency)
+        self._queue = []  # heap of (due, seq, user, generation)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._polls = set()
+        # Instrumentation
+        self.polls = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    async def start(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self._concurrency),
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT),
+        )
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = [self._task, *self._polls] if self._task else list(self._polls)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.session is not None:
+            await self.session.close()
+
+    # --- Linking ---
+    async def link(self, user, room, refresh_token, url_root):
+        """
+        Checks the refresh token once and starts polling for `user`.
+        Raises AuthError, RateLimited, BadResponse, ValueError (too many users) or aiohttp errors.
+        """
+        if user not in self.listeners and len(self.listeners) >= self.max_users:
+            raise ValueError("Too many linked accounts")
+        listener = LinkedListener(user, room, refresh_token, url_root)
+        await self._refresh(listener)
+        self.listeners[user] = listener
+        self._schedule(listener, 0)
+
+    def unlink(self, user, refresh_token):
+        """Stops polling for `user`; only whoever knows the token may unlink it."""
+        listener = self.listeners.get(user)
+        if listener is None or listener.link_token != refresh_token:
+            return False
+        del self.listeners[user]
+        return True
+
+    def stats(self):
+        return {
+            "linked": len(self.listeners),
+            "polls": self.polls,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "paused_for": round(max(0.0, self.paused_until - time.monotonic()), 1),
+        }
+
+    # --- Scheduling ---
+    def _schedule(self, listener, delay):
+        listener.generation = next(self._seq)
+        heapq.heappush(self._queue, (time.monotonic() + delay, listener.generation, listener.user, listener.generation))
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            due, _, user, generation = self._queue[0]
+            now = time.monotonic()
+            wait = max(due, self.paused_until) - now
+            if wait > 0:
+                # Sleep until the next poll is due, unless something earlier gets scheduled.
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            heapq.heappop(self._queue)
+            listener = self.listeners.get(user)
+            if listener is None or listener.generation != generation:
+                continue  # Unlinked or rescheduled meanwhile
+            allowed, retry_after = self.limiter.allow("spotify", now)
+            if not allowed:
+                heapq.heappush(self._queue, (now + retry_after, next(self._seq), user, generation))
+                continue
+            await self._slots.acquire()
+            task = asyncio.create_task(self._poll(listener))
+            self._polls.add(task)
+            task.add_done_callback(self._poll_done)
+
+    def _poll_done(self, task):
+        self._polls.discard(task)
+        self._slots.release()
+
+    # --- Spotify calls ---
+    async def _poll(self, listener):
+        self.polls += 1
+        try:
+            playback = await self._currently_playing(listener)
+        except AuthError as e:
+            print(f"Spotify farm: Unlinking '{listener.user}': {e}")
+            if self.listeners.get(listener.user) is listener:
+                del self.listeners[listener.user]
+            return
+        except RateLimited as e:
+            self.rate_limited += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + e.seconds)
+            self._schedule(listener, e.seconds)
+            return
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, BadResponse) as e:
+            self.errors += 1
+            listener.failures += 1
+            delay = min(ERROR_MAX_INTERVAL, PLAYING_INTERVAL * 2 ** (listener.failures - 1))
+            print(f"Spotify farm: Poll for '{listener.user}' failed ({e!r}), retrying in {delay}s")
+            self._schedule(listener, delay)
+            return
+        listener.failures = 0
+        if self.listeners.get(listener.user) is not listener:
+            return  # Unlinked while the request was in flight
+        self.report(listener.room, listener.user, playback or {"song": "", "art_url": None}, listener.url_root)
+        self._schedule(listener, next_interval(listener, playback))
+
+    async def _currently_playing(self, listener):
+        if listener.access_token is None or time.monotonic() >= listener.expires_at:
+            await self._refresh(listener)
+        headers = {"Authorization": f"Bearer {listener.access_token}"}
+        async with self.session.get(f"{self.api_url}/me/player/currently-playing", headers=headers) as response:
+            sampled_at = time.time()
+            if response.status == 204:
+                return None
+            if response.status == 401:
+                listener.access_token = None  # Refresh on the next poll
+                raise aiohttp.ClientResponseError(response.request_info, response.history, status=401)
+            if response.status == 429:
+                raise RateLimited(retry_after(response))
+            response.raise_for_status()
+            body = await json_object(response)
+        try:
+            return playback_from(body, sampled_at)
+        except (AttributeError, TypeError) as e:
+            raise BadResponse(f"unexpected currently-playing body: {e!r}") from e
+
+    async def _refresh(self, listener):
+        data = {"grant_type": "refresh_token", "refresh_token": listener.refresh_token}
+        headers = {"Authorization": f"Basic {self._basic_auth}"}
+        async with self.session.post(f"{self.accounts_url}/api/token", data=data, headers=headers) as response:
+            if response.status in (400, 401):
+                raise AuthError(f"refresh token rejected ({response.status})")
+            if response.status == 429:
+                raise RateLimited(retry_after(response))
+            response.raise_for_status()
+            body = await json_object(response)
+        if not isinstance(body.get("access_token"), str):
+            raise BadResponse("token response without an access_token")
+        expires_in = body.get("expires_in", 3600)
+        if not isinstance(expires_in, (int, float)):
+            expires_in = 3600
+        listener.access_token = body["access_token"]
+        listener.expires_at = time.monotonic() + expires_in - TOKEN_MARGIN
+        # Spotify may rotate the refresh token.
+        if body.get("refresh_token"):
+            listener.refresh_token = body["refresh_token"]
+
+async def json_object(response):
+    try:
+        body = await response.json()
+    except ValueError as e:
+        raise BadResponse(f"invalid JSON: {e}") from e
+    if not isinstance(body, dict):
+        raise BadResponse(f"expected a JSON object, got {type(body).__name__}")
+    return body
+
+def retry_after(response):
+    try:
+        return max(1.0, float(response.headers.get("Retry-After", "1")))
+    except ValueError:
+        return 1.0
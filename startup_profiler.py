@@ -0,0 +1,71 @@
+import sys
+import time
+from contextlib import contextmanager
+
+# --- Startup profiling for the desktop clients ---
+# Import this module first in an entry script so the clock starts as early as possible.
+# Profiling is only active when the app is launched with --profile-startup.
+PROFILE_FLAG = "--profile-startup"
+REPORT_FILE = "startup_profile.txt"
+
+_start = time.perf_counter()
+enabled = PROFILE_FLAG in sys.argv
+_marks = []  # (label, seconds since start, duration or None)
+_reported = 0  # how many marks have been reported so far
+
+def mark(label):
+    """Records a point in time since startup."""
+    if enabled:
+        _marks.append((label, time.perf_counter() - _start, None))
+
+@contextmanager
+def timed(label):
+    """Records how long the wrapped block takes, e.g. an import of a heavy module."""
+    if not enabled:
+        yield
+        return
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        _marks.append((label, end - _start, end - begin))
+
+def report():
+    """
+    Prints the timings collected since the last report.
+    PyInstaller --windowed builds have no console, so there it appends to REPORT_FILE instead.
+    """
+    global _reported
+    if not enabled or _reported == len(_marks):
+        return
+    lines = ["--- Startup profile ---"] if _reported == 0 else []
+    for label, at, duration in _marks[_reported:]:
+        if duration is None:
+            lines.append(f"{at * 1000:8.1f} ms  {label}")
+        else:
+            lines.append(f"{at * 1000:8.1f} ms  {label} (took {duration * 1000:.1f} ms)")
+    _reported = len(_marks)
+    text = "\n".join(lines)
+    if sys.stdout is not None:
+        print(text)
+    else:
+        with open(REPORT_FILE, "a", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+def watch_first_paint(widget, label="first paint"):
+    """Marks the first paint event of `widget` and then prints the report."""
+    if not enabled:
+        return
+    from PySide6.QtCore import QObject, QEvent
+
+    class _FirstPaintFilter(QObject):
+        def eventFilter(self, obj, event):
+            if event.type() == QEvent.Paint:
+                obj.removeEventFilter(self)
+                mark(label)
+                report()
+            return False
+
+    widget._first_paint_filter = _FirstPaintFilter(widget)
+    widget.installEventFilter(widget._first_paint_filter)
@@ -0,0 +1,144 @@
+import io
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+
+import pytest
+
+import art_proxy
+import room_service
+
+PIL = pytest.importorskip("PIL.Image")
+
+def png_bytes(size=(400, 300)):
+    out = io.BytesIO()
+    PIL.new("RGB", size, (200, 40, 40)).save(out, format="PNG")
+    return out.getvalue()
+
+@pytest.fixture
+def origin():
+    """A stand-in image CDN on 127.0.0.1: /cover.png, /big.png and redirects."""
+    image = png_bytes()
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            if self.path == "/cover.png":
+                self._send(image)
+            elif self.path == "/big.png":
+                self._send(b"\0" * (art_proxy.MAX_ORIGIN_BYTES + 10))
+            elif self.path.startswith("/redirect?to="):
+                self.send_response(302)
+                self.send_header("Location", self.path.split("=", 1)[1])
+                self.end_headers()
+            else:
+                self.send_error(404)
+
+        def _send(self, body):
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", requests
+    server.shutdown()
+    server.server_close()
+
+HOSTS = ("127.0.0.1",)
+
+@pytest.mark.parametrize("url", [
+    "http://p1.music.126.net/abc/109951.jpg",
+    "https://p2.music.126.net/x.jpg?param=80y80",
+    "https://i.scdn.co/image/ab67616d0000b273",
+])
+def test_cdn_hosts_are_allowed(url):
+    assert art_proxy.allowed_origin(url)
+
+@pytest.mark.parametrize("url", [
+    "http://169.254.169.254/latest/meta-data/",
+    "http://localhost:8080/admin",
+    "http://127.0.0.1/",
+    "http://i.scdn.co.example.com/x.jpg",
+    "http://example.com/?u=i.scdn.co",
+    "http://i.scdn.co@169.254.169.254/",
+    "http://music.126.net.example.com/x.jpg",
+    "file:///etc/passwd",
+    "ftp://i.scdn.co/x.jpg",
+    "",
+    None,
+    123,
+    ["http://i.scdn.co/x"],
+])
+def test_other_urls_are_refused(url):
+    assert not art_proxy.allowed_origin(url)
+
+def test_fetch_and_resize_from_origin(origin):
+    base, _ = origin
+    thumbnails = art_proxy.make_thumbnails(art_proxy.fetch_image(f"{base}/cover.png", HOSTS))
+    assert sorted(thumbnails) == sorted(art_proxy.STANDARD_SIZES)
+    for size, data in thumbnails.items():
+        image = PIL.open(io.BytesIO(data))
+        assert image.format == "JPEG"
+        assert max(image.size) == size
+
+def test_fetch_refuses_hosts_off_the_list(origin):
+    base, requests = origin
+    with pytest.raises(ValueError):
+        art_proxy.fetch_image(f"{base}/cover.png")  # 127.0.0.1 is not an art CDN
+    assert requests == []
+
+def test_redirects_stay_on_the_list(origin):
+    base, requests = origin
+    data = art_proxy.fetch_image(f"{base}/redirect?to={base}/cover.png", HOSTS)
+    assert data.startswith(b"\x89PNG")
+    port = base.rsplit(":", 1)[1]
+    with pytest.raises(HTTPError):
+        art_proxy.fetch_image(f"{base}/redirect?to=http://localhost:{port}/cover.png", HOSTS)
+    assert requests.count("/cover.png") == 1  # the disallowed target was never requested
+
+def test_oversized_origin_images_are_refused(origin):
+    base, _ = origin
+    with pytest.raises(ValueError):
+        art_proxy.fetch_image(f"{base}/big.png", HOSTS)
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = art_proxy.ThumbnailCache(str(tmp_path), max_bytes=250)
+    cache.store("a" * 24, {80: b"x" * 100})
+    cache.store("b" * 24, {80: b"x" * 100})
+    assert cache.lookup("a" * 24, 80)  # a is now the most recently used
+    written = cache.write("c" * 24, {80: b"x" * 100})
+    evicted = cache.add("c" * 24, written)
+    assert evicted == ["b" * 24]
+    cache.remove_files(evicted)
+    assert not (tmp_path / f"{'b' * 24}_80.jpg").exists()
+    assert cache.lookup("b" * 24, 80) is None
+    assert cache.total_bytes == 200
+
+def test_only_cdn_art_urls_are_proxied(tmp_path):
+    service = room_service.RoomService()
+    service.art_cache = art_proxy.ThumbnailCache(str(tmp_path), max_bytes=1024)
+    url = "https://i.scdn.co/image/ab67616d0000b273"
+    proxied = service.proxied_art_url(url, "http://server/")
+    assert proxied == f"http://server/art/{art_proxy.art_key(url)}"
+    assert service.art_cache.origin(art_proxy.art_key(url)) == url
+    for other in ("http://169.254.169.254/latest/meta-data/", None, 123, ""):
+        assert service.proxied_art_url(other, "http://server/") == other
+
+def test_read_survives_eviction_after_lookup(tmp_path):
+    cache = art_proxy.ThumbnailCache(str(tmp_path), max_bytes=150)
+    cache.store("a" * 24, {80: b"a" * 100})
+    path = cache.lookup("a" * 24, 80)
+    assert cache.read(path) == b"a" * 100
+    # Another cover evicts a between lookup() and read(): the server gets None and refetches
+    # instead of failing halfway through a file response.
+    cache.store("b" * 24, {80: b"b" * 100})
+    assert cache.read(path) is None
+    assert cache.lookup("a" * 24, 80) is None
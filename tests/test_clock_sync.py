@@ -0,0 +1,46 @@
+import pytest
+
+import clock_sync
+
+def test_offset_and_rtt_exclude_server_processing():
+    # Server clock is 100 s ahead; 0.1 s each way; server spends 0.5 s.
+    offset, rtt = clock_sync.offset_and_rtt(10.0, 110.1, 110.6, 10.7)
+    assert offset == pytest.approx(100.0)
+    assert rtt == pytest.approx(0.2)
+
+def test_estimator_has_no_offset_before_a_sample():
+    estimator = clock_sync.ClockOffsetEstimator()
+    assert estimator.offset is None
+    assert estimator.to_server_time(5.0) is None
+
+def test_estimator_trusts_the_fastest_round_trip():
+    estimator = clock_sync.ClockOffsetEstimator()
+    estimator.add_sample(0.0, 100.9, 100.9, 1.0)  # slow, asymmetric: offset 100.4
+    estimator.add_sample(2.0, 102.05, 102.05, 2.1)  # fast: offset 100.0
+    estimator.add_sample(3.0, 103.1, 103.1, 3.6)  # slow again: offset 99.8
+    assert estimator.offset == pytest.approx(100.0)
+    assert estimator.to_server_time(10.0) == pytest.approx(110.0)
+
+def test_estimator_ignores_negative_round_trips():
+    estimator = clock_sync.ClockOffsetEstimator()
+    estimator.add_sample(5.0, 100.0, 101.0, 5.5)
+    assert estimator.offset is None
+
+def test_estimator_forgets_old_samples():
+    estimator = clock_sync.ClockOffsetEstimator(max_samples=2)
+    estimator.add_sample(0.0, 50.0, 50.0, 0.0)  # rtt 0, offset 50
+    estimator.add_sample(1.0, 101.1, 101.1, 1.2)
+    estimator.add_sample(2.0, 102.1, 102.1, 2.2)
+    # The zero-rtt sample fell out of the window.
+    assert estimator.offset == pytest.approx(100.0)
+
+@pytest.mark.parametrize("progress_ms, duration_ms, sampled_at, now, expected", [
+    (1000, 200000, 50.0, 52.5, 3500),
+    (1000, 200000, 50.0, 50.0, 1000),
+    (1000, 200000, 50.0, 49.0, 1000),  # a sample from the future never rewinds
+    (199000, 200000, 50.0, 60.0, 200000),  # clamped to the end of the track
+    (1000, 0, 50.0, 60.0, 11000),  # unknown duration is not clamped
+    (1000, None, 50.0, 51.2345, 2234),
+])
+def test_extrapolate_position(progress_ms, duration_ms, sampled_at, now, expected):
+    assert clock_sync.extrapolate_position(progress_ms, duration_ms, sampled_at, now) == expected
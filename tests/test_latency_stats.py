@@ -0,0 +1,84 @@
+import pytest
+
+import latency_stats
+
+def histogram(*values_ms):
+    result = latency_stats.LatencyHistogram(bounds_ms=(10, 100, 1000))
+    for ms in values_ms:
+        result.add(ms)
+    return result
+
+def test_empty_histogram_has_no_percentiles():
+    summary = histogram().summary()
+    assert summary["count"] == 0
+    assert summary["avg_ms"] is None and summary["p50_ms"] is None
+
+@pytest.mark.parametrize("fraction, expected", [
+    (0.0, 10),
+    (0.5, 10),  # 5 of 10 values are <= 10 ms
+    (0.6, 100),
+    (0.9, 1000),
+    (1.0, 4321.0),  # past the last bound: the largest value seen
+])
+def test_percentile_is_the_upper_bound_of_its_bucket(fraction, expected):
+    result = histogram(1, 2, 3, 10, 10, 11, 50, 100, 999, 4321)
+    assert result.percentile(fraction) == expected
+
+def test_values_on_a_bound_fall_into_that_bucket():
+    result = histogram(10, 100, 1000, 1000.5)
+    assert result.counts == [1, 1, 1, 1]
+    assert result.summary()["buckets"] == {"le_10": 1, "le_100": 1, "le_1000": 1, "inf": 1}
+    assert result.summary()["max_ms"] == 1000.5
+
+@pytest.mark.parametrize("start, end, expected", [
+    (100.0, 100.25, 0.25),
+    (100.0, 99.5, 0.0),  # slightly negative from clock error counts as 0
+    (100.0, 98.5, None),  # further off is discarded
+    (0.0, latency_stats.MAX_STAGE_SECONDS + 1, None),
+    (None, 100.0, None),
+    ("100", 101.0, None),
+])
+def test_stage_seconds(start, end, expected):
+    assert latency_stats.stage_seconds({"a": start, "b": end}, "a", "b") == expected
+
+def test_tracker_fills_each_stage_once():
+    tracker = latency_stats.LatencyTracker()
+    tracker.stored("t1", 100.0, 100.1, 100.3, 100.31)
+    assert [tracker.histograms[s].count for s in ("detect", "upload", "server", "delivery")] == [1, 1, 1, 0]
+    assert tracker.report("t1", 100.5, 100.6)
+    assert tracker.report("t1", 100.7, 100.9)  # a second friend
+    assert tracker.histograms["delivery"].count == 2
+    assert tracker.histograms["render"].count == 2
+    assert tracker.histograms["total"].count == 2
+    assert tracker.histograms["total"].max_ms == pytest.approx(900.0)
+    assert tracker.discarded == 0
+
+def test_implausible_stages_are_discarded():
+    tracker = latency_stats.LatencyTracker()
+    # The sender's clock is off by minutes: detect and upload are nonsense, server is fine.
+    tracker.stored("t1", 500.0, 500.1, 100.0, 100.01)
+    assert tracker.histograms["detect"].count == 1
+    assert tracker.histograms["upload"].count == 0
+    assert tracker.histograms["server"].count == 1
+    assert tracker.discarded == 1
+    # A friend's report from before the update was stored is dropped too.
+    tracker.report("t1", 90.0, 90.1)
+    assert tracker.histograms["delivery"].count == 0
+    assert tracker.histograms["render"].count == 1
+    assert tracker.discarded == 3  # delivery and total (detected_at 500 -> 90.1)
+
+def test_missing_timestamps_are_skipped_not_discarded():
+    tracker = latency_stats.LatencyTracker()
+    tracker.stored("t1", None, None, 100.0, 100.01)
+    assert tracker.histograms["detect"].count == tracker.histograms["upload"].count == 0
+    assert tracker.histograms["server"].count == 1
+    assert tracker.discarded == 0
+
+def test_unknown_and_forgotten_traces():
+    tracker = latency_stats.LatencyTracker(max_pending=2)
+    for trace_id in ("t1", "t2", "t3"):
+        tracker.stored(trace_id, 100.0, 100.1, 100.2, 100.3)
+    assert list(tracker.pending) == ["t2", "t3"]
+    assert not tracker.report("t1", 101.0, 101.1)
+    assert not tracker.report("nope", 101.0, 101.1)
+    assert tracker.unknown == 2 and tracker.reports == 0
@@ -0,0 +1,124 @@
+import random
+
+import pytest
+
+import listening_history
+
+def test_ranked_counter_tracks_increments_and_decrements():
+    counter = listening_history.RankedCounter()
+    for key in "abacabad":
+        counter.increment(key)
+    assert counter.top_k(2) == [("a", 4), ("b", 2)]
+    assert counter.top_k(10) == [("a", 4), ("b", 2), ("c", 1), ("d", 1)]
+    counter.decrement("a")
+    counter.decrement("a")
+    counter.decrement("a")
+    assert counter.top_k(2) == [("b", 2), ("c", 1)]
+    counter.decrement("d")
+    counter.decrement("d")  # already gone
+    counter.decrement("missing")
+    assert len(counter) == 3
+    assert counter.count("d") == 0
+
+def test_ranked_counter_matches_a_plain_count():
+    rng = random.Random(7)
+    counter = listening_history.RankedCounter()
+    expected = {}
+    for _ in range(5000):
+        key = rng.randrange(30)
+        if rng.random() < 0.6 or not expected.get(key):
+            counter.increment(key)
+            expected[key] = expected.get(key, 0) + 1
+        else:
+            counter.decrement(key)
+            expected[key] -= 1
+        assert counter.count(key) == expected[key]
+    ranked = counter.top_k(len(counter))
+    assert [n for _, n in ranked] == sorted((n for n in expected.values() if n), reverse=True)
+    assert dict(ranked) == {key: n for key, n in expected.items() if n}
+
+def test_ranked_totals():
+    totals = listening_history.RankedTotals()
+    totals.add("rex", 30.5)
+    totals.add("ann", 120)
+    totals.add("bob", 60)
+    totals.add("rex", 100)
+    assert totals.top_k(2) == [("rex", 130.5), ("ann", 120)]
+    totals.add("rex", -130.5)
+    assert totals.top_k(5) == [("ann", 120), ("bob", 60)]
+    assert len(totals) == 2 and totals.total("rex") == 0
+
+def play(history, user, song, start, end, room="den"):
+    history.record(room, user, song, "spotify", start)
+    history.close(room, user, end)
+
+def test_stats_rank_tracks_artists_and_listeners():
+    history = listening_history.ListeningHistory({"1h": 3600})
+    play(history, "rex", "Song A - Artist, Guest", 0, 100)
+    play(history, "ann", "Song A - Artist, Guest", 0, 200)
+    play(history, "bob", "Song B - Artist", 0, 50)
+    stats = history.stats("den", "1h", k=2, now=300)
+    assert stats["top_tracks"] == [{"song": "Song A - Artist, Guest", "plays": 2}, {"song": "Song B - Artist", "plays": 1}]
+    assert stats["top_artists"] == [{"artist": "Artist", "plays": 3}, {"artist": "Guest", "plays": 2}]
+    # Only the top k listeners, so the answer doesn't grow with the room.
+    assert stats["listening_time"] == {"ann": 200.0, "rex": 100.0}
+
+def test_switching_songs_closes_the_play():
+    history = listening_history.ListeningHistory({"1h": 3600})
+    history.record("den", "rex", "Song A - Artist", "spotify", 0)
+    history.record("den", "rex", "Song A - Artist", "spotify", 30)  # heartbeat
+    history.record("den", "rex", "Song B - Artist", "spotify", 60)
+    history.record("den", "rex", "", "spotify", 90)  # paused
+    stats = history.stats("den", "1h", now=100)
+    assert [t["song"] for t in stats["top_tracks"]] == ["Song A - Artist", "Song B - Artist"]
+    assert stats["listening_time"] == {"rex": 90.0}
+    assert history.sizes()["open_plays"] == 0
+
+def test_plays_leave_the_window():
+    history = listening_history.ListeningHistory({"1h": 3600, "24h": 86400})
+    play(history, "rex", "Old - Artist", 0, 100)
+    play(history, "rex", "New - Artist", 4000, 4100)
+    assert history.stats("den", "1h", now=4200)["top_tracks"] == [{"song": "New - Artist", "plays": 1}]
+    assert history.stats("den", "1h", now=4200)["listening_time"] == {"rex": 100.0}
+    assert len(history.stats("den", "24h", now=4200)["top_tracks"]) == 2
+    # A room whose plays all left the window has no aggregates left.
+    assert history.stats("den", "1h", now=9000) == {"top_tracks": [], "top_artists": [], "listening_time": {}}
+    assert "den" not in history.windows["1h"].rooms
+
+def test_max_events_evicts_the_oldest_plays():
+    history = listening_history.ListeningHistory({"24h": 86400}, max_events=3)
+    for i in range(5):
+        play(history, f"user{i}", f"Song {i} - Artist", i * 10, i * 10 + 5)
+    stats = history.stats("den", "24h", now=100)
+    assert {t["song"] for t in stats["top_tracks"]} == {"Song 2 - Artist", "Song 3 - Artist", "Song 4 - Artist"}
+    assert stats["top_artists"] == [{"artist": "Artist", "plays": 3}]
+    assert history.sizes()["events"] == {"24h": 3}
+
+def test_adopted_plays_join_the_windows_in_time_order():
+    old = listening_history.ListeningHistory({"1h": 3600, "24h": 86400})
+    play(old, "rex", "Old - Artist", 0, 100)
+    play(old, "rex", "Recent - Artist", 5000, 5100)
+    play(old, "rex", "Elsewhere - Artist", 0, 100, room="attic")
+    old.record("den", "ann", "Open - Artist", "spotify", 5200)
+    new = listening_history.ListeningHistory({"1h": 3600, "24h": 86400})
+    play(new, "bob", "Local - Artist", 4000, 4100)
+    new.adopt(old.export(["den"]), now=5300)
+
+    assert [t["song"] for t in new.stats("den", "1h", now=5300)["top_tracks"]] == ["Local - Artist", "Recent - Artist"]
+    assert len(new.stats("den", "24h", now=5300)["top_tracks"]) == 3
+    assert new.stats("attic", "24h", now=5300)["top_tracks"] == []
+    # ann's play is still open; it counts once she moves on.
+    new.close("den", "ann", 5250)
+    assert new.stats("den", "1h", now=5300)["listening_time"]["ann"] == 50.0
+    # Eviction from the front still goes oldest first.
+    assert [event["end"] for event in new.windows["24h"].events] == [100, 4100, 5100, 5250]
+
+@pytest.mark.parametrize("song, artists", [
+    ("Song - A, B", ["A", "B"]),
+    ("Title - With - Dash - Artist", ["Artist"]),
+    ("No artist", []),
+    (None, []),
+    (123, []),
+])
+def test_split_artists(song, artists):
+    assert listening_history.split_artists(song) == artists
@@ -0,0 +1,164 @@
+import asyncio
+import shutil
+import subprocess
+
+import pytest
+from dbus_next import Variant
+from dbus_next.aio import MessageBus
+from dbus_next.service import PropertyAccess, ServiceInterface, dbus_property, signal
+
+import mpris_detector
+
+pytestmark = pytest.mark.skipif(shutil.which("dbus-daemon") is None, reason="needs dbus-daemon")
+
+@pytest.fixture
+def session_bus(monkeypatch):
+    """A private session bus, so the tests never see the desktop's players."""
+    daemon = subprocess.Popen(["dbus-daemon", "--session", "--nofork", "--print-address"],
+                              stdout=subprocess.PIPE, text=True)
+    address = daemon.stdout.readline().strip()
+    monkeypatch.setenv("DBUS_SESSION_BUS_ADDRESS", address)
+    yield address
+    daemon.terminate()
+    daemon.wait(timeout=10)
+
+class FakePlayer(ServiceInterface):
+    """The org.mpris.MediaPlayer2.Player properties the detector reads."""
+
+    def __init__(self):
+        super().__init__(mpris_detector.PLAYER_INTERFACE)
+        self.status = "Stopped"
+        self.metadata = {}
+        self.position_us = 0
+        self.position_reads = 0
+
+    @dbus_property(access=PropertyAccess.READ)
+    def PlaybackStatus(self) -> "s":
+        return self.status
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Metadata(self) -> "a{sv}":
+        return self.metadata
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Position(self) -> "x":
+        self.position_reads += 1
+        return self.position_us
+
+    @signal()
+    def Seeked(self) -> "x":
+        return self.position_us
+
+    def play(self, title, artist, length_us=200_000_000, art_url="https://i.scdn.co/image/cover"):
+        self.status = "Playing"
+        self.metadata = {"xesam:title": Variant("s", title), "xesam:artist": Variant("as", [artist]),
+                         "mpris:length": Variant("x", length_us), "mpris:artUrl": Variant("s", art_url)}
+        self.emit_properties_changed({"PlaybackStatus": self.status, "Metadata": self.metadata})
+
+    def pause(self):
+        self.status = "Paused"
+        self.emit_properties_changed({"PlaybackStatus": self.status})
+
+async def start_player(name="spotify"):
+    bus = await MessageBus().connect()
+    player = FakePlayer()
+    bus.export(mpris_detector.MPRIS_PATH, player)
+    await bus.request_name(mpris_detector.MPRIS_PREFIX + name)
+    return bus, player
+
+async def wait_until(condition, timeout=5):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+def run(test):
+    async def main():
+        changes = []
+        detector = mpris_detector.MprisDetector(changes.append)
+        try:
+            await test(detector, changes)
+        finally:
+            if detector.bus is not None:
+                detector.bus.disconnect()
+    asyncio.run(main())
+
+def test_track_change_is_pushed_with_position(session_bus):
+    async def test(detector, changes):
+        bus, player = await start_player()
+        await detector.connect()
+        assert changes == [mpris_detector.IDLE]
+        player.position_us = 5_000_000
+        player.play("Song", "Artist")
+        await wait_until(lambda: changes[-1].get("progress_ms") == 5000)
+        assert changes[-1]["song"] == "Song - Artist"
+        assert changes[-1]["platform"] == "spotify"
+        assert changes[-1]["art_url"] == "https://i.scdn.co/image/cover"
+        assert changes[-1]["duration_ms"] == 200000
+        player.pause()
+        await wait_until(lambda: changes[-1] == mpris_detector.IDLE)
+        bus.disconnect()
+    run(test)
+
+def test_player_already_playing_is_found_on_connect(session_bus):
+    async def test(detector, changes):
+        bus, player = await start_player("chromium.instance42")
+        player.play("Song", "Artist")
+        player.position_us = 1_000_000
+        await detector.connect()
+        assert changes[-1]["song"] == "Song - Artist"
+        assert changes[-1]["platform"] == "chromium"
+        assert changes[-1]["progress_ms"] == 1000
+        bus.disconnect()
+        await wait_until(lambda: changes[-1] == mpris_detector.IDLE)
+    run(test)
+
+def test_seek_is_pushed(session_bus):
+    async def test(detector, changes):
+        bus, player = await start_player()
+        player.play("Song", "Artist")
+        await detector.connect()
+        player.position_us = 90_000_000
+        player.Seeked()
+        await wait_until(lambda: changes[-1].get("progress_ms") == 90000)
+        bus.disconnect()
+    run(test)
+
+def test_heartbeat_reads_position_afresh(session_bus):
+    async def test(detector, changes):
+        bus, player = await start_player()
+        player.play("Song", "Artist")
+        await detector.connect()
+        first = detector.current()
+        reads = player.position_reads
+        # The player moves on without signalling anything, as real players do.
+        player.position_us = 70_000_000
+        await asyncio.sleep(0.05)
+        beat = await detector.heartbeat()
+        assert player.position_reads == reads + 1
+        assert beat["progress_ms"] == 70000
+        assert beat["sampled_at"] > first["sampled_at"]
+        # The heartbeat is what was last sent, so the next unrelated signal doesn't resend it.
+        assert detector.last_emitted == beat
+        bus.disconnect()
+    run(test)
+
+def test_heartbeat_when_idle(session_bus):
+    async def test(detector, changes):
+        await detector.connect()
+        assert await detector.heartbeat() == mpris_detector.IDLE
+    run(test)
+
+def test_song_data_carries_the_track_metadata():
+    state = mpris_detector.PlayerState(mpris_detector.MPRIS_PREFIX + "spotify")
+    state.apply({"PlaybackStatus": "Playing", "Metadata": {
+        "xesam:title": "Song - Live at Home", "xesam:artist": ["Artist", "Guest"],
+        "xesam:album": "Album", "xesam:contentCreated": "2010-05-01T00:00:00Z"}}, now=1.0)
+    data = state.song_data()
+    assert data["song"] == "Song - Live at Home - Artist, Guest"
+    # Title and artist stay apart, so a UI never has to split "song" on a dash.
+    assert (data["title"], data["artist"]) == ("Song - Live at Home", "Artist, Guest")
+    assert (data["album"], data["year"]) == ("Album", "2010")
+    state.apply({"Metadata": {"xesam:title": "Song", "xesam:contentCreated": "unknown"}}, now=2.0)
+    assert (state.song_data()["album"], state.song_data()["year"]) == (None, None)
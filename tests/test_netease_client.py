@@ -0,0 +1,84 @@
+import importlib
+import sys
+import threading
+import types
+
+import pytest
+
+SEARCH_RESULT = {"result": {"songs": [{
+    "name": "Song",
+    "ar": [{"name": "Artist"}, {"name": "Guest"}],
+    "al": {"id": 42, "name": "Album", "picUrl": "http://p1.music.126.net/cover.jpg"},
+}]}}
+
+@pytest.fixture
+def netease(monkeypatch):
+    """netease_client imported against stubbed pyncm and win32gui."""
+    calls = {"search": [], "album": []}
+    pyncm = types.ModuleType("pyncm")
+    apis = types.ModuleType("pyncm.apis")
+    apis.cloudsearch = types.SimpleNamespace(
+        GetSearchResult=lambda keywords, limit, stype: calls["search"].append(keywords) or SEARCH_RESULT)
+    apis.album = types.SimpleNamespace(
+        GetAlbumInfo=lambda album_id: calls["album"].append(album_id) or {"album": {"publishTime": 1262304000000}})
+    pyncm.apis = apis
+    monkeypatch.setitem(sys.modules, "pyncm", pyncm)
+    monkeypatch.setitem(sys.modules, "pyncm.apis", apis)
+    monkeypatch.setitem(sys.modules, "win32gui", types.ModuleType("win32gui"))
+    monkeypatch.delitem(sys.modules, "netease_client", raising=False)
+    module = importlib.import_module("netease_client")
+    module.calls = calls
+    monkeypatch.setattr(module, "download_cover", lambda url: b"cover of " + url.encode())
+    yield module
+    sys.modules.pop("netease_client", None)
+
+def test_track_details(netease):
+    details, error = netease.get_track_info("Song", "Artist")
+    assert error is None
+    assert details["name"] == "Song"
+    assert details["artist"] == "Artist, Guest"
+    assert details["album"] == "Album"
+    assert details["release_year"] == "2010"
+    assert details["cover_url"] == "http://p1.music.126.net/cover.jpg?param=200y200"
+    assert details["cover_future"].result(timeout=5) == b"cover of http://p1.music.126.net/cover.jpg?param=200y200"
+    assert netease.calls["search"] == ["Song Artist"]
+    assert {"search", "album_info", "cover", "total"} <= set(details["timings"])
+
+def test_album_lookup_and_cover_download_overlap(netease, monkeypatch):
+    cover_started = threading.Event()
+    album_started = threading.Event()
+
+    def slow_album_info(album_id):
+        album_started.set()
+        # Only returns in time if the cover download is already running alongside.
+        assert cover_started.wait(5)
+        return {"album": {}}
+
+    def slow_cover(url):
+        cover_started.set()
+        assert album_started.wait(5)
+        return b"cover"
+
+    netease.album.GetAlbumInfo = slow_album_info
+    monkeypatch.setattr(netease, "download_cover", slow_cover)
+    details, error = netease.get_track_info("Song", "Artist")
+    assert error is None
+    assert details["release_year"] == "an unknown year"
+    assert details["cover_future"].result(timeout=5) == b"cover"
+
+def test_album_info_is_cached_by_album_id(netease, monkeypatch):
+    monkeypatch.setattr(netease, "ALBUM_CACHE_SIZE", 2)
+    for _ in range(3):
+        netease.get_track_info("Song", "Artist")
+    assert netease.calls["album"] == [42]
+    netease.get_album_info(1)
+    netease.get_album_info(2)  # evicts 42, the least recently used
+    netease.get_album_info(42)
+    assert netease.calls["album"] == [42, 1, 2, 42]
+
+def test_track_not_found(netease):
+    netease.cloudsearch.GetSearchResult = lambda keywords, limit, stype: {"result": {"songs": []}}
+    details, error = netease.get_track_info("Nothing", "Nobody")
+    assert details is None
+    assert "Could not find" in error
+    assert netease.calls["album"] == []
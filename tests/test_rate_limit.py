@@ -0,0 +1,65 @@
+import pytest
+
+import rate_limit
+
+@pytest.mark.parametrize("forwarded, hops, expected", [
+    # The proxy appends the peer it saw; what the client sent sits to its left.
+    ("203.0.113.7", 1, "203.0.113.7"),
+    ("1.2.3.4, 203.0.113.7", 1, "203.0.113.7"),
+    ("1.2.3.4,5.6.7.8 , 203.0.113.7", 1, "203.0.113.7"),
+    ("1.2.3.4, 203.0.113.7, 10.0.0.2", 2, "203.0.113.7"),
+    (" , 203.0.113.7", 1, "203.0.113.7"),
+])
+def test_client_is_the_hop_the_trusted_proxy_appended(forwarded, hops, expected):
+    assert rate_limit.client_address(forwarded, "10.0.0.1", hops) == expected
+
+@pytest.mark.parametrize("forwarded, hops", [
+    (None, 1), ("", 1), (" , ", 1),
+    ("203.0.113.7", 2),  # fewer hops than proxies: the header can't be trusted
+    ("1.2.3.4", 0),  # no proxy: the header came from the client
+])
+def test_peer_address_without_a_trusted_hop(forwarded, hops):
+    assert rate_limit.client_address(forwarded, "10.0.0.1", hops) == "10.0.0.1"
+    assert rate_limit.client_address(forwarded, None, hops) == "unknown"
+
+def test_spoofed_first_hops_share_one_bucket():
+    limiter = rate_limit.TokenBucketLimiter(rate=1, burst=2)
+    results = [limiter.allow(rate_limit.client_address(f"10.0.{i}.1, 203.0.113.7", "10.0.0.1", 1), now=100)[0]
+               for i in range(5)]
+    assert results == [True, True, False, False, False]
+    assert len(limiter) == 1
+
+def test_burst_then_refill():
+    limiter = rate_limit.TokenBucketLimiter(rate=2, burst=3)
+    assert [limiter.allow("rex", now=100)[0] for _ in range(3)] == [True, True, True]
+    allowed, retry_after = limiter.allow("rex", now=100)
+    assert not allowed and retry_after == pytest.approx(0.5)
+    assert limiter.allow("rex", now=100.5) == (True, 0)
+    # Refills never exceed the burst.
+    assert [limiter.allow("rex", now=1000)[0] for _ in range(4)] == [True, True, True, False]
+
+def test_keys_have_their_own_buckets():
+    limiter = rate_limit.TokenBucketLimiter(rate=1, burst=1)
+    assert limiter.allow("rex", now=100)[0]
+    assert not limiter.allow("rex", now=100)[0]
+    assert limiter.allow("ann", now=100)[0]
+
+def test_least_recently_used_bucket_is_dropped():
+    limiter = rate_limit.TokenBucketLimiter(rate=1, burst=1, max_keys=2)
+    limiter.allow("a", now=100)
+    limiter.allow("b", now=100)
+    limiter.allow("a", now=100)  # a is now the most recently used
+    limiter.allow("c", now=100)
+    assert len(limiter) == 2
+    # b was dropped, so it starts with a full bucket again; a kept its empty one.
+    assert limiter.allow("b", now=100)[0]
+    assert not limiter.allow("c", now=100)[0]
+
+def test_zero_rate_disables_the_limit():
+    limiter = rate_limit.TokenBucketLimiter(rate=0, burst=0)
+    assert all(limiter.allow("rex", now=100) == (True, 0) for _ in range(100))
+    assert len(limiter) == 0
+
+@pytest.mark.parametrize("seconds, header", [(0, "1"), (0.2, "1"), (1.0, "1"), (1.01, "2"), (29.5, "30")])
+def test_retry_after_header(seconds, header):
+    assert rate_limit.retry_after_header(seconds) == header
@@ -0,0 +1,299 @@
+import time
+
+import pytest
+
+import room_service
+
+def entries(count, now, song="Song - Artist"):
+    return {f"user{i}": {"song": song, "platform": "spotify", "timestamp": now - count + i} for i in range(count)}
+
+def test_adopted_room_is_cut_to_the_cap(monkeypatch):
+    monkeypatch.setattr(room_service, "MAX_USERS_PER_ROOM", 3)
+    service = room_service.RoomService()
+    now = time.time()
+    service.adopt_rooms({"rooms": {"den": entries(10, now)}}, now)
+    # The newest three stay.
+    assert list(service.rooms["den"]) == ["user7", "user8", "user9"]
+    assert len(service.recent) == 3
+    assert service.evicted_users == 7
+
+def test_restored_room_is_cut_to_the_cap(monkeypatch):
+    monkeypatch.setattr(room_service, "MAX_USERS_PER_ROOM", 3)
+    service = room_service.RoomService()
+    service.restore_snapshot({"rooms": {"den": entries(10, time.time())}})
+    assert list(service.rooms["den"]) == ["user7", "user8", "user9"]
+    assert len(service.recent) == 3
+
+def test_chat_messages_keep_only_user_and_text():
+    service = room_service.RoomService()
+    stored = service.add_message("den", {"user": "rex", "message": "x" * 10**6, "blob": "y" * 10**6}, now=5)
+    assert stored == {"user": "rex", "message": "x" * room_service.CHAT_MESSAGE_MAX_LENGTH, "timestamp": 5}
+    assert service.chat_history("den") == [stored]
+
+def test_malformed_chat_messages_are_dropped():
+    service = room_service.RoomService()
+    for data in (None, "hi", {"user": "rex"}, {"user": "rex", "message": ["hi"]}, {"user": True, "message": "hi"},
+                 {"user": {"a": 1}, "message": "hi"}, {"user": "rex", "message": ""}):
+        assert service.add_message("den", data) is None
+    assert not service.chat_history("den")
+
+def test_restored_chat_messages_are_trimmed():
+    service = room_service.RoomService()
+    now = time.time()
+    service.restore_snapshot({"rooms": {}, "chat": {"den": [
+        {"user": "rex", "message": "x" * 10**4, "timestamp": now, "blob": "y"},
+        {"user": "rex", "timestamp": now}, {"user": "rex", "message": "old", "timestamp": 0}]}})
+    assert service.chat_history("den") == [
+        {"user": "rex", "message": "x" * room_service.CHAT_MESSAGE_MAX_LENGTH, "timestamp": now}]
+
+def test_chat_is_kept_per_room():
+    service = room_service.RoomService()
+    service.add_message("den", {"user": "rex", "message": "hi den"}, now=1)
+    service.add_message("attic", {"user": "ann", "message": "hi attic"}, now=2)
+    assert [m["message"] for m in service.chat_history("den")] == ["hi den"]
+    assert [m["message"] for m in service.chat_history("attic")] == ["hi attic"]
+    assert service.chat_history("cellar") == []
+
+def test_chat_rooms_are_capped(monkeypatch):
+    monkeypatch.setattr(room_service, "MAX_ROOMS", 2)
+    service = room_service.RoomService()
+    for i, name in enumerate(["a", "b", "a", "c"]):
+        service.add_message(name, {"user": "rex", "message": "hi"}, now=i)
+    # "b" was the least recently used chat.
+    assert list(service.chats) == ["a", "c"]
+
+def test_snapshot_from_before_per_room_chat_restores_the_default_chat():
+    service = room_service.RoomService()
+    now = time.time()
+    service.restore_snapshot({"rooms": {}, "chat_history": [{"user": "rex", "message": "hi", "timestamp": now}]})
+    assert service.chat_history(room_service.DEFAULT_ROOM) == [{"user": "rex", "message": "hi", "timestamp": now}]
+
+def test_snapshot_from_before_named_rooms_restores_the_default_room():
+    service = room_service.RoomService()
+    now = time.time()
+    service.restore_snapshot({"room_state": entries(2, now), "chat_history": []})
+    assert list(service.rooms[room_service.DEFAULT_ROOM]) == ["user0", "user1"]
+
+def sorted_users(*names):
+    index = room_service.SortedUsers()
+    for name in names:
+        index.add(name)
+    return index
+
+def test_sorted_users_ignore_duplicates_and_unknown_removals():
+    index = sorted_users("cat", "ann", "bob", "ann")
+    index.remove("zed")
+    assert index.names == ["ann", "bob", "cat"]
+    index.remove("bob")
+    assert index.names == ["ann", "cat"]
+
+@pytest.mark.parametrize("after, limit, page", [
+    (None, 2, (["ann", "bob"], True)),
+    (None, 4, (["ann", "bob", "cat", "dan"], False)),  # exactly the rest: no next page
+    (None, 10, (["ann", "bob", "cat", "dan"], False)),
+    ("bob", 1, (["cat"], True)),
+    ("bob", 2, (["cat", "dan"], False)),
+    ("bo", 1, (["bob"], True)),  # a cursor that is no longer in the room still works
+    ("", 1, (["ann"], True)),
+    ("dan", 5, ([], False)),
+    ("zzz", 5, ([], False)),
+])
+def test_sorted_users_page(after, limit, page):
+    assert sorted_users("dan", "bob", "ann", "cat").page(after, limit) == page
+
+def test_paging_survives_users_coming_and_going():
+    service = room_service.RoomService()
+    now = time.time()
+    service.update("den", "bob", {"song": "Song - Artist"}, None, now - room_service.INACTIVE_THRESHOLD - 1)
+    for name in ("ann", "cat", "dan", "eve"):
+        service.update("den", name, {"song": "Song - Artist"}, None, now)
+    first = service.page("den", limit=2, now=now)
+    assert [u["user"] for u in first["users"]] == ["ann", "bob"]
+    assert first["next"] == "bob" and first["total"] == 5
+    # bob expires and abe joins before the next page: nobody after the cursor is skipped or repeated.
+    service.cleanup_inactive_users("den", now)
+    service.update("den", "abe", {"song": "Song - Artist"}, None, now)
+    second = service.page("den", limit=2, after=first["next"], now=now)
+    assert [u["user"] for u in second["users"]] == ["cat", "dan"]
+    last = service.page("den", limit=2, after=second["next"], now=now)
+    assert [u["user"] for u in last["users"]] == ["eve"] and last["next"] is None
+
+def test_page_projects_fields():
+    service = room_service.RoomService()
+    now = time.time()
+    service.update("den", "rex", {"song": "Song - Artist", "platform": "spotify"}, "http://art", now)
+    page = service.page("den", fields=("user", "song", "duration_ms"), now=now)
+    assert page["users"] == [{"user": "rex", "song": "Song - Artist", "duration_ms": None}]
+
+def test_page_of_an_unknown_room_is_empty():
+    service = room_service.RoomService()
+    assert service.page("nowhere") == {"users": [], "next": None, "total": 0}
+
+@pytest.mark.parametrize("limit, expected", [
+    (None, room_service.MAX_PAGE_SIZE),
+    (0, 1),
+    (-5, 1),
+    (1, 1),
+    (50, 50),
+    (10**9, room_service.MAX_PAGE_SIZE),
+    ("50", room_service.MAX_PAGE_SIZE),
+])
+def test_page_args_clamp_the_limit(limit, expected):
+    assert room_service.page_args(limit, None) == (expected, None)
+
+def test_page_args_parse_fields():
+    assert room_service.page_args(10, " song, user ,song,,") == (10, ("song", "user"))
+    assert room_service.page_args(10, "") == (10, None)
+    with pytest.raises(ValueError):
+        room_service.page_args(10, "song,password")
+
+def report(service, room, user, now, song="Song - Artist"):
+    service.update(room, user, {"song": song}, None, now)
+
+def test_room_cap_evicts_the_least_recently_updated(monkeypatch):
+    monkeypatch.setattr(room_service, "MAX_USERS_PER_ROOM", 2)
+    service = room_service.RoomService()
+    now = time.time()
+    report(service, "den", "ann", now)
+    report(service, "den", "bob", now + 1)
+    report(service, "den", "ann", now + 2)  # ann is now the most recent
+    report(service, "den", "cat", now + 3)
+    assert list(service.rooms["den"]) == ["ann", "cat"]
+    assert service.indexes["den"].names == ["ann", "cat"]
+    assert service.same_song.listeners("den", "song|artist") == {"ann", "cat"}
+    assert service.evicted_users == 1
+
+def test_user_cap_evicts_across_rooms(monkeypatch):
+    monkeypatch.setattr(room_service, "MAX_USERS", 3)
+    service = room_service.RoomService()
+    now = time.time()
+    report(service, "den", "ann", now)
+    report(service, "attic", "bob", now + 1)
+    report(service, "den", "cat", now + 2)
+    version = service.version("den")
+    report(service, "attic", "dan", now + 3)
+    assert list(service.recent) == [("attic", "bob"), ("den", "cat"), ("attic", "dan")]
+    assert list(service.rooms["den"]) == ["cat"]
+    assert service.version("den") > version  # long-polls on the victim's room wake up
+
+def test_room_cap_never_evicts_the_default_room(monkeypatch):
+    monkeypatch.setattr(room_service, "MAX_ROOMS", 2)
+    service = room_service.RoomService()
+    now = time.time()
+    report(service, "den", "ann", now)
+    report(service, "attic", "bob", now + 1)
+    assert set(service.rooms) == {room_service.DEFAULT_ROOM, "attic"}
+    assert "den" not in service.indexes and ("den", "ann") not in service.recent
+    assert service.evicted_rooms == 1
+
+def test_reclaim_expires_rooms_nobody_polls():
+    service = room_service.RoomService()
+    now = time.time()
+    stale = now - room_service.INACTIVE_THRESHOLD - 1
+    report(service, "den", "ann", stale)
+    report(service, "attic", "bob", stale)
+    report(service, "attic", "cat", now)
+    service.reclaim(now)
+    assert "den" not in service.rooms and "den" not in service.indexes
+    assert list(service.rooms["attic"]) == ["cat"]
+    assert list(service.recent) == [("attic", "cat")]
+    assert service.same_song.key_of("attic", "bob") is None
+    assert service.expired_users == 2
+    # Nothing left to expire: reclaim stops at the first active user.
+    service.reclaim(now)
+    assert service.expired_users == 2
+
+def test_connection_cap(monkeypatch):
+    monkeypatch.setattr(room_service, "MAX_CONNECTIONS", 2)
+    service = room_service.RoomService()
+    assert service.admit_connection() and service.admit_connection()
+    assert not service.admit_connection()
+    service.connection_closed()
+    assert service.admit_connection()
+    assert service.memory()["refused_connections"] == 1
+
+def test_delta_sends_only_changed_and_removed_users():
+    service = room_service.RoomService()
+    now = time.time()
+    report(service, "den", "ann", now - room_service.INACTIVE_THRESHOLD - 1)
+    report(service, "den", "bob", now)
+    since = service.version("den")
+    report(service, "den", "bob", now, song="Other - Artist")
+    report(service, "den", "cat", now)
+    report(service, "den", "cat", now)  # a heartbeat: no visible change
+    service.cleanup_inactive_users("den", now)
+    delta = service.delta("den", since, now)
+    assert delta["full"] is False
+    assert sorted(delta["users"]) == ["bob", "cat"]
+    assert delta["users"]["bob"]["song"] == "Other - Artist"
+    assert delta["removed"] == ["ann"]
+    assert service.delta("den", service.version("den"), now) == {"full": False, "users": {}, "removed": []}
+
+def test_delta_for_a_user_who_left_and_came_back():
+    service = room_service.RoomService()
+    now = time.time()
+    report(service, "den", "ann", now - room_service.INACTIVE_THRESHOLD - 1)
+    since = service.version("den")
+    service.cleanup_inactive_users("den", now)
+    report(service, "den", "ann", now)
+    delta = service.delta("den", since, now)
+    assert list(delta["users"]) == ["ann"] and delta["removed"] == []
+
+@pytest.mark.parametrize("since", [None, 0, "older", "newer"])
+def test_delta_falls_back_to_the_full_room(since):
+    service = room_service.RoomService()
+    now = time.time()
+    report(service, "den", "ann", now)
+    since = {"older": service.changes["den"].floor - 1, "newer": service.version("den") + 1}.get(since, since)
+    assert service.delta("den", since, now) == {"full": True, "users": service.view("den", now), "removed": []}
+
+def test_forgotten_departures_raise_the_floor(monkeypatch):
+    monkeypatch.setattr(room_service, "MAX_REMEMBERED_REMOVALS", 2)
+    service = room_service.RoomService()
+    now = time.time()
+    stale = now - room_service.INACTIVE_THRESHOLD - 1
+    report(service, "den", "keep", now)
+    since = service.version("den")
+    for user in ("ann", "bob", "cat"):
+        report(service, "den", user, stale)
+        report(service, "den", "keep", now)  # a heartbeat, so the stale user is first in line
+        service.cleanup_inactive_users("den", now)
+    # ann's departure was forgotten, so a client from before it needs the whole room again.
+    assert service.delta("den", since, now)["full"] is True
+    assert service.delta("den", service.changes["den"].floor, now)["removed"] == ["bob", "cat"]
+
+def test_handoff_carries_users_chat_and_listening_history():
+    now = time.time()
+    old, new = room_service.RoomService(), room_service.RoomService()
+    report(old, "den", "rex", now - 30, song="Song A - Artist")
+    report(old, "den", "rex", now - 10, song="Song B - Artist")  # closes Song A
+    old.add_message("den", {"user": "rex", "message": "moving"}, now=now - 5)
+    new.add_message("den", {"user": "ann", "message": "first"}, now=now - 6)
+    handoff = old.export_rooms(old.room_names())
+    assert room_service.handoff_rooms(handoff) == {"den"}
+
+    assert new.adopt_rooms(handoff, now) == 1
+    assert list(new.rooms["den"]) == ["rex"]
+    assert [m["message"] for m in new.chat_history("den")] == ["first", "moving"]
+    assert new.stats("den", "24h", 10)["listening_time"] == {"rex": 20.0}
+    # Song B is still playing and is closed by the new owner when it changes.
+    report(new, "den", "rex", now, song="Song C - Artist")
+    assert [t["song"] for t in new.stats("den", "24h", 10)["top_tracks"]] == ["Song A - Artist", "Song B - Artist"]
+
+    old.drop_rooms(["den"])
+    assert "den" not in old.room_names()
+    assert old.stats("den", "24h", 10)["top_tracks"] == []
+    assert old.history.sizes()["open_plays"] == 0
+
+def test_adopt_rooms_skips_malformed_chat_and_plays():
+    service = room_service.RoomService()
+    now = time.time()
+    users = service.adopt_rooms({
+        "rooms": {"den": "nope"},
+        "chat": {"den": [{"user": "rex", "message": "hi", "timestamp": "now"}, None], "attic": "nope"},
+        "history": {"den": {"events": [{"user": "rex", "song": "Song - Artist", "platform": "spotify",
+                                        "start": "then", "end": now}], "open": [None]}, "attic": []},
+    }, now)
+    assert users == 0
+    assert service.chat_history("den") == []
+    assert service.history.sizes() == {"open_plays": 0, "events": {name: 0 for name in room_service.STATS_WINDOWS}}
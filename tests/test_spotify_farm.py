@@ -0,0 +1,250 @@
+import asyncio
+import base64
+import time
+
+import pytest
+from aiohttp import web
+
+import spotify_farm
+
+CLIENT_ID, CLIENT_SECRET = "client", "secret"
+
+def track(name="Song", artists=("Artist", "Guest"), progress_ms=1000, duration_ms=200000):
+    return {
+        "is_playing": True,
+        "progress_ms": progress_ms,
+        "item": {
+            "name": name,
+            "duration_ms": duration_ms,
+            "artists": [{"name": artist} for artist in artists],
+            "album": {"images": [{"url": "https://i.scdn.co/640", "width": 640},
+                                 {"url": "https://i.scdn.co/300", "width": 300},
+                                 {"url": "https://i.scdn.co/64", "width": 64}]},
+        },
+    }
+
+class MockSpotify:
+    """The accounts and Web API endpoints the farm uses, on 127.0.0.1."""
+
+    def __init__(self):
+        self.refresh_tokens = {}  # refresh token -> user
+        self.rotate = set()  # refresh tokens replaced by a new one when used
+        self.playing = {}  # user -> currently-playing body, None for 204, or a status code
+        self.delay = 0.0
+        self.token_body = None  # if set, the token endpoint answers 200 with this instead
+        self.token_requests = 0
+        self.polls = []  # (user, monotonic time)
+        self._access = {}  # access token -> user
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/api/token", self.token)
+        app.router.add_get("/v1/me/player/currently-playing", self.currently_playing)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def token(self, request):
+        self.token_requests += 1
+        expected = base64.b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode()).decode()
+        if request.headers.get("Authorization") != f"Basic {expected}":
+            return web.json_response({"error": "invalid_client"}, status=401)
+        form = await request.post()
+        user = self.refresh_tokens.get(form.get("refresh_token"))
+        if form.get("grant_type") != "refresh_token" or user is None:
+            return web.json_response({"error": "invalid_grant"}, status=400)
+        if self.token_body is not None:
+            return web.json_response(self.token_body)
+        access = f"access-{user}-{self.token_requests}"
+        self._access[access] = user
+        body = {"access_token": access, "expires_in": 3600}
+        if form["refresh_token"] in self.rotate:
+            rotated = f"{form['refresh_token']}-next"
+            self.refresh_tokens[rotated] = self.refresh_tokens.pop(form["refresh_token"])
+            body["refresh_token"] = rotated
+        return web.json_response(body)
+
+    async def currently_playing(self, request):
+        user = self._access.get(request.headers.get("Authorization", "").removeprefix("Bearer "))
+        if user is None:
+            return web.json_response({"error": {"status": 401}}, status=401)
+        self.polls.append((user, time.monotonic()))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        state = self.playing.get(user)
+        if state == 429:
+            return web.json_response({"error": {"status": 429}}, status=429, headers={"Retry-After": "1"})
+        if state == 401:
+            self._access = {token: owner for token, owner in self._access.items() if owner != user}
+            return web.json_response({"error": {"status": 401}}, status=401)
+        if state is None:
+            return web.Response(status=204)
+        return web.json_response(state)
+
+async def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+def run_farm(test):
+    """Runs test(mock, farm, reports) against a started mock and farm."""
+    async def main():
+        mock = MockSpotify()
+        await mock.start()
+        reports = []
+        farm = spotify_farm.SpotifyPollerFarm(
+            lambda room, user, data, root: reports.append((room, user, data)), CLIENT_ID, CLIENT_SECRET,
+            api_url=f"{mock.url}/v1", accounts_url=mock.url)
+        await farm.start()
+        try:
+            await test(mock, farm, reports)
+        finally:
+            await farm.stop()
+            await mock.stop()
+    asyncio.run(main())
+
+def test_linked_user_is_polled_and_reported():
+    async def test(mock, farm, reports):
+        mock.refresh_tokens["token-rex"] = "rex"
+        mock.playing["rex"] = track()
+        before = time.time()
+        await farm.link("rex", "den", "token-rex", "http://server/")
+        await wait_until(lambda: reports)
+        room, user, data = reports[0]
+        assert (room, user) == ("den", "rex")
+        assert data["song"] == "Song - Artist, Guest"
+        assert data["art_url"] == "https://i.scdn.co/64"
+        assert (data["progress_ms"], data["duration_ms"]) == (1000, 200000)
+        assert before <= data["sampled_at"] <= time.time()
+        assert farm.stats()["linked"] == 1
+    run_farm(test)
+
+def test_idle_user_reports_no_song():
+    async def test(mock, farm, reports):
+        mock.refresh_tokens["token-ann"] = "ann"
+        await farm.link("ann", "default", "token-ann", "http://server/")
+        await wait_until(lambda: reports)
+        assert reports[0][2] == {"song": "", "art_url": None}
+        assert farm.listeners["ann"].idle_polls == 1
+    run_farm(test)
+
+def test_rejected_refresh_token_is_not_linked():
+    async def test(mock, farm, reports):
+        with pytest.raises(spotify_farm.AuthError):
+            await farm.link("eve", "default", "forged", "http://server/")
+        assert farm.stats()["linked"] == 0
+    run_farm(test)
+
+def test_users_share_one_pool_and_are_polled_concurrently():
+    async def test(mock, farm, reports):
+        mock.delay = 0.3
+        for i in range(10):
+            mock.refresh_tokens[f"token-{i}"] = f"user{i}"
+            mock.playing[f"user{i}"] = track(name=f"Song {i}")
+        started = time.monotonic()
+        await asyncio.gather(*(farm.link(f"user{i}", "default", f"token-{i}", "http://server/") for i in range(10)))
+        await wait_until(lambda: len(reports) == 10)
+        # Ten 0.3 s requests one after another would take 3 s.
+        assert time.monotonic() - started < 1.5
+        assert sorted(user for _, user, _ in reports) == sorted(f"user{i}" for i in range(10))
+    run_farm(test)
+
+def test_rate_limit_pauses_every_user():
+    async def test(mock, farm, reports):
+        mock.refresh_tokens["token-a"] = "a"
+        mock.refresh_tokens["token-b"] = "b"
+        mock.playing["a"] = 429
+        mock.playing["b"] = track()
+        await farm.link("a", "default", "token-a", "http://server/")
+        await wait_until(lambda: farm.rate_limited == 1)
+        limited_at = time.monotonic()
+        mock.playing["a"] = track()
+        await farm.link("b", "default", "token-b", "http://server/")
+        await wait_until(lambda: any(user == "b" for _, user, _ in reports))
+        # b was due at once but waited for the app-wide Retry-After of 1 s.
+        b_polls = [at for user, at in mock.polls if user == "b"]
+        assert b_polls[0] - limited_at >= 0.9
+        assert farm.stats()["rate_limited"] == 1
+    run_farm(test)
+
+def test_revoked_token_unlinks_the_user():
+    async def test(mock, farm, reports):
+        mock.refresh_tokens["token-rex"] = "rex"
+        mock.playing["rex"] = track()
+        await farm.link("rex", "default", "token-rex", "http://server/")
+        await wait_until(lambda: reports)
+        # The user revokes the app: the access token stops working and the refresh is refused.
+        del mock.refresh_tokens["token-rex"]
+        mock.playing["rex"] = 401
+        farm._schedule(farm.listeners["rex"], 0)
+        await wait_until(lambda: farm.errors == 1)
+        farm._schedule(farm.listeners["rex"], 0)
+        await wait_until(lambda: "rex" not in farm.listeners)
+    run_farm(test)
+
+def test_rotated_refresh_token_still_unlinks_with_the_original():
+    async def test(mock, farm, reports):
+        mock.refresh_tokens["token-rex"] = "rex"
+        mock.rotate.add("token-rex")
+        await farm.link("rex", "default", "token-rex", "http://server/")
+        assert farm.listeners["rex"].refresh_token == "token-rex-next"
+        assert not farm.unlink("rex", "token-rex-next")
+        assert farm.unlink("rex", "token-rex")
+        assert farm.stats()["linked"] == 0
+    run_farm(test)
+
+@pytest.mark.parametrize("body", [{"token_type": "Bearer"}, {"access_token": 5}, ["access-rex"], "access-rex"])
+def test_malformed_token_response_is_not_linked(body):
+    async def test(mock, farm, reports):
+        mock.refresh_tokens["token-rex"] = "rex"
+        mock.token_body = body
+        with pytest.raises(spotify_farm.BadResponse):
+            await farm.link("rex", "default", "token-rex", "http://server/")
+        assert farm.stats()["linked"] == 0
+    run_farm(test)
+
+def queued(farm, user):
+    listener = farm.listeners[user]
+    return any(entry[2] == user and entry[3] == listener.generation for entry in farm._queue)
+
+def test_malformed_responses_while_polling_are_retried():
+    async def test(mock, farm, reports):
+        mock.refresh_tokens["token-rex"] = "rex"
+        mock.playing["rex"] = ["not", "an", "object"]
+        await farm.link("rex", "default", "token-rex", "http://server/")
+        await wait_until(lambda: farm.errors == 1)
+        assert queued(farm, "rex")
+        # The access token expires and the refresh comes back without one.
+        mock.token_body = {"expires_in": 3600}
+        farm.listeners["rex"].expires_at = 0.0
+        farm._schedule(farm.listeners["rex"], 0)
+        await wait_until(lambda: farm.errors == 2)
+        assert queued(farm, "rex")
+        # A body of the right type but the wrong shape is retried the same way.
+        mock.token_body = None
+        mock.playing["rex"] = {"is_playing": True, "item": ["Song"]}
+        farm._schedule(farm.listeners["rex"], 0)
+        await wait_until(lambda: farm.errors == 3)
+        assert queued(farm, "rex")
+        assert farm.listeners["rex"].failures == 3
+        assert reports == []
+    run_farm(test)
+
+def test_poll_intervals():
+    listener = spotify_farm.LinkedListener("rex", "default", "token", "http://server/")
+    playing = spotify_farm.playback_from(track(progress_ms=195000, duration_ms=200000), 0)
+    assert spotify_farm.next_interval(listener, playing) == 5 + spotify_farm.TRACK_END_SLACK
+    playing = spotify_farm.playback_from(track(progress_ms=0, duration_ms=600000), 0)
+    assert spotify_farm.next_interval(listener, playing) == spotify_farm.PLAYING_INTERVAL
+    idle = [spotify_farm.next_interval(listener, None) for _ in range(4)]
+    assert idle == sorted(idle) and idle[-1] == spotify_farm.IDLE_MAX_INTERVAL
+    assert spotify_farm.IDLE_MAX_INTERVAL < 30  # below room_service.INACTIVE_THRESHOLD
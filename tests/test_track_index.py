@@ -0,0 +1,74 @@
+import pytest
+
+import track_index
+
+@pytest.mark.parametrize("song", [
+    "Song - Artist",
+    "song - artist",
+    "  SONG  - Artist",
+    "Song (Live) - Artist",
+    "Song [Remastered 2011] - Artist",
+    "Song（Live） - Artist",
+    "Song【伴奏】 - Artist",
+    "Song - Remastered 2009 - Artist",
+    "Song - 2011 Remaster - Artist",
+    "Song - Radio Edit - Artist",
+    "Song (feat. Guest) - Artist",
+    "Song feat. Guest - Artist",
+    "Song ft. Guest - Artist",
+    "Song - Artist, Guest",
+    "Song - Artist/Guest",
+    "Song - Artist & Guest",
+    "Song - Artist、Guest",
+    "Song - Artist x Guest",
+    "Song - Artist feat. Guest",
+    "Ｓｏｎｇ - Ａｒｔｉｓｔ",  # fullwidth, folded by NFKC
+    "Song! - Artist.",
+])
+def test_variants_share_one_key(song):
+    assert track_index.canonical_track_key(song) == "song|artist"
+
+def test_title_and_artist_can_be_passed_apart():
+    assert track_index.canonical_track_key("Song (Live)", "Artist, Guest") == "song|artist"
+    # Apart, a dash in the title is part of the title.
+    assert track_index.canonical_track_key("A - B", "Artist") == "a b|artist"
+
+def test_last_dash_separates_the_artist():
+    assert track_index.canonical_track_key("Title - With - Dashes - Artist") == "title with dashes|artist"
+
+@pytest.mark.parametrize("song, key", [
+    ("Song", "song|"),
+    ("Live Forever - Oasis", "live forever|oasis"),  # only suffixes after a dash are dropped
+    ("Demons - Imagine Dragons", "demons|imagine dragons"),
+    ("Alive - Artist", "alive|artist"),
+    ("Song - Other Artist", "song|other artist"),
+])
+def test_keys_keep_what_tells_tracks_apart(song, key):
+    assert track_index.canonical_track_key(song) == key
+
+@pytest.mark.parametrize("title, artist", [
+    ("", None), (None, None), ("(Live)", "Artist"), ("   ", None), (123, None), ("Song", 5), (["Song"], None),
+])
+def test_no_key_for_empty_or_non_text_titles(title, artist):
+    assert track_index.canonical_track_key(title, artist) is None
+
+def test_same_song_index_reports_the_second_listener():
+    index = track_index.SameSongIndex()
+    assert index.update("den", "rex", "Song - Artist") is None
+    assert index.update("den", "ann", "Song (Live) - Artist") == "song|artist"
+    assert index.update("other", "bob", "Song - Artist") is None  # rooms are separate
+    assert index.listeners("den", "song|artist") == {"rex", "ann"}
+    # Heartbeats with the same track don't announce it again.
+    assert index.update("den", "ann", "Song - Artist") is None
+
+def test_same_song_index_moves_and_removes_listeners():
+    index = track_index.SameSongIndex()
+    index.update("den", "rex", "Song - Artist")
+    index.update("den", "ann", "Song - Artist")
+    index.update("den", "rex", "Other - Artist")
+    assert index.listeners("den", "song|artist") == {"ann"}
+    assert index.key_of("den", "rex") == "other|artist"
+    index.update("den", "rex", "")
+    index.remove("den", "ann")
+    assert len(index) == 0
+    assert index._listeners == {}
@@ -0,0 +1,106 @@
+import asyncio
+
+import pytest
+
+import update_outbox
+
+def test_backoff_grows_to_its_maximum_with_jitter(monkeypatch):
+    monkeypatch.setattr(update_outbox.random, "uniform", lambda low, high: (low, high))
+    backoff = update_outbox.Backoff(base=1.0, factor=2.0, maximum=5.0)
+    assert [backoff.next_delay() for _ in range(5)] == [(0.5, 1.0), (1.0, 2.0), (2.0, 4.0), (2.5, 5.0), (2.5, 5.0)]
+    backoff.reset()
+    assert backoff.next_delay() == (0.5, 1.0)
+
+def test_backoff_delays_stay_in_range():
+    backoff = update_outbox.Backoff(base=0.5, maximum=3.0)
+    for _ in range(20):
+        assert 0.25 <= backoff.next_delay() <= 3.0
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = update_outbox.CircuitBreaker(failure_threshold=3, reset_timeout=30.0)
+    breaker.record_failure(now=100.0)
+    breaker.record_failure(now=101.0)
+    assert breaker.state == breaker.CLOSED
+    assert breaker.wait_time(now=101.0) == 0.0
+    breaker.record_failure(now=102.0)
+    assert breaker.state == breaker.OPEN
+    assert breaker.wait_time(now=112.0) == pytest.approx(20.0)
+
+def test_breaker_success_resets_the_count():
+    breaker = update_outbox.CircuitBreaker(failure_threshold=2)
+    breaker.record_failure(now=0.0)
+    breaker.record_success()
+    breaker.record_failure(now=1.0)
+    assert breaker.state == breaker.CLOSED
+
+def test_breaker_half_open_trial():
+    breaker = update_outbox.CircuitBreaker(failure_threshold=1, reset_timeout=10.0)
+    breaker.record_failure(now=0.0)
+    assert breaker.wait_time(now=10.0) == 0.0
+    assert breaker.state == breaker.HALF_OPEN
+    # A failed trial reopens it for another full timeout...
+    breaker.record_failure(now=10.0)
+    assert breaker.state == breaker.OPEN
+    assert breaker.wait_time(now=15.0) == pytest.approx(5.0)
+    # ...and a successful one closes it.
+    breaker.wait_time(now=20.0)
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED
+    assert breaker.wait_time(now=20.0) == 0.0
+
+def test_outbox_sends_one_merged_state_after_failures():
+    async def scenario():
+        sent = []
+        failures = 2
+        health = []
+
+        async def send(state):
+            nonlocal failures
+            if failures:
+                failures -= 1
+                outbox.put({"progress": failures})  # detections keep arriving meanwhile
+                raise OSError("down")
+            sent.append(state)
+
+        outbox = update_outbox.UpdateOutbox(send, health.append,
+                                            backoff=update_outbox.Backoff(base=0.001, maximum=0.001),
+                                            breaker=update_outbox.CircuitBreaker(failure_threshold=5))
+        outbox.put({"song": "A", "progress": 9})
+        outbox.put({"song": "B"})
+        task = asyncio.create_task(outbox.run())
+        for _ in range(100):
+            if sent:
+                break
+            await asyncio.sleep(0.005)
+        task.cancel()
+        return sent, health, outbox
+
+    sent, health, outbox = asyncio.run(scenario())
+    assert sent == [{"song": "B", "progress": 0}]
+    assert health[-1] == "Connected"
+    assert any(status.startswith("Connection problem") for status in health)
+    assert outbox.pending is None
+
+def test_retry_later_does_not_trip_the_breaker():
+    async def scenario():
+        calls = []
+
+        async def send(state):
+            calls.append(state)
+            if len(calls) == 1:
+                raise update_outbox.RetryLater(0.001)
+
+        breaker = update_outbox.CircuitBreaker(failure_threshold=1)
+        outbox = update_outbox.UpdateOutbox(send, breaker=breaker)
+        outbox.put({"song": "A"})
+        task = asyncio.create_task(outbox.run())
+        for _ in range(100):
+            if len(calls) == 2:
+                break
+            await asyncio.sleep(0.005)
+        task.cancel()
+        return calls, breaker
+
+    calls, breaker = asyncio.run(scenario())
+    assert calls == [{"song": "A"}, {"song": "A"}]
+    assert breaker.state == breaker.CLOSED
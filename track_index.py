@@ -0,0 +1,107 @@
+import re
+import unicodedata
+
+# --- Canonical track keys ---
+# Spotify, NetEase and the NetEase window title all spell the same track a little differently
+# ("Song (Live) - A, B", "Song - Remastered 2009 - A", "Song（Live） - A/B", "Song (feat. B) - A").
+# canonical_track_key() reduces them to one comparable key: "<title>|<primary artist>".
+
+# Bracketed suffixes such as (Live), [Remastered 2011], （伴奏）, (feat. X)
+_BRACKETS = re.compile(r"\s*[\(\[（【][^\)\]）】]*[\)\]）】]")
+# Spotify style " - Remastered 2009", " - Live at ...", " - Radio Edit"
+_DASH_SUFFIX = re.compile(r"\s+-\s+(\d{4}\s+)?(remaster\w*|live|radio edit|single version|mono|stereo|acoustic|demo)\b.*$")
+# Inline featuring credits: "Song feat. X", "Artist ft. Y"
+_FEATURING = re.compile(r"\s+(feat\.?|ft\.?|featuring)\s+.*$")
+_ARTIST_SEPARATORS = re.compile(r"\s*(?:,|/|&|、|;| x | and )\s*")
+_NOISE = re.compile(r"[^\w]+")
+
+def _normalize(text):
+    return unicodedata.normalize("NFKC", text).casefold().strip()
+
+def _clean_title(title):
+    title = _normalize(title)
+    title = _BRACKETS.sub("", title)
+    title = _DASH_SUFFIX.sub("", title)
+    title = _FEATURING.sub("", title)
+    return _NOISE.sub(" ", title).strip()
+
+def _primary_artist(artist):
+    artist = _FEATURING.sub("", _normalize(artist))
+    first = _ARTIST_SEPARATORS.split(artist, maxsplit=1)[0]
+    return _NOISE.sub(" ", first).strip()
+
+def split_song(song):
+    """Splits a "title - artist" string as built by the detectors. Returns (title, artist)."""
+    if " - " not in song:
+        return song, ""
+    title, artist = song.rsplit(" - ", 1)
+    return title, artist
+
+def canonical_track_key(title, artist=None):
+    """
+    Returns a normalized key for a track, or None for an empty (or non-text) title.
+    Pass either (title, artist) or a single "title - artist" string.
+    """
+    if not isinstance(title, str) or not isinstance(artist, (str, type(None))):
+        return None
+    if artist is None:
+        title, artist = split_song(title or "")
+    title = _clean_title(title or "")
+    if not title:
+        return None
+    return f"{title}|{_primary_artist(artist or '')}"
+
+# --- Inverted index: track key -> listeners ---
+class SameSongIndex:
+    """
+    Maps each room's canonical track keys to the users currently playing them.
+    Every update touches only the user's old and new key, so it is O(1) regardless of room size.
+    """
+
+    def __init__(self):
+        self._listeners = {}  # room -> {track_key: set(users)}
+        self._key_of = {}  # (room, user) -> track_key
+
+    def update(self, room, user, song):
+        """
+        Moves `user` to the key of `song`.
+        Returns the new key if the user just joined a key someone else in the room is already playing,
+        otherwise None.
+        """
+        key = canonical_track_key(song) if song else None
+        old_key = self._key_of.get((room, user))
+        if key == old_key:
+            return None
+        self._discard(room, user, old_key)
+        if key is None:
+            return None
+        self._key_of[(room, user)] = key
+        listeners = self._listeners.setdefault(room, {}).setdefault(key, set())
+        listeners.add(user)
+        return key if len(listeners) > 1 else None
+
+    def __len__(self):
+        return len(self._key_of)
+
+    def remove(self, room, user):
+        self._discard(room, user, self._key_of.get((room, user)))
+
+    def key_of(self, room, user):
+        return self._key_of.get((room, user))
+
+    def listeners(self, room, key):
+        """Returns the set of users in `room` playing `key` (do not modify it)."""
+        return self._listeners.get(room, {}).get(key, set())
+
+    def _discard(self, room, user, key):
+        if key is None:
+            return
+        self._key_of.pop((room, user), None)
+        room_keys = self._listeners.get(room)
+        if not room_keys or key not in room_keys:
+            return
+        room_keys[key].discard(user)
+        if not room_keys[key]:
+            del room_keys[key]
+            if not room_keys:
+                del self._listeners[room]
@@ -0,0 +1,140 @@
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import time
+
+import track_index
+
+# --- Traffic traces (opt-in) ---
+# With TRACE_PATH set, the server logs the shape of its traffic: when updates, polls, batches
+# and Socket.IO events arrived, and which (anonymized) users, rooms and tracks they were about.
+# replay_trace.py plays such a file back against a local server. Records are compact JSON
+# lines in a gzip file; each server start appends a new header and gzip member.
+#
+# Anonymization: names are replaced by a keyed hash (HMAC with TRACE_SALT, or a random per-run
+# key), so the same user/room/track keeps the same id within a trace but can't be looked up.
+# Tracks are hashed by canonical key, so "who listens to the same song" survives. Chat text is
+# reduced to its length. Nothing else from the requests is kept.
+TRACE_FORMAT = 1
+TRACE_FLUSH_INTERVAL = float(os.environ.get("TRACE_FLUSH_INTERVAL", "5"))
+TRACE_MAX_BUFFER = 100000  # records kept between flushes; more are counted as dropped
+
+class TraceRecorder:
+    def __init__(self, path, salt=None, max_buffer=TRACE_MAX_BUFFER):
+        self.path = path
+        self.salt = salt.encode() if salt else os.urandom(16)
+        self.max_buffer = max_buffer
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self._buffer = []
+        self._header_written = False
+        self.recorded = 0
+        self.dropped = 0
+
+    def anonymize(self, value):
+        if value is None or value == "":
+            return None
+        return hmac.new(self.salt, str(value).encode("utf-8"), hashlib.sha1).hexdigest()[:10]
+
+    def _room(self, name):
+        # The default room keeps its name so a replay exercises the same code path.
+        return None if name in (None, "", "default") else self.anonymize(name)
+
+    def _add(self, record):
+        if len(self._buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+        record["t"] = round(time.monotonic() - self._started, 3)
+        self._buffer.append(record)
+        self.recorded += 1
+
+    def _update_fields(self, data):
+        record = {"u": self.anonymize(data.get("user")), "r": self._room(data.get("room"))}
+        # Batches are traced before their items are checked, so only text fields are kept.
+        song = data.get("song")
+        if isinstance(song, str) and song:
+            record["s"] = self.anonymize(track_index.canonical_track_key(song))
+        if isinstance(data.get("platform"), str) and data["platform"]:
+            record["p"] = data["platform"][:16]
+        if isinstance(data.get("art_url"), str) and data["art_url"]:
+            record["a"] = 1
+        if isinstance(data.get("progress_ms"), (int, float)):
+            record["pr"] = int(data["progress_ms"])
+            if isinstance(data.get("duration_ms"), (int, float)):
+                record["d"] = int(data["duration_ms"])
+        return record
+
+    # --- HTTP ---
+    def update(self, data):
+        self._add(dict(self._update_fields(data), k="update"))
+
+    def batch(self, items):
+        self._add({"k": "batch", "i": [self._update_fields(item) for item in items if isinstance(item, dict)]})
+
+    def get(self, room, since=None, wait=0):
+        record = {"k": "get", "r": self._room(room)}
+        if since is not None and wait:
+            record["w"] = wait
+        self._add(record)
+
+    # --- Socket.IO ---
+    def connect(self, sid, ip):
+        self._add({"k": "connect", "c": self.anonymize(sid), "ip": self.anonymize(ip)})
+
+    def disconnect(self, sid):
+        self._add({"k": "disconnect", "c": self.anonymize(sid)})
+
+    def message(self, sid, data):
+        message = data.get("message") if isinstance(data, dict) else None
+        self._add({"k": "message", "c": self.anonymize(sid),
+                   "u": self.anonymize(data.get("user") if isinstance(data, dict) else None),
+                   "n": len(message) if isinstance(message, str) else 0})
+
+    def clock_sync(self, sid):
+        self._add({"k": "clock_sync", "c": self.anonymize(sid)})
+
+    # --- Writing ---
+    def flush(self):
+        """Appends buffered records to the trace file. Blocking; adapters run it off their loop."""
+        records, self._buffer = self._buffer, []
+        if not records and self._header_written:
+            return
+        lines = []
+        if not self._header_written:
+            lines.append(json.dumps({"trace": TRACE_FORMAT, "started_at": self.started_at}, separators=(",", ":")))
+            self._header_written = True
+        lines.extend(json.dumps(record, separators=(",", ":")) for record in records)
+        try:
+            with gzip.open(self.path, "at", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+        except OSError as e:
+            print(f"Trace: Failed to write '{self.path}': {e}")
+
+def recorder_from_env():
+    """A TraceRecorder when TRACE_PATH is set, else None (tracing is off by default)."""
+    path = os.environ.get("TRACE_PATH")
+    return TraceRecorder(path, os.environ.get("TRACE_SALT")) if path else None
+
+def read_trace(path):
+    """Returns all records sorted by arrival, with "at" = absolute time (seconds since the epoch)."""
+    records = []
+    started_at = None
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if "trace" in record:
+                if record["trace"] != TRACE_FORMAT:
+                    raise ValueError(f"Unsupported trace format {record['trace']}")
+                started_at = record["started_at"]
+                continue
+            if started_at is None:
+                raise ValueError("Trace record before any header")
+            record["at"] = started_at + record.pop("t")
+            records.append(record)
+    records.sort(key=lambda record: record["at"])
+    return records
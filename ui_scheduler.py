@@ -0,0 +1,60 @@
+import time
+from PySide6.QtCore import QObject, QTimer
+
+# --- Frame-budgeted UI updates ---
+# State can arrive faster than it is worth drawing (polls, pushes, retries). The scheduler
+# keeps only the newest state and renders it at most once per frame, from the event loop
+# instead of from inside the slot that received it.
+FRAME_MS = 16
+
+class RenderScheduler(QObject):
+    """
+    submit(state) remembers the newest state and schedules one render on the next frame.
+    `render` is called with that state; the time it takes on the UI thread is recorded.
+    """
+
+    def __init__(self, render, frame_ms=FRAME_MS, parent=None):
+        super().__init__(parent)
+        self.render = render
+        self.frame_ms = frame_ms
+        self._pending = None
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._flush)
+        # Instrumentation
+        self.submitted = 0
+        self.renders = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.slow_renders = 0
+
+    def submit(self, state):
+        self.submitted += 1
+        self._pending = state
+        if not self._timer.isActive():
+            self._timer.start(self.frame_ms)
+
+    def _flush(self):
+        state, self._pending = self._pending, None
+        if state is None:
+            return
+        start = time.perf_counter()
+        self.render(state)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.renders += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        if elapsed_ms > self.frame_ms:
+            self.slow_renders += 1
+            print(f"UI: Render took {elapsed_ms:.1f} ms (frame budget {self.frame_ms} ms)")
+
+    def stats(self):
+        """Summary of UI-thread time spent rendering state updates."""
+        return {
+            "submitted": self.submitted,
+            "renders": self.renders,
+            "coalesced": self.submitted - self.renders,
+            "avg_ms": round(self.total_ms / self.renders, 2) if self.renders else 0.0,
+            "max_ms": round(self.max_ms, 2),
+            "slow_renders": self.slow_renders,
+        }
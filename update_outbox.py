@@ -0,0 +1,132 @@
+import asyncio
+import random
+import time
+
+# --- Client-side outbox for state updates ---
+# Detections keep arriving every few seconds, but only the newest state matters. The outbox
+# holds one pending state (later fields overwrite earlier ones), retries with exponential
+# backoff, and stops hammering an unreachable server with a circuit breaker. After an outage
+# exactly one, up-to-date update is sent.
+
+class RetryLater(Exception):
+    """Raised by a send function when the server asked us to wait (e.g. HTTP 429 Retry-After)."""
+    def __init__(self, seconds):
+        super().__init__(f"retry after {seconds}s")
+        self.seconds = seconds
+
+class Backoff:
+    """Exponential backoff with full jitter."""
+    def __init__(self, base=1.0, factor=2.0, maximum=60.0):
+        self.base = base
+        self.factor = factor
+        self.maximum = maximum
+        self.attempt = 0
+
+    def next_delay(self):
+        delay = min(self.maximum, self.base * (self.factor ** self.attempt))
+        self.attempt += 1
+        return random.uniform(delay / 2, delay)
+
+    def reset(self):
+        self.attempt = 0
+
+class CircuitBreaker:
+    """
+    closed: requests flow. After `failure_threshold` consecutive failures it opens and
+    blocks requests for `reset_timeout` seconds, then lets a single trial through (half-open).
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def wait_time(self, now=None):
+        """Seconds until a request may be attempted (0 if allowed now)."""
+        if self.state != self.OPEN:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        remaining = self.opened_at + self.reset_timeout - now
+        if remaining <= 0:
+            self.state = self.HALF_OPEN
+            return 0.0
+        return remaining
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self, now=None):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic() if now is None else now
+
+class UpdateOutbox:
+    """
+    put() merges fields into the single pending state; run() sends it whenever there is one.
+    `send` is a coroutine function taking the state dict; it raises on failure.
+    `on_health` is called with a short status string whenever the connection state changes.
+    """
+
+    def __init__(self, send, on_health=None, backoff=None, breaker=None):
+        self.send = send
+        self.on_health = on_health or (lambda status: None)
+        self.backoff = backoff or Backoff()
+        self.breaker = breaker or CircuitBreaker()
+        self.pending = None
+        self.coalesced = 0  # states that were overwritten before they could be sent
+        self._wakeup = asyncio.Event()
+        self._health = None
+
+    def put(self, fields):
+        if self.pending is None:
+            self.pending = dict(fields)
+        else:
+            self.pending.update(fields)
+            self.coalesced += 1
+        self._wakeup.set()
+
+    async def run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if self.pending is None:
+                continue
+            wait = self.breaker.wait_time()
+            if wait > 0:
+                self._set_health(f"Offline, retrying in {wait:.0f}s")
+                await asyncio.sleep(wait)
+                self.breaker.wait_time()  # moves the breaker to half-open
+            # Take the newest state; anything detected while sending lands in a fresh pending.
+            state, self.pending = self.pending, None
+            try:
+                await self.send(state)
+            except Exception as e:
+                # Put it back unless a newer state arrived meanwhile.
+                if self.pending is None:
+                    self.pending = state
+                else:
+                    self.coalesced += 1
+                    state.update(self.pending)
+                    self.pending = state
+                delay = e.seconds if isinstance(e, RetryLater) else self.backoff.next_delay()
+                if not isinstance(e, RetryLater):
+                    self.breaker.record_failure()
+                self._set_health(f"Connection problem, retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
+                self._wakeup.set()
+                continue
+            self.backoff.reset()
+            self.breaker.record_success()
+            self._set_health("Connected")
+            if self.pending is not None:
+                self._wakeup.set()
+
+    def _set_health(self, status):
+        if status != self._health:
+            self._health = status
+            self.on_health(status)